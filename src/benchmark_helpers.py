@@ -0,0 +1,216 @@
+# Stage by stage benchmarks of the data pipeline on synthetic SkillCorner data
+# Every stage is timed on its own (wall time, peak resident memory above the start of the stage, rows per second) and the
+# results can be saved as a baseline JSON so later runs flag stages that got slower or use more memory.
+#
+#   python -m src.benchmark_helpers --generate --matches 2 --frames 54000 --save-baseline
+#   python -m src.benchmark_helpers                  # compares against benchmarks/baseline.json
+#   python -m src.benchmark_helpers --check-imports  # fails if a data-only import is over the import time budget
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import pandas as pd
+
+from src.data_processing_helpers import *
+from src.universal_helpers import readEvents, readTrackingData
+from src.cache_helpers import configureCache
+from src.profiling_helpers import PeakMemorySampler
+from src.synthetic_data_helpers import generateSyntheticData
+
+default_baseline_path = os.path.join("benchmarks", "baseline.json")
+default_benchmark_dir = os.path.join("data", "synthetic")
+
+# modules a data-only job imports and the packages they must not load (those belong to the modeling & plotting layers)
+data_only_modules = ["src.data_processing_helpers", "src.universal_helpers", "src.skillcorner_pysport_hackathon_helpers", "src.pipeline_helpers"]
+heavy_modules = ["matplotlib", "mplsoccer", "arviz", "bambi", "pymc", "pytensor"]
+default_import_budget_s = 1.5
+
+# the stages in pipeline order: (name, function of the outputs so far, input the rows/s are counted on)
+benchmark_stages = [
+    ("read_events",         lambda out, ids: readEvents(match_list = ids),                                                   None),
+    ("read_tracking",       lambda out, ids: readTrackingData(match_list = ids),                                             None),
+    ("partition_events",    lambda out, ids: partitionEvents(event_df = out["read_events"]),                                "read_events"),
+    ("process_pp",          lambda out, ids: process_PPdata(event_df = out["read_events"], partitions = out["partition_events"])[0], "read_events"),
+    ("process_po",          lambda out, ids: process_POforPP(event_df = out["read_events"], partitions = out["partition_events"]),  "read_events"),
+    ("process_obe",         lambda out, ids: process_OBEforPP(event_df = out["read_events"], partitions = out["partition_events"])[0], "read_events"),
+    ("normalize_direction", lambda out, ids: create_LeftToRightPoss(df = out["read_tracking"]),                             "read_tracking"),
+    ("merge_track_pp",      lambda out, ids: mergeTrack_and_PP(event_df = out["process_pp"], track_df = out["normalize_direction"]), "normalize_direction"),
+    ("ball_distance",       lambda out, ids: distance_BallCoveredInPossession(df = out["merge_track_pp"]),                  "merge_track_pp"),
+    ("ball_path_index",     lambda out, ids: ballDistanceFromIndex(event_df = out["process_pp"],
+                                                                   ball_index = createBallPathIndex(track_df = out["normalize_direction"])),
+                                                                                                                              "normalize_direction"),
+]
+
+# 1
+def runBenchmarks(match_ids : list[int], data_dir : str = default_benchmark_dir, stages : list[str] = None) -> pd.DataFrame:
+    """
+        Runs the pipeline stages on matches in data_dir (SkillCorner layout, see generateSyntheticData) without network access.
+        Returns one row per stage with wall_s, peak_mb (peak resident memory above the start of the stage),
+        rows_in, rows_out and rows_per_s
+    """
+
+    previous = configureCache()
+    configureCache(mirror_dir = data_dir, offline = True)
+
+    outputs, results = {}, []
+    try:
+        for name, stage, rows_from in benchmark_stages:
+            if stages is not None and name not in stages and name not in neededStages(stages):
+                continue
+
+            with PeakMemorySampler() as sampler:
+                start = time.perf_counter()
+                outputs[name] = stage(outputs, match_ids)
+                wall_s = time.perf_counter() - start
+
+            rows_out = len(outputs[name])
+            rows_in = len(outputs[rows_from]) if rows_from is not None else rows_out
+            results.append({"stage" : name,
+                            "wall_s" : wall_s,
+                            "peak_mb" : sampler.peak_delta_mb,
+                            "rows_in" : rows_in,
+                            "rows_out" : rows_out,
+                            "rows_per_s" : rows_in / wall_s if wall_s > 0 else float("nan")})
+    finally:
+        configureCache(offline = previous["offline"], mirror_dir = previous["mirror_dir"] or "")
+
+    return pd.DataFrame(results)
+
+def neededStages(stages : list[str]) -> set[str]:
+    """Stages that have to run before the requested stages (the benchmark always runs stages on real inputs)"""
+
+    order = [name for name, _, _ in benchmark_stages]
+    last = max(order.index(name) for name in stages)
+    return set(order[:last])
+
+# 2
+def saveBaseline(report : pd.DataFrame, baseline_path : str = default_baseline_path, **info) -> str:
+    """Saves a runBenchmarks report as the baseline, together with the machine it ran on and any extra info (e.g. n_frames)"""
+
+    baseline = {"created" : time.strftime("%Y-%m-%d %H:%M:%S"),
+                "machine" : {"python" : platform.python_version(), "platform" : platform.platform(), "cpus" : os.cpu_count()},
+                "info" : info,
+                "stages" : report.set_index("stage")[["wall_s", "peak_mb", "rows_per_s"]].to_dict(orient = "index")}
+
+    os.makedirs(os.path.dirname(baseline_path) or ".", exist_ok = True)
+    with open(baseline_path, "w") as f:
+        json.dump(baseline, f, indent = 2)
+
+    return baseline_path
+
+# 3
+def compareToBaseline(report : pd.DataFrame, baseline_path : str = default_baseline_path,
+                      time_tolerance : float = 0.25, memory_tolerance : float = 0.25, memory_floor_mb : float = 20,
+                      time_floor_s : float = 0.05) -> pd.DataFrame:
+    """
+        Adds the baseline numbers to a report and flags regressions: a stage is slower than (1 + time_tolerance) x baseline
+        wall time and more than time_floor_s slower, or its peak memory is above (1 + memory_tolerance) x baseline and more
+        than memory_floor_mb higher (stages of a few milliseconds or megabytes are within the noise of the timer & the sampler)
+    """
+
+    with open(baseline_path) as f:
+        baseline = pd.DataFrame.from_dict(json.load(f)["stages"], orient = "index")
+
+    baseline = baseline.add_prefix("baseline_").rename_axis("stage").reset_index()
+    compared = pd.merge(left = report, right = baseline[["stage", "baseline_wall_s", "baseline_peak_mb"]], on = "stage", how = "left")
+
+    compared["wall_change"] = compared["wall_s"] / compared["baseline_wall_s"] - 1
+    compared["slower"] = (compared["wall_change"] > time_tolerance) & (compared["wall_s"] - compared["baseline_wall_s"] > time_floor_s)
+    compared["more_memory"] = ((compared["peak_mb"] > (1 + memory_tolerance) * compared["baseline_peak_mb"]) &
+                               (compared["peak_mb"] - compared["baseline_peak_mb"] > memory_floor_mb))
+    compared["regression"] = compared["slower"] | compared["more_memory"]
+
+    return compared
+
+# 4
+def measureImport(module : str, repeats : int = 3) -> dict:
+    """
+        Star imports module in a fresh interpreter (repeats times, the fastest run is kept) and returns the import time,
+        the resident memory after the import and the heavy modules it loaded (a star import also loads every name in __all__)
+    """
+
+    script = ("import sys, time, json, psutil\n"
+              "start = time.perf_counter()\n"
+              f"from {module} import *\n"
+              "import_s = time.perf_counter() - start\n"
+              "print(json.dumps({'import_s' : import_s, 'rss_mb' : psutil.Process().memory_info().rss / 1024**2,\n"
+              f"                  'heavy_loaded' : [name for name in {heavy_modules!r} if name in sys.modules]}}))")
+
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = [json.loads(subprocess.run([sys.executable, "-c", script], cwd = repo_dir, capture_output = True, text = True, check = True).stdout)
+            for _ in range(repeats)]
+
+    return {"module" : module, **min(runs, key = lambda run: run["import_s"])}
+
+def checkImportTime(modules : list[str] = data_only_modules, budget_s : float = default_import_budget_s, repeats : int = 3) -> pd.DataFrame:
+    """One row per module with import_s, rss_mb and heavy_loaded. over_budget flags imports slower than budget_s or that load a heavy module"""
+
+    report = pd.DataFrame([measureImport(module = module, repeats = repeats) for module in modules])
+    report["over_budget"] = (report["import_s"] > budget_s) | (report["heavy_loaded"].str.len() > 0)
+
+    return report
+
+# 5
+def main(argv : list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description = "Benchmark the data pipeline stages on synthetic SkillCorner data")
+    parser.add_argument("--data-dir", default = default_benchmark_dir, help = "folder with the synthetic matches")
+    parser.add_argument("--generate", action = "store_true", help = "(re)write the synthetic matches first")
+    parser.add_argument("--matches", type = int, default = 2, help = "number of synthetic matches")
+    parser.add_argument("--frames", type = int, default = 54000, help = "tracking frames per match (10 per second)")
+    parser.add_argument("--possession-rate", type = float, default = 0.75, help = "share of frames with a team in possession")
+    parser.add_argument("--stages", nargs = "*", default = None, help = "only report these stages")
+    parser.add_argument("--baseline", default = default_baseline_path, help = "baseline JSON to compare with or save to")
+    parser.add_argument("--save-baseline", action = "store_true", help = "save this run as the new baseline")
+    parser.add_argument("--tolerance", type = float, default = 0.25, help = "allowed relative slow down / memory growth")
+    parser.add_argument("--check-imports", action = "store_true", help = "only check the import time of the data-only modules")
+    parser.add_argument("--import-budget", type = float, default = default_import_budget_s, help = "import time budget in seconds")
+    args = parser.parse_args(argv)
+
+    if args.check_imports:
+        imports = checkImportTime(budget_s = args.import_budget)
+        print(imports.to_string(index = False, float_format = "%.3f"))
+
+        if imports["over_budget"].any():
+            print("\n***-- Over the import budget:", ", ".join(imports.loc[imports["over_budget"], "module"]), "--***")
+            return 1
+        return 0
+
+    first_match_id = 5000001
+    if args.generate:
+        generateSyntheticData(data_dir = args.data_dir, n_matches = args.matches, n_frames = args.frames,
+                              possession_rate = args.possession_rate, first_match_id = first_match_id)
+    synthetic_ids = [first_match_id + i for i in range(args.matches)]
+
+    report = runBenchmarks(match_ids = synthetic_ids, data_dir = args.data_dir, stages = args.stages)
+    if args.stages is not None:
+        report = report.loc[report["stage"].isin(args.stages)].reset_index(drop = True)
+
+    if args.save_baseline:
+        saveBaseline(report = report, baseline_path = args.baseline, n_matches = args.matches, n_frames = args.frames,
+                     possession_rate = args.possession_rate)
+        print(f"\n***-- Saved baseline to {args.baseline} --***")
+        print(report.to_string(index = False, float_format = "%.3f"))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(report.to_string(index = False, float_format = "%.3f"))
+        print(f"\nNo baseline at {args.baseline}, run again with --save-baseline to store one")
+        return 0
+
+    compared = compareToBaseline(report = report, baseline_path = args.baseline, time_tolerance = args.tolerance, memory_tolerance = args.tolerance)
+    print(compared[["stage", "wall_s", "baseline_wall_s", "wall_change", "peak_mb", "baseline_peak_mb", "rows_per_s", "regression"]]
+          .to_string(index = False, float_format = "%.3f"))
+
+    if compared["regression"].any():
+        print("\n***-- Regressions in:", ", ".join(compared.loc[compared["regression"], "stage"]), "--***")
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# fin.
@@ -0,0 +1,462 @@
+# Local on-disk cache for the SkillCorner open data files
+# Files are stored by the sha256 of their content (objects/<sha256>) and an index maps every URL to its object.
+# The cache is bounded in size and the least recently used files are removed first.
+# Downloads run on asyncio with one shared httpx connection pool, a bounded number of concurrent transfers, retries with
+# backoff and HTTP Range resume of partially downloaded files (see fetchMatchFiles).
+import os
+import re
+import json
+import time
+import random
+import shutil
+import asyncio
+import hashlib
+import atexit
+import tempfile
+import threading
+import contextlib
+import requests
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError: # Windows: no lock between processes, run one downloading process at a time there
+    fcntl = None
+
+from src.universal_global_variables import *
+
+# current cache settings (see configureCache)
+cache_settings = {
+    "cache_dir" : os.path.expanduser(os.environ.get("SKILLCORNER_CACHE_DIR", skillcorner_cache_dir)),
+    "max_bytes" : int(float(os.environ.get("SKILLCORNER_CACHE_MAX_GB", skillcorner_cache_max_gb)) * 1024**3),
+    "offline" : os.environ.get("SKILLCORNER_OFFLINE", "0").lower() in ["1", "true", "yes"],
+    "mirror_dir" : os.environ.get("SKILLCORNER_MIRROR_DIR") or None,
+}
+
+# 1
+def configureCache(cache_dir : str = None, max_gb : float = None, offline : bool = None, mirror_dir : str = None) -> dict:
+    """
+        Changes the cache settings for this session. Only the arguments that are given are changed.
+        offline = True only reads files from the mirror directory or the cache and never downloads.
+        mirror_dir points the readers at a local copy of the SkillCorner data/matches folder (<mirror_dir>/<match_id>/<file>)
+    """
+
+    if cache_dir is not None:
+        cache_settings["cache_dir"] = os.path.expanduser(cache_dir)
+    if max_gb is not None:
+        assert max_gb > 0, "max_gb must be positive"
+        cache_settings["max_bytes"] = int(max_gb * 1024**3)
+    if offline is not None:
+        cache_settings["offline"] = bool(offline)
+    if mirror_dir is not None:
+        cache_settings["mirror_dir"] = os.path.expanduser(mirror_dir) if mirror_dir else None
+
+    return dict(cache_settings)
+
+# 2
+def skillcornerFileName(match_id : int, kind : str) -> str:
+    """Returns the SkillCorner file name of a match for kind = 'events', 'tracking' or 'match'"""
+
+    assert kind in skillcorner_match_files, f"kind must be one of {list(skillcorner_match_files)}"
+
+    return skillcorner_match_files[kind][0].format(match_id = match_id)
+
+# 3
+def skillcornerURL(match_id : int, kind : str, base_url : str = None) -> str:
+    """Returns the URL of a SkillCorner match file. base_url replaces the GitHub host (e.g. a local HTTP server)"""
+
+    if base_url is None:
+        base_url = skillcorner_match_files[kind][1]
+
+    return f"{base_url.rstrip('/')}/{match_id}/{skillcornerFileName(match_id = match_id, kind = kind)}"
+
+# cache hits of this process that are not in the index yet: {url : last access time}. They are written together with the next
+# index update (or at exit), so a cache hit never rewrites the index
+pending_access = {}
+pending_access_lock = threading.Lock()
+
+# 4
+def _indexPath() -> str:
+    return os.path.join(cache_settings["cache_dir"], "index.json")
+
+def _objectPath(sha256 : str) -> str:
+    return os.path.join(cache_settings["cache_dir"], "objects", sha256)
+
+def _readIndex() -> dict:
+    try:
+        with open(_indexPath()) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _writeIndex(index : dict) -> None:
+    # write to a temporary file first so a crash never leaves a half written index behind
+    os.makedirs(cache_settings["cache_dir"], exist_ok = True)
+    fd, temp_path = tempfile.mkstemp(dir = cache_settings["cache_dir"], suffix = ".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(index, f)
+    os.replace(temp_path, _indexPath())
+
+@contextlib.contextmanager
+def fileLock(lock_path : str):
+    """Exclusive lock between processes & threads on lock_path (created if missing) for a read-modify-write of a shared file"""
+
+    os.makedirs(os.path.dirname(lock_path) or ".", exist_ok = True)
+    with open(lock_path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _indexLock():
+    # every read-modify-write of the index holds an exclusive lock on <cache_dir>/index.lock, so processes & threads that
+    # add files at the same time never overwrite each other's entries (an entry lost that way would never be evicted)
+    return fileLock(os.path.join(cache_settings["cache_dir"], "index.lock"))
+
+def _applyPendingAccess(index : dict) -> dict:
+    # call with the index lock held
+    with pending_access_lock:
+        for url, last_access in pending_access.items():
+            if url in index:
+                index[url]["last_access"] = max(index[url]["last_access"], last_access)
+        pending_access.clear()
+
+    return index
+
+def flushAccessTimes() -> None:
+    """Writes the access times of the cache hits of this process to the index (also runs at exit)"""
+
+    if len(pending_access) == 0:
+        return
+
+    with _indexLock():
+        _writeIndex(_applyPendingAccess(index = _readIndex()))
+
+atexit.register(flushAccessTimes)
+
+# 5
+def lookupCache(url : str) -> str | None:
+    """
+        Returns the local path of a cached URL or None when it is not cached. The hit is marked as recently used in
+        pending_access, the index itself is only read
+    """
+
+    entry = _readIndex().get(url)
+    if entry is None or not os.path.exists(_objectPath(entry["sha256"])):
+        return None
+
+    with pending_access_lock:
+        pending_access[url] = time.time()
+
+    return _objectPath(entry["sha256"])
+
+# 6
+def addFileToCache(url : str, file_path : str, keep : list[str] = ()) -> str:
+    """
+        Moves a downloaded file into the cache under the sha256 of its content, records the URL in the index
+        and evicts the least recently used files when the cache is over its size limit (never url or the URLs in keep).
+        Returns the cached path
+    """
+
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    sha256 = sha256.hexdigest()
+
+    # under the lock so another process can not evict the object between the move and the index update
+    with _indexLock():
+        object_path = _objectPath(sha256)
+        os.makedirs(os.path.dirname(object_path), exist_ok = True)
+        if os.path.exists(object_path):
+            os.remove(file_path) # identical content is already cached under another URL
+        else:
+            shutil.move(file_path, object_path)
+
+        index = _applyPendingAccess(index = _readIndex())
+        index[url] = {"sha256" : sha256, "size" : os.path.getsize(object_path), "last_access" : time.time()}
+        index = evictCache(index = index, keep = [url, *keep])
+        _writeIndex(index)
+
+    return object_path
+
+# 7
+def evictCache(index : dict, keep : str | list[str] = None) -> dict:
+    """
+        Removes least recently used objects until the cache fits in max_bytes. The URLs in keep are never removed
+        (so the cache can stay over max_bytes when they do not fit). Call it with the index lock held (see addFileToCache)
+    """
+
+    keep = {keep} if isinstance(keep, str) else set(keep or [])
+
+    # several URLs can point to the same object so the size is counted per object
+    def cacheSize(index):
+        return sum({entry["sha256"] : entry["size"] for entry in index.values()}.values())
+
+    for url in sorted(index, key = lambda url: index[url]["last_access"]):
+        if cacheSize(index) <= cache_settings["max_bytes"]:
+            break
+        if url in keep:
+            continue
+
+        sha256 = index.pop(url)["sha256"]
+        if all(entry["sha256"] != sha256 for entry in index.values()) and os.path.exists(_objectPath(sha256)):
+            os.remove(_objectPath(sha256))
+
+    return index
+
+# 8
+def fetchMatchFile(match_id : int, kind : str) -> str:
+    """
+        Returns a local path for a SkillCorner match file (kind = 'events', 'tracking' or 'match').
+        Looks in the mirror directory first, then the cache, and only downloads (into the cache) when not offline
+    """
+
+    file_name = skillcornerFileName(match_id = match_id, kind = kind)
+
+    if cache_settings["mirror_dir"] is not None:
+        mirror_path = os.path.join(cache_settings["mirror_dir"], str(match_id), file_name)
+        if os.path.exists(mirror_path):
+            return mirror_path
+
+    url = skillcornerURL(match_id = match_id, kind = kind)
+    cached_path = lookupCache(url = url)
+    if cached_path is not None:
+        return cached_path
+
+    if cache_settings["offline"]:
+        raise FileNotFoundError(f"{file_name} is not in the mirror directory or the cache and offline mode is on")
+
+    return fetchMatchFiles(match_ids = [match_id], kinds = [kind])[(match_id, kind)]
+
+# 9
+def matchFileSize(match_id : int, kind : str) -> int | None:
+    """
+        Size in bytes of a SkillCorner match file without downloading it: from the mirror directory or the cache when
+        the file is there, otherwise from the Content-Length of a HEAD request. None when the size is unknown
+    """
+
+    file_name = skillcornerFileName(match_id = match_id, kind = kind)
+    if cache_settings["mirror_dir"] is not None:
+        mirror_path = os.path.join(cache_settings["mirror_dir"], str(match_id), file_name)
+        if os.path.exists(mirror_path):
+            return os.path.getsize(mirror_path)
+
+    url = skillcornerURL(match_id = match_id, kind = kind)
+    entry = _readIndex().get(url)
+    if entry is not None:
+        return entry["size"]
+
+    if cache_settings["offline"]:
+        return None
+
+    try:
+        response = requests.head(url, allow_redirects = True, timeout = 30)
+        response.raise_for_status()
+        return int(response.headers["Content-Length"])
+    except (requests.RequestException, KeyError, ValueError):
+        return None
+
+# 10
+def matchFileHash(match_id : int, kind : str) -> str:
+    """
+        sha256 of the content of a SkillCorner match file (fetched through fetchMatchFile).
+        Cached files are stored under their hash so only mirror files have to be read
+    """
+
+    file_path = fetchMatchFile(match_id = match_id, kind = kind)
+    if os.path.dirname(file_path) == os.path.dirname(_objectPath("")):
+        return os.path.basename(file_path)
+
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+# 11
+def clearCache() -> None:
+    """Deletes every cached file"""
+
+    with pending_access_lock:
+        pending_access.clear()
+    shutil.rmtree(cache_settings["cache_dir"], ignore_errors = True)
+
+# ***
+# Async downloads
+
+# 12
+def _partialPath(url : str) -> str:
+    # the same URL always resumes into the same file
+    return os.path.join(cache_settings["cache_dir"], "partial", hashlib.sha256(url.encode()).hexdigest() + ".part")
+
+def _validatorPath(url : str) -> str:
+    # ETag / Last-Modified of the response the .part file was started from
+    return _partialPath(url = url) + ".json"
+
+def _discardPartial(url : str) -> None:
+    for path in [_partialPath(url = url), _validatorPath(url = url)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+def _resumeHeaders(url : str, offset : int) -> dict:
+    # Range + If-Range for a partial file: the server only sends the missing bytes when the file did not change,
+    # otherwise the whole file. Without a validator we can not tell so the download starts again
+    try:
+        with open(_validatorPath(url = url)) as f:
+            validator = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        validator = {}
+
+    if_range = validator.get("etag") or validator.get("last_modified")
+    if offset == 0 or if_range is None:
+        return {}
+
+    return {"Range" : f"bytes={offset}-", "If-Range" : if_range}
+
+def _saveValidator(url : str, response : httpx.Response) -> None:
+    # weak ETags can not be used in If-Range
+    etag = response.headers.get("ETag")
+    validator = {"etag" : etag if etag is not None and not etag.startswith("W/") else None,
+                 "last_modified" : response.headers.get("Last-Modified")}
+    with open(_validatorPath(url = url), "w") as f:
+        json.dump(validator, f)
+
+def _contentRange(response : httpx.Response) -> tuple:
+    # "bytes 100-999/1000" -> (100, 1000), "bytes */1000" -> (None, 1000), total is None when unknown ("*")
+    match = re.fullmatch(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)", response.headers.get("Content-Range", "").strip())
+    if match is None:
+        return None, None
+
+    start, total = match.groups()
+    return (None if start is None else int(start)), (None if total == "*" else int(total))
+
+async def downloadFileAsync(client : httpx.AsyncClient, url : str, retries : int = 5, backoff : float = 1.0) -> str:
+    """
+        Streams a URL into <cache_dir>/partial/<sha256 of url>.part and returns that path. When a partial file is already
+        there (a dropped connection or an earlier crash) only the missing bytes are requested with an HTTP Range header and
+        an If-Range of the ETag / Last-Modified the partial file was started from (kept next to it in .part.json). The bytes
+        are only appended to a 206 response whose Content-Range starts where the partial file ends, anything else starts
+        again from byte 0. Connection errors, 429 and 5xx responses are retried with exponential backoff, other errors are raised
+    """
+
+    part_path = _partialPath(url = url)
+    os.makedirs(os.path.dirname(part_path), exist_ok = True)
+
+    for attempt in range(retries + 1):
+        try:
+            for resume in [True, False]: # a resume the server answers with the wrong range is requested again from byte 0
+                offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                headers = _resumeHeaders(url = url, offset = offset) if resume else {}
+
+                async with client.stream("GET", url, headers = headers) as response:
+                    start, total = _contentRange(response = response)
+                    if response.status_code == 416 and "Range" in headers and total == offset: # nothing left to download
+                        return part_path
+                    if "Range" in headers and (response.status_code == 416 or (response.status_code == 206 and start != offset)):
+                        _discardPartial(url = url)
+                        continue
+                    if response.status_code == 206 and "Range" not in headers:
+                        raise httpx.HTTPStatusError(f"unexpected 206 for {url} without a Range header", request = response.request, response = response)
+                    if response.status_code == 429 or response.status_code >= 500:
+                        raise httpx.HTTPStatusError(f"{response.status_code} for {url}", request = response.request, response = response)
+                    response.raise_for_status()
+
+                    # 206: the missing bytes of the same file, 200: the whole file (it changed, or the server ignores ranges)
+                    if response.status_code != 206:
+                        _saveValidator(url = url, response = response)
+                    with open(part_path, "ab" if response.status_code == 206 else "wb") as f:
+                        async for block in response.aiter_bytes(chunk_size = 1024 * 1024):
+                            f.write(block)
+
+                return part_path
+
+        except (httpx.TransportError, httpx.HTTPStatusError) as error:
+            retryable = isinstance(error, httpx.TransportError) or error.response.status_code == 429 or error.response.status_code >= 500
+            if not retryable or attempt == retries:
+                raise
+            wait = backoff * 2**attempt * (1 + random.random()) # jitter so parallel downloads do not retry at once
+            print(f"download of {url} failed ({error!r}), retrying in {wait:.1f}s")
+            await asyncio.sleep(wait)
+
+async def _fetchMatchFilesAsync(jobs : list[tuple], max_concurrency : int, retries : int, backoff : float, keep : list[str] = ()) -> dict:
+    semaphore = asyncio.Semaphore(max_concurrency)
+    cache_lock = asyncio.Lock() # the cache index is a single JSON file
+
+    limits = httpx.Limits(max_connections = max_concurrency, max_keepalive_connections = max_concurrency)
+    timeout = httpx.Timeout(60, connect = 15)
+
+    async with httpx.AsyncClient(limits = limits, timeout = timeout, follow_redirects = True) as client:
+
+        async def fetch(key, download_url, cache_url):
+            async with semaphore:
+                part_path = await downloadFileAsync(client = client, url = download_url, retries = retries, backoff = backoff)
+            async with cache_lock:
+                # hashing a large file should not block the other downloads
+                cached_path = await asyncio.to_thread(addFileToCache, cache_url, part_path, keep)
+            _discardPartial(url = download_url) # the validator of the finished download
+            return key, cached_path
+
+        return dict(await asyncio.gather(*[fetch(*job) for job in jobs]))
+
+def runAsync(coroutine):
+    """Runs a coroutine to completion, also from Jupyter where an event loop is already running in this thread"""
+
+    try:
+        asyncio.get_running_loop()
+        loop_running = True
+    except RuntimeError:
+        loop_running = False
+
+    if not loop_running:
+        return asyncio.run(coroutine)
+
+    # the running loop belongs to the notebook, so our loop runs in a worker thread
+    with ThreadPoolExecutor(max_workers = 1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+# 13
+def fetchMatchFiles(match_ids : list[int], kinds : list[str] = list(skillcorner_match_files), base_url : str = None,
+                    max_concurrency : int = 8, retries : int = 5, backoff : float = 1.0) -> dict:
+    """
+        Makes sure the SkillCorner files of many matches are local and returns {(match_id, kind) : path}.
+        Files in the mirror directory or the cache are used as they are, the others are downloaded concurrently over one
+        connection pool (at most max_concurrency at a time) and added to the cache. base_url downloads from another host
+        (e.g. a local HTTP server) but the files are cached under their SkillCorner URL so the readers find them.
+        The files of all match_ids are pinned while the others download, so call it with one batch at a time: the cache
+        can go over its size limit when a batch does not fit
+    """
+
+    paths, jobs = {}, []
+    for match_id in match_ids:
+        for kind in kinds:
+            mirror_path = None
+            if cache_settings["mirror_dir"] is not None:
+                mirror_path = os.path.join(cache_settings["mirror_dir"], str(match_id), skillcornerFileName(match_id = match_id, kind = kind))
+
+            cache_url = skillcornerURL(match_id = match_id, kind = kind)
+            if mirror_path is not None and os.path.exists(mirror_path):
+                paths[(match_id, kind)] = mirror_path
+            elif (cached_path := lookupCache(url = cache_url)) is not None:
+                paths[(match_id, kind)] = cached_path
+            elif cache_settings["offline"]:
+                raise FileNotFoundError(f"{skillcornerFileName(match_id = match_id, kind = kind)} is not in the mirror directory or the cache and offline mode is on")
+            else:
+                jobs.append(((match_id, kind), skillcornerURL(match_id = match_id, kind = kind, base_url = base_url), cache_url))
+
+    flushAccessTimes() # one index update for all the cache hits
+
+    if len(jobs) > 0:
+        print(f"***-- Downloading {len(jobs)} SkillCorner files --***")
+        # downloads evict least recently used files, but never the other files of this call
+        keep = [skillcornerURL(match_id = match_id, kind = kind) for match_id in match_ids for kind in kinds]
+        paths.update(runAsync(_fetchMatchFilesAsync(jobs = jobs, max_concurrency = max_concurrency, retries = retries, backoff = backoff, keep = keep)))
+
+    return paths
+
+# fin.
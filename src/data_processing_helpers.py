@@ -1,8 +1,69 @@
 # Author: Tahmeed Tureen <tureen@umich.edu>
 import pandas as pd
-import requests
+import json
 import numpy as np
 from src.universal_global_variables import *
+from src.cache_helpers import fetchMatchFile
+from src.profiling_helpers import StageProfile, profiling_settings
+
+# 0 Packed possession keys
+def packPossessionKey(match_id, possession, index = 0) -> np.ndarray:
+    """
+        Packs match_id, the team possession number and the event index into one int64 (see possession_key_bits).
+        index = 0 gives the key of the team possession, so team_poss_key == poss_key with the index bits cleared
+    """
+
+    match_id = np.asarray(match_id, dtype = np.int64)
+    possession = np.asarray(possession, dtype = np.int64)
+    index = np.asarray(index, dtype = np.int64)
+
+    for name, values in [("match_id", match_id), ("possession", possession), ("index", index)]:
+        assert values.size == 0 or (values.min() >= 0 and values.max() < 2**possession_key_bits[name]), \
+            f"{name} does not fit in the {possession_key_bits[name]} bits of the possession key"
+
+    return ((match_id << (possession_key_bits["possession"] + possession_key_bits["index"])) |
+            (possession << possession_key_bits["index"]) |
+            index)
+
+def validateMatchIds(match_ids) -> None:
+    """Checks that every match_id is a non negative integer that fits in the match_id bits of the possession keys (see possession_key_bits)"""
+
+    for id in match_ids:
+        assert isinstance(id, (int, np.integer)) and not isinstance(id, bool), f"match_id {id!r} must be an integer"
+        assert 0 <= id < 2**possession_key_bits["match_id"], \
+            f"match_id {id} does not fit in the {possession_key_bits['match_id']} bits of the possession key (see possession_key_bits)"
+
+def unpackPossessionKey(keys) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns match_id, team possession number and event index of packed possession keys"""
+
+    keys = np.asarray(keys, dtype = np.int64)
+    index = keys & (2**possession_key_bits["index"] - 1)
+    possession = (keys >> possession_key_bits["index"]) & (2**possession_key_bits["possession"] - 1)
+    match_id = keys >> (possession_key_bits["possession"] + possession_key_bits["index"])
+
+    return match_id, possession, index
+
+def addPossessionLabels(df : pd.DataFrame, pp_df : pd.DataFrame = None) -> pd.DataFrame:
+    """
+        Adds the readable possession IDs for display: match_team_possession_id (match_team_possession number) and
+        individual_poss_id (match_index_event_id). The parts that are not in df are looked up in pp_df on poss_key
+    """
+
+    label_cols = ["match_id", "team_shortname", "match_possession_id", "index", "event_id"]
+    missing = [col for col in label_cols if col not in df.columns]
+
+    labels = df[["poss_key"] + [col for col in label_cols if col not in missing]]
+    if len(missing) > 0:
+        assert pp_df is not None, f"df has no {missing} columns, pass the player possession data (process_PPdata) as pp_df"
+        labels = pd.merge(left = labels, right = pp_df[["poss_key"] + missing].drop_duplicates("poss_key"), on = "poss_key", how = "left")
+
+    df = df.copy()
+    df["match_team_possession_id"] = (labels["match_id"].astype("str") + "_" + labels["team_shortname"].astype("str").str.strip() + "_" +
+                                      labels["match_possession_id"].astype("str")).to_numpy()
+    df["individual_poss_id"] = (labels["match_id"].astype("str") + "_" + labels["index"].astype("str") + "_" +
+                                labels["event_id"].astype("str")).to_numpy()
+
+    return df
 
 # 1 This function helps us create a possession index/identifier
 def createPossessionIndex(pp_df: pd.DataFrame) -> pd.DataFrame:
@@ -14,28 +75,31 @@ def createPossessionIndex(pp_df: pd.DataFrame) -> pd.DataFrame:
 
     #TODO asserts
 
-    pp_out = pp_df.sort_values(["match_id", "index"], ascending = True) # sort the dataset appropriately by making sure index is moving from 0 to infinity
-    pp_out["team_possession_start"] = (pp_out.groupby("match_id")["first_player_possession_in_team_possession"].transform(lambda indicator : (indicator == True))).astype(int) # create a numeric in the sequence that represents the start of a new possession
-    pp_out["match_possession_id"] = pp_out.groupby(["match_id"])["team_possession_start"].cumsum() # by summing the cumulative posession starts, we can get the n-th posession in the match
-    pp_out["match_team_possession_id"] = pp_out["match_id"].astype(str) + "_" + pp_out["team_shortname"].str.strip() + "_" + pp_out["match_possession_id"].astype(str)
-    pp_out["individual_poss_id"] = pp_out["match_id"].astype("str") + "_" + pp_out["index"].astype("str") + "_" + pp_out["event_id"].astype("str") # create 
+    pp_out = sortFrame(df = pp_df, columns = ["match_id", "index"]) # sort the dataset appropriately by making sure index is moving from 0 to infinity
+    team_possession_start = (pp_out["first_player_possession_in_team_possession"] == True).to_numpy().astype(int) # create a numeric in the sequence that represents the start of a new possession
+    pp_out["team_possession_start"] = team_possession_start
+    # by summing the cumulative posession starts, we can get the n-th posession in the match
+    # (the rows of a match are contiguous after the sort, so the running sum restarts at the first row of every match)
+    match_values = pp_out["match_id"].to_numpy()
+    first_row = np.ones(len(match_values), dtype = bool)
+    first_row[1:] = match_values[1:] != match_values[:-1]
+    running_starts = np.cumsum(team_possession_start)
+    pp_out["match_possession_id"] = running_starts - np.maximum.accumulate(np.where(first_row, running_starts - team_possession_start, 0))
+    # integer keys for joins & group bys (the readable string IDs are only made for display, see addPossessionLabels)
+    pp_out["team_poss_key"] = packPossessionKey(match_id = pp_out["match_id"], possession = pp_out["match_possession_id"])
+    pp_out["poss_key"] = packPossessionKey(match_id = pp_out["match_id"], possession = pp_out["match_possession_id"], index = pp_out["index"])
 
     # ** Calculate possession metrics for each match and possession
     # team_possession_duration: duration (seconds) of the team possession until possession changes to opposition team
     # team_possession_num_sequences : number of player possession changes within the team possession
-    possession_metrics = (pp_out.groupby(["match_id", "match_possession_id", "match_team_possession_id", "team_id"])
-                                .agg(team_possession_duration = ("duration", "sum"),
-                                     team_possession_num_sequences = ("index", "size"))
-                         )
+    possession_metrics = aggregateGroups(df = pp_out, keys = ["match_id", "match_possession_id", "team_poss_key", "team_id"],
+                                         team_possession_duration = ("duration", "sum"),
+                                         team_possession_num_sequences = ("index", "size"))
     
-    # Make sure the IDs are strings for future use
-    pp_out["match_id"] = pp_out["match_id"].astype("str")
-    pp_out["team_id"] = pp_out["team_id"].astype("str")
-    pp_out["player_id"] = pp_out["player_id"].astype("str")
+    # Make sure the IDs are strings for future use (stored as categoricals with string categories)
+    pp_out = applyDataSchema(df = pp_out, schema = possession_id_schema, stage = "player possession", report_memory = False)
 
-    possession_metrics = possession_metrics.reset_index(drop = False)
-
-    return pp_out, possession_metrics.sort_values(["match_id", "match_possession_id"], ascending = True)
+    return pp_out, possession_metrics
 
 # 2 # add a new column frame_end_v2 that represents the end frame for any passes 
 # # (in other words, the frame_start of a reception from a successful pass in a team possession)
@@ -43,30 +107,124 @@ def createPassEndFrame(df: pd.DataFrame) -> pd.DataFrame:
     """TODO add description"""
     # TODO: add asserts!
     
-    df = df.sort_values(["match_id", "match_possession_id", "index"]) # sort to make sure every row is in order
+    df = sortFrame(df = df, columns = ["match_id", "match_possession_id", "index"]) # sort to make sure every row is in order
 
-    # group by our unique possession id and then create a variable that captures what the next frame is
-    # this works for us because we already filtered the data for just possession
-    df["next_frame_start"] = (
-        df.groupby("match_team_possession_id")["frame_start"].shift(-1)
-    )
+    # the player possessions of a team possession are contiguous after the sort, so the next frame in the team possession
+    # is the frame_start of the next row whenever that row has the same team_poss_key
+    team_poss_key = df["team_poss_key"].to_numpy()
+    frame_start = df["frame_start"].to_numpy()
+    has_next = np.zeros(len(df), dtype = bool)
+    has_next[:-1] = team_poss_key[1:] == team_poss_key[:-1]
+    next_frame_start = np.r_[frame_start[1:], frame_start[-1:]] # the last row has no next row (has_next is False)
 
     # We will create a frame_end version 2 which captures where the ball ends up when there is a successful pass
     # filters:
     # (1) Player Possession ends with a pass
     # (2) Pass outcome is successful
     # (3) This action is not the last action in the Team Possession (TODO: Ask @NanoSkillCorner question about this)
-    bool_successful_pass = (df["end_type"] == "pass") & (df["pass_outcome"] == "successful") & (df["last_player_possession_in_team_possession"] == False)
-    df["frame_end_v2"] = df["frame_end"] # assign this as a catch all since not all possessions end with a successful pass
-    df.loc[bool_successful_pass, "frame_end_v2"] = df.loc[bool_successful_pass, "next_frame_start"] # using the filter we now assign the new frame (where the ball is sent via a pass)
+    bool_successful_pass = ((df["end_type"] == "pass") & (df["pass_outcome"] == "successful") & (df["last_player_possession_in_team_possession"] == False)).to_numpy()
+    assert has_next[bool_successful_pass].all(), "a successful pass that is not the last player possession must be followed by one in the same team possession"
 
-    df["frame_end_v2"] = df["frame_end_v2"].astype("int") # convert this to integer
-    df.drop(columns = ["next_frame_start"], inplace = True) # drop this variable
+    # frame_end is the catch all since not all possessions end with a successful pass, the passes get the frame where the ball is sent
+    df["frame_end_v2"] = np.where(bool_successful_pass, next_frame_start, df["frame_end"].to_numpy()).astype("int")
 
     return df
 
 # 3
-def process_PPdata(event_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+def partitionEvents(event_df : pd.DataFrame, event_types : list[str] = None) -> dict[str, np.ndarray]:
+    """
+        Splits the events by event_type in a single pass (one stable sort of the event_type codes) and returns a dictionary
+        event_type -> row positions of that type, in their original order. event_types limits the dictionary to those types.
+        Pass it to process_PPdata, process_POforPP and process_OBEforPP so they only copy their own rows & columns
+    """
+
+    event_type = event_df["event_type"]
+    codes, categories = (event_type.cat.codes.to_numpy(), event_type.cat.categories) if isinstance(event_type.dtype, pd.CategoricalDtype) \
+                        else pd.factorize(event_type)
+
+    order = np.argsort(codes, kind = "stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(categories) + 1), side = "left")
+
+    partitions = {str(category) : order[bounds[k]:bounds[k + 1]] for k, category in enumerate(categories)}
+    if event_types is not None:
+        partitions = {event_type : partitions.get(event_type, np.array([], dtype = np.int64)) for event_type in event_types}
+
+    return partitions
+
+def eventsOfType(event_df : pd.DataFrame, event_type : str, columns : list[str], partitions : dict[str, np.ndarray] = None) -> pd.DataFrame:
+    """The columns of the events of one event_type, using the row positions of partitionEvents when they are given"""
+
+    if partitions is None:
+        return event_df.loc[event_df["event_type"] == event_type, columns]
+
+    # column by column, so only the rows of this event type are copied (iloc copies the selected columns of every row first)
+    rows = partitions.get(event_type, np.array([], dtype = np.int64))
+    return pd.DataFrame({col : event_df[col].array.take(rows) for col in columns}, index = event_df.index[rows])
+
+def aggregateGroups(df : pd.DataFrame, keys : list[str], **aggregations) -> pd.DataFrame:
+    """
+        Same result as df.groupby(keys).agg(**aggregations).reset_index() for numeric keys and the aggregations
+        "size", "nunique", "sum", "min", "max" & "mean" (missing values are skipped, rows with a missing key dropped),
+        but the groups are runs of one sort of the keys and every aggregation is one numpy reduceat, so it does not pay
+        the fixed cost of a pandas group by (most of the time of the event stages, which have small groups)
+    """
+
+    assert all(func in ["size", "nunique", "sum", "min", "max", "mean"] for _, func in aggregations.values()), \
+        "aggregations must be (column, func) with func in size, nunique, sum, min, max or mean"
+
+    key_values = [df[key].to_numpy() for key in keys]
+    keep = np.ones(len(df), dtype = bool)
+    for values in key_values:
+        keep &= ~pd.isna(values)
+
+    # order of the kept rows by keys (first key first) and the first row of every group in that order
+    rows = np.flatnonzero(keep)
+    if len(keys) > 0 and not keysInOrder(keys = [values[rows] for values in key_values]):
+        rows = rows[np.lexsort([values[rows] for values in key_values[::-1]])]
+    new_group = np.zeros(len(rows), dtype = bool)
+    new_group[:1] = True
+    for values in key_values:
+        sorted_values = values[rows]
+        new_group[1:] |= sorted_values[1:] != sorted_values[:-1]
+    starts = np.flatnonzero(new_group)
+    sizes = np.diff(np.r_[starts, len(rows)])
+
+    output = {key : df[key].to_numpy()[rows[starts]] for key in keys}
+    for name, (column, func) in aggregations.items():
+        values = df[column].to_numpy()[rows]
+        if func == "size":
+            output[name] = sizes.astype(np.int64)
+            continue
+
+        missing = pd.isna(values)
+        if func == "nunique":
+            # sort the value codes inside every group (one stable sort, the groups stay in place) and count where they change
+            codes = pd.factorize(values)[0] # -1 for missing values, which are not counted
+            within = np.argsort(np.repeat(np.arange(len(starts), dtype = np.int64), sizes) * (codes.max(initial = 0) + 2) + codes, kind = "stable")
+            sorted_codes = codes[within]
+            first_value = new_group.copy()
+            first_value[1:] |= sorted_codes[1:] != sorted_codes[:-1]
+            output[name] = np.add.reduceat(first_value & (sorted_codes >= 0), starts).astype(np.int64) if len(starts) else np.zeros(0, dtype = np.int64)
+            continue
+
+        # float sums are accumulated in float64 and returned in the column's type like pandas does (integer means are float64)
+        result_type = values.dtype if np.issubdtype(values.dtype, np.floating) else (np.float64 if func == "mean" else values.dtype)
+        totals = np.where(missing, 0, values).astype(np.float64 if np.issubdtype(values.dtype, np.floating) else np.int64)
+        if len(starts) == 0:
+            output[name] = np.zeros(0, dtype = result_type)
+        elif func == "sum":
+            output[name] = np.add.reduceat(totals, starts).astype(result_type)
+        elif func in ["min", "max"]:
+            reduce = np.fmin if func == "min" else np.fmax # fmin / fmax skip missing values
+            output[name] = reduce.reduceat(values, starts).astype(result_type)
+        else:
+            with np.errstate(invalid = "ignore", divide = "ignore"):
+                output[name] = (np.add.reduceat(totals, starts) / np.add.reduceat(~missing, starts)).astype(result_type)
+
+    return pd.DataFrame(output)
+
+# 3a
+def process_PPdata(event_df: pd.DataFrame, partitions : dict[str, np.ndarray] = None) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
         Takes in SkillCorner events dataset, selects relevant columns based on a global variable (see src.universal_global_variables)
         and creates a dataset that can be used to model possession metrics. The model also returns a match and possession level summary
@@ -77,7 +235,7 @@ def process_PPdata(event_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
     # TODO assert for global variables
     
     # pp_variables is a global variable
-    output_df = event_df.loc[event_df["event_type"] == "player_possession", :][pp_variables].reset_index(drop = True)
+    output_df = eventsOfType(event_df = event_df, event_type = "player_possession", columns = pp_variables, partitions = partitions).reset_index(drop = True)
 
     # add a possesion label for each PP event and match combo
     output_df, possession_metrics = createPossessionIndex(pp_df = output_df)
@@ -91,86 +249,74 @@ def process_PPdata(event_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
 
 # 4
 # TODO: add to helpers
-def process_POforPP(event_df : pd.DataFrame) -> pd.DataFrame:
+def process_POforPP(event_df : pd.DataFrame, partitions : dict[str, np.ndarray] = None) -> pd.DataFrame:
     # TODO: add asserts
-    output_df = event_df.loc[event_df["event_type"] == "passing_option", :][po_variables]
-    output_df.rename({"associated_player_possession_event_id" : "pp_event_id"}, axis = 1, inplace = True)
+    # only copy the columns of po_variables that are aggregated below (the others are for future steps)
+    po_columns = [col for col in po_variables if col in ["match_id", "associated_player_possession_event_id", "player_id",
+                                                           "interplayer_distance", "passing_option_score"]]
+    output_df = eventsOfType(event_df = event_df, event_type = "passing_option", columns = po_columns, partitions = partitions)
+    output_df = output_df.rename({"associated_player_possession_event_id" : "pp_event_id"}, axis = 1)
 
     # group by and create metrics that could be potential predictors in our model
-    output_df = output_df.groupby(["match_id", "pp_event_id"]).agg({"interplayer_distance" : ["min", "mean"],
-                                                     "passing_option_score" : ["max", "mean"],
-                                                     "player_id" : "nunique"}).reset_index()
-    
-    output_df.columns = ['_'.join(col).strip() for col in output_df.columns.values]
-    output_df.rename({"match_id_" : "match_id", 
-                      "pp_event_id_" : "pp_event_id",
-                      "player_id_nunique" : "po_options_custom"},
-                        axis = 1, inplace = True)
+    output_df = aggregateGroups(df = output_df, keys = ["match_id", "pp_event_id"],
+                                interplayer_distance_min = ("interplayer_distance", "min"),
+                                interplayer_distance_mean = ("interplayer_distance", "mean"),
+                                passing_option_score_max = ("passing_option_score", "max"),
+                                passing_option_score_mean = ("passing_option_score", "mean"),
+                                po_options_custom = ("player_id", "nunique"))
 
     return output_df
 
 # 5
-# TODO add doc
-def aggregateOBE(obe_df, subtypes) -> pd.DataFrame:
-    # TODO add asserts
-    obe_agg = obe_df.loc[obe_df["event_subtype"].isin(subtypes), :]
-    obe_agg = obe_agg.groupby(["match_id", "pp_event_id"]).agg({"player_id" : "nunique",
-                                                                "distance_covered" : ["mean", "min"],
-                                                                "speed_avg" : ["mean", "max"]})
-    obe_agg = obe_agg.reset_index()
-
-    obe_agg.columns = ['_'.join(col).strip() for col in obe_agg.columns.values]
+def aggregateOBE(obe_df : pd.DataFrame, buckets : dict[str, list[str]] = obe_subtype_buckets) -> dict[str, pd.DataFrame]:
+    """
+        Aggregates on ball engagements per player possession for every subtype bucket (see obe_subtype_buckets) with one
+        group by over (bucket, match_id, pp_event_id). Returns bucket -> feature block with the columns
+        match_id, pp_event_id, num_<bucket>_players, <bucket>_dist_covered_mean/min, <bucket>_speed_avg_mean/max
+    """
 
-    return obe_agg
+    # bucket of every row (-1 when the subtype is in no bucket), the rows in no bucket are dropped
+    bucket_index = {subtype : k for k, subtypes in enumerate(buckets.values()) for subtype in subtypes}
+    subtypes = pd.Categorical(obe_df["event_subtype"])
+    lookup = np.array([bucket_index.get(subtype, -1) for subtype in subtypes.categories] + [-1], dtype = np.int8)
+    bucket = lookup[subtypes.codes] # code -1 (missing subtype) reads the last entry
+    keep = bucket >= 0
+    obe_agg = pd.DataFrame({"bucket" : bucket[keep],
+                            **{col : obe_df[col].to_numpy()[keep] for col in ["match_id", "pp_event_id", "player_id", "distance_covered", "speed_avg"]}})
+
+    obe_agg = aggregateGroups(df = obe_agg, keys = ["bucket", "match_id", "pp_event_id"],
+                              num_players = ("player_id", "nunique"),
+                              dist_covered_mean = ("distance_covered", "mean"),
+                              dist_covered_min = ("distance_covered", "min"),
+                              speed_avg_mean = ("speed_avg", "mean"),
+                              speed_avg_max = ("speed_avg", "max"))
+
+    # pivot: the rows are sorted by bucket first, so every bucket is a slice of the aggregated rows
+    bucket_bounds = np.searchsorted(obe_agg["bucket"].to_numpy(), np.arange(len(buckets) + 1), side = "left")
+    columns = {col : obe_agg[col].to_numpy() for col in obe_agg.columns if col != "bucket"}
+    output = {}
+    for k, name in enumerate(buckets):
+        rows = slice(bucket_bounds[k], bucket_bounds[k + 1])
+        output[name] = pd.DataFrame({(f"num_{name}_players" if col == "num_players" else col if col in ["match_id", "pp_event_id"] else f"{name}_{col}") :
+                                     values[rows] for col, values in columns.items()})
+
+    return output
 
 # 6
 # TODO add doc
-def process_OBEforPP(event_df : pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+def process_OBEforPP(event_df : pd.DataFrame, partitions : dict[str, np.ndarray] = None) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     # TODO add asserts
 
-    obe_df = event_df.loc[event_df["event_type"] == "on_ball_engagement", :][obe_variables].reset_index(drop = True)
-    obe_df.rename({"associated_player_possession_event_id" : "pp_event_id"}, axis = 1, inplace = True)
-
-    # presses
-    press = ["pressing", "counter_press", "recovery_press"]
-    press_df = aggregateOBE(obe_df = obe_df, subtypes = press)
-    press_df.rename({"match_id_" : "match_id",
-                     "pp_event_id_" : "pp_event_id",
-                     "player_id_nunique" : "num_opp_press_players",
-                     "distance_covered_mean" : "opp_press_dist_covered_mean",
-                     "distance_covered_min" : "opp_press_dist_covered_min",
-                     "speed_avg_mean" : "opp_press_speed_avg_mean",
-                     "speed_avg_max" : "opp_press_speed_avg_max"
-                     }, 
-                     axis = 1,
-                     inplace = True)
-
-    # pressure
-    pressure_df = aggregateOBE(obe_df = obe_df, subtypes = ["pressure"])
-    pressure_df.rename({"match_id_" : "match_id",
-                        "pp_event_id_" : "pp_event_id",
-                        "player_id_nunique" : "num_opp_pressure_players",
-                        "distance_covered_mean" : "opp_pressure_dist_covered_mean",
-                        "distance_covered_min" : "opp_pressure_dist_covered_min",
-                        "speed_avg_mean" : "opp_pressure_speed_avg_mean",
-                        "speed_avg_max" : "opp_pressure_speed_avg_max"
-                        }, 
-                        axis = 1,
-                        inplace = True)
-
-    # other
-    other_df = aggregateOBE(obe_df = obe_df, subtypes = ["other"])
-    other_df.rename({"match_id_" : "match_id",
-                     "pp_event_id_" : "pp_event_id",
-                     "player_id_nunique" : "num_opp_other_obe_players",
-                     "distance_covered_mean" : "opp_other_obe_dist_covered_mean",
-                     "distance_covered_min" : "opp_other_obe_dist_covered_min",
-                     "speed_avg_mean" : "opp_other_obe_speed_avg_mean",
-                     "speed_avg_max" : "opp_other_obe_speed_avg_max"}, 
-                     axis = 1,
-                     inplace = True)
-
-    return press_df, pressure_df, other_df
+    # only copy the columns of obe_variables that aggregateOBE reads (the others are for future steps)
+    obe_columns = [col for col in obe_variables if col in ["match_id", "associated_player_possession_event_id", "event_subtype",
+                                                             "player_id", "distance_covered", "speed_avg"]]
+    obe_df = eventsOfType(event_df = event_df, event_type = "on_ball_engagement", columns = obe_columns, partitions = partitions).reset_index(drop = True)
+    obe_df = obe_df.rename({"associated_player_possession_event_id" : "pp_event_id"}, axis = 1)
+
+    # presses, pressure & other in one pass (see obe_subtype_buckets)
+    obe_blocks = aggregateOBE(obe_df = obe_df)
+
+    return obe_blocks["opp_press"], obe_blocks["opp_pressure"], obe_blocks["opp_other_obe"]
 
 
 # 7
@@ -178,11 +324,9 @@ def playerMetaData(match_id : int) -> pd.DataFrame:
     # TODO asserts
     # Code inspired by SkillCorner's open tutorials
     
-    meta_data_github_url = f"https://raw.githubusercontent.com/SkillCorner/opendata/master/data/matches/{match_id}/{match_id}_match.json"
-    
-    # Read the JSON data as a JSON object
-    response = requests.get(meta_data_github_url)
-    raw_match_data = response.json()
+    # Read the JSON data as a JSON object (downloaded once and then read from the local cache)
+    with open(fetchMatchFile(match_id = match_id, kind = "match")) as f:
+        raw_match_data = json.load(f)
 
     # The output has nested json elements. We process them
     raw_match_df = pd.json_normalize(raw_match_data, max_level=2)  
@@ -257,7 +401,7 @@ def playerMetaData(match_id : int) -> pd.DataFrame:
         "direction_player_2nd_half",
     ]
 
-    return players_df[columns_to_keep]
+    return applyDataSchema(df = players_df[columns_to_keep].copy(), schema = tracking_schema, report_memory = False)
 
 # 8
 # TODO NEED TO FIX THIS function
@@ -285,102 +429,222 @@ def cleanTrackingData(df, match_id) -> pd.DataFrame:
     # raw_df["possession_player_id"] = raw_df["possession_player_id"].astype("str")
     raw_df["match_id"] = str(match_id) # Add the match_id identifier to your dataframe
     
-    return raw_df
+    return applyDataSchema(df = raw_df, schema = tracking_schema, stage = f"tracking {match_id}")
+
+# 8a
+def parseTrackingData(file_path : str, match_id : int, players_per_frame : int = 23) -> pd.DataFrame:
+    """
+        Streaming version of pd.read_json + cleanTrackingData for a SkillCorner _tracking_extrapolated.jsonl file.
+        The file is read line by line and written straight into preallocated NumPy columns (one row per player per frame),
+        so the match is never held as nested Python objects. Returns the same data frame as cleanTrackingData
+    """
+
+    # one pass to count the frames so the frame level columns can be preallocated
+    with open(file_path, "rb") as f:
+        n_frames = sum(1 for line in f if line.strip())
+
+    # frame level columns (broadcast to the players of the frame at the end)
+    frame = np.zeros(n_frames, dtype = np.int64)
+    timestamp = np.full(n_frames, None, dtype = object)
+    period = np.full(n_frames, np.nan)
+    possession_player_id = np.full(n_frames, np.nan)
+    possession_group = np.full(n_frames, None, dtype = object)
+    ball_x = np.full(n_frames, np.nan)
+    ball_y = np.full(n_frames, np.nan)
+    ball_z = np.full(n_frames, np.nan)
+    is_detected_ball = np.full(n_frames, None, dtype = object)
+    players_in_frame = np.zeros(n_frames, dtype = np.int64)
+
+    # player level columns, grown by doubling if a frame has more players than expected
+    capacity = max(n_frames * players_per_frame, 1)
+    player_columns = {"x" : np.full(capacity, np.nan),
+                      "y" : np.full(capacity, np.nan),
+                      "player_id" : np.zeros(capacity, dtype = np.int64),
+                      "is_detected" : np.zeros(capacity, dtype = bool)}
+    player_keys = None # order of the player fields as they appear in the file (json_normalize keeps this order)
+
+    n_rows = 0
+    i = 0
+    with open(file_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            record = json.loads(line)
+            players = record.get("player_data") or []
+            possession = record.get("possession") or {}
+            ball = record.get("ball_data") or {}
+
+            frame[i] = record["frame"]
+            timestamp[i] = record.get("timestamp")
+            period[i] = np.nan if record.get("period") is None else record["period"]
+            possession_player_id[i] = np.nan if possession.get("player_id") is None else possession["player_id"]
+            possession_group[i] = possession.get("group")
+            ball_x[i] = np.nan if ball.get("x") is None else ball["x"]
+            ball_y[i] = np.nan if ball.get("y") is None else ball["y"]
+            ball_z[i] = np.nan if ball.get("z") is None else ball["z"]
+            is_detected_ball[i] = ball.get("is_detected")
+
+            n = len(players)
+            players_in_frame[i] = n
+            if n > 0:
+                if player_keys is None:
+                    player_keys = [key for key in players[0] if key in player_columns]
+                while n_rows + n > capacity:
+                    capacity = 2 * capacity
+                    for key, column in player_columns.items():
+                        player_columns[key] = np.resize(column, capacity)
+
+                for key, column in player_columns.items():
+                    column[n_rows : n_rows + n] = [player.get(key) for player in players]
+                n_rows += n
+
+            i += 1
+
+    # frames without players do not produce any rows (same as json_normalize with record_path)
+    keep = np.repeat(np.arange(n_frames), players_in_frame)
+
+    raw_df = pd.DataFrame({key : player_columns[key][:n_rows] for key in (player_keys or list(player_columns))})
+    raw_df["frame"] = frame[keep]
+    # read_json parses the match clock (hh:mm:ss.xx) in the timestamp column as a time on today's date
+    raw_df["timestamp"] = (pd.Timestamp.today().normalize() + pd.to_timedelta(timestamp))[keep]
+    # read_json only gives a float period when the file has a missing period
+    raw_df["period"] = period[keep] if np.isnan(period).any() else period[keep].astype(np.int64)
+    raw_df["possession_player_id"] = possession_player_id[keep]
+    if not np.isnan(raw_df["possession_player_id"]).any():
+        raw_df["possession_player_id"] = raw_df["possession_player_id"].astype(np.int64)
+    raw_df["possession_group"] = possession_group[keep]
+    raw_df["ball_x"] = ball_x[keep]
+    raw_df["ball_y"] = ball_y[keep]
+    raw_df["ball_z"] = ball_z[keep]
+    raw_df["is_detected_ball"] = pd.Series(is_detected_ball[keep]).infer_objects()
+
+    # change data types for merging purposes (player_id becomes a categorical with string categories in applyDataSchema)
+    raw_df["match_id"] = str(match_id) # Add the match_id identifier to your dataframe
+
+    return applyDataSchema(df = raw_df, schema = tracking_schema, stage = f"tracking {match_id}")
 
 # 9
-def create_LeftToRightPoss(df) -> pd.DataFrame:
-    # TODO asserts
-    '''Takes in SkillCorner tracking data and then creates coordinates that represent all possession as left to right'''
+def directionSignTable(teams) -> tuple[np.ndarray, np.ndarray, np.ndarray, list]:
+    """
+        Builds the direction normalization tables from player meta data with one row per match & team
+        (team_name, home_team.name, direction_player_1st_half, direction_player_2nd_half).
+        For team t, period p (0 = 1st half, 1 = 2nd half) and possession group g (0 = away team, 1 = home team) it returns
+          sign[t, p, g]:      int8 flip sign, -1 when the team in possession attacks right to left (flip x & y), 1 otherwise
+          flag[t, g]:         0 when team t is in possession (IP), 1 when it is out of possession (OOP)
+          direction[t, p]:    code of the direction team t plays towards in period p
+          direction_categories: the directions the codes refer to
+    """
 
-    poss_trck_df = df[~df["possession_group"].isnull()].reset_index(drop = True)
+    is_home = (teams["team_name"].astype(object) == teams["home_team.name"].astype(object)).to_numpy()
+    direction = np.stack([teams["direction_player_1st_half"].astype(object).to_numpy(),
+                          teams["direction_player_2nd_half"].astype(object).to_numpy()], axis = 1)
 
-    # Create some flags in case we need them later
-    poss_trck_df["possession_team_name"] = np.where(
-        poss_trck_df["possession_group"] == "home team",
-        poss_trck_df["home_team.name"],
-        poss_trck_df["away_team.name"],
-    )
+    # team t is in possession when it is the home team and the home team has the ball (or away & away)
+    in_possession = (is_home[:, None] == np.array([False, True])[None, :]) # [team, group]
+    flag = np.where(in_possession, 0, 1).astype(np.int8)
 
-    # Create a possesion flag so we can filter for visualizations
-    poss_trck_df["possession_flag"] = np.where(
-        poss_trck_df["possession_team_name"] == poss_trck_df["team_name"], 
-        "IP", # In Possession
-        "OOP" # Out of Possession
-    )
+    # the team in possession plays our direction when we have the ball, otherwise the opposite one
+    team_rtl = (direction == "right_to_left") # [team, period]
+    possession_rtl = np.where(in_possession[:, None, :], team_rtl[:, :, None], ~team_rtl[:, :, None]) # [team, period, group]
+    sign = np.where(possession_rtl, -1, 1).astype(np.int8)
 
-    # Conditions
-    # Team In Possession, Players Moving Right to Left --> Flip Their Coordinates
-    # Team In Possession, Opponents Moving Left to Right --> Flip Opponents Coordinates
-    # Team Out of Possession, Players Moving Left to Right --> Flip Their Coordinates
-    # Team Out of Possession, Opponents Moving Right to Left --> Flip Their Coordinates
-    # Conditions 1 and 2 would cover 3 and 4 as they are basically the same thing
-
-    # We basically want to convert the X and Y to make sure we're always visualizing left to right. A player's XY will depend on the half so the straight average doesn't work
-    poss_trck_df["direction_player"] = np.where(
-        poss_trck_df["period"] == 1,
-        poss_trck_df["direction_player_1st_half"],
-        poss_trck_df["direction_player_2nd_half"],
-    )
-    # When going right to left, we flip the coordinates (We want our analysis to go from left to right)
-    poss_trck_df["adj_x"] = np.where(
-        (poss_trck_df["direction_player"] == "right_to_left") & (poss_trck_df["possession_flag"] == "IP"),
-        -poss_trck_df["x"], # when going right to left, flip coordinates
-        poss_trck_df["x"],
-    )  # Convert X
-
-    poss_trck_df["adj_y"] = np.where(
-        (poss_trck_df["direction_player"] == "right_to_left") & (poss_trck_df["possession_flag"] == "IP"),
-        -poss_trck_df["y"], # when going right to left, flip coordinates
-        poss_trck_df["y"],
-    )  # Convert Y
-
-    # When going right to left for possession team, we flip the coordinates (We want our analysis to go from left to right)
-    poss_trck_df["ball_adj_x"] = np.where(
-        (poss_trck_df["direction_player"] == "right_to_left") & (poss_trck_df["possession_flag"] == "IP"),
-        -poss_trck_df["ball_x"], # when going right to left, flip coordinates
-        poss_trck_df["ball_x"],
-    )  # Convert X
-
-    poss_trck_df["ball_adj_y"] = np.where(
-        (poss_trck_df["direction_player"] == "right_to_left") & (poss_trck_df["possession_flag"] == "IP"),
-        -poss_trck_df["ball_y"], # when going right to left, flip coordinates
-        poss_trck_df["ball_y"],
-    )  # Convert Y
-
-    # When going right to left, we flip the coordinates (We want our analysis to go from left to right)
-    poss_trck_df["adj_x"] = np.where(
-        (poss_trck_df["direction_player"] == "left_to_right") & (poss_trck_df["possession_flag"] == "OOP"),
-        -poss_trck_df["x"], # when going right to left, flip coordinates
-        poss_trck_df["x"],
-    )  # Convert X
-
-    poss_trck_df["adj_y"] = np.where(
-        (poss_trck_df["direction_player"] == "left_to_right") & (poss_trck_df["possession_flag"] == "OOP"),
-        -poss_trck_df["y"], # when going right to left, flip coordinates
-        poss_trck_df["y"],
-    )  # Convert Y
+    # directions as categorical codes so we never build a string per tracking row
+    direction_categories = pd.Index(pd.unique(direction.ravel())).dropna().sort_values()
+    direction_codes = direction_categories.get_indexer(direction.ravel()).reshape(direction.shape)
 
-    
-    # Convert possession player ID to string
-    poss_trck_df["possession_player_id"] = poss_trck_df["possession_player_id"].fillna(-1)
-    poss_trck_df["possession_player_id"] = poss_trck_df["possession_player_id"].astype("int").astype("str")
-    poss_trck_df["possession_player_id"] = np.where(poss_trck_df["possession_player_id"] == -1,
-                                                    "None",
-                                                    poss_trck_df["possession_player_id"])
-    
-    return poss_trck_df[["adj_x", "adj_y", "ball_adj_x", "ball_adj_y"] + df.columns.tolist() + ["possession_flag", "direction_player"]] # rearrange columns and then return
+    return sign, flag, direction_codes, direction_categories.tolist()
+
+# 9a
+def create_LeftToRightPoss(df, inplace = False) -> pd.DataFrame:
+    # TODO asserts
+    '''
+        Takes in SkillCorner tracking data and then creates coordinates that represent all possession as left to right.
+        One int8 flip sign is computed per (match, team, period, possession group) from the meta data (see directionSignTable)
+        and broadcast to the players and the ball of every tracking row, so x, y, ball_x and ball_y are flipped together.
+        inplace = True adds the columns to df itself (rows without a team in possession are dropped from df)
+    '''
+
+    if inplace:
+        df.drop(index = df.index[df["possession_group"].isnull()], inplace = True)
+        df.reset_index(drop = True, inplace = True)
+        poss_trck_df = df
+    else:
+        poss_trck_df = df[~df["possession_group"].isnull()].reset_index(drop = True)
+
+    # row -> (match, team) number, and the meta data of each team from its first row
+    team_row = poss_trck_df.groupby(["match_id", "team_id"], observed = True, sort = False).ngroup().to_numpy()
+    first_rows = np.unique(team_row, return_index = True)[1]
+    sign, flag, direction, direction_categories = directionSignTable(teams = poss_trck_df.iloc[first_rows])
+
+    period = (poss_trck_df["period"].to_numpy() != 1).astype(np.int8) # same rule as before: anything but period 1 uses the 2nd half side
+    group = (poss_trck_df["possession_group"] == "home team").to_numpy().astype(np.int8)
+
+    # broadcast the flip sign once to the players and the ball
+    row_sign = sign[team_row, period, group]
+    adj = {"adj_x" : "x", "adj_y" : "y", "ball_adj_x" : "ball_x", "ball_adj_y" : "ball_y"}
+    for position, (adj_col, col) in enumerate(adj.items()):
+        values = poss_trck_df[col].to_numpy() * row_sign.astype(poss_trck_df[col].dtype)
+        if adj_col in poss_trck_df.columns:
+            poss_trck_df[adj_col] = values
+        else:
+            poss_trck_df.insert(position, adj_col, values)
+
+    # Create a possesion flag so we can filter for visualizations & the side the player plays towards
+    poss_trck_df["possession_flag"] = pd.Categorical.from_codes(flag[team_row, group], categories = ["IP", "OOP"])
+    poss_trck_df["direction_player"] = pd.Categorical.from_codes(direction[team_row, period], categories = direction_categories)
+
+    # Possession player ID as an "id" categorical, "-1" when nobody has the ball (no string per row, see tracking_schema)
+    ids = poss_trck_df["possession_player_id"]
+    if not isinstance(ids.dtype, pd.CategoricalDtype):
+        ids = ids.fillna(-1).astype("int64").astype("category") # string categories are set by applyDataSchema
+    elif ids.isna().any():
+        ids = ids.cat.add_categories("-1").fillna("-1")
+    poss_trck_df["possession_player_id"] = ids
+
+    if not inplace:
+        poss_trck_df = poss_trck_df[list(adj) + [col for col in df.columns if col not in adj] + ["possession_flag", "direction_player"]] # rearrange columns
+
+    return applyDataSchema(df = poss_trck_df, schema = tracking_schema, stage = "normalized tracking")
+
+# 9b
+def normalizeTrackingChunks(chunks, inplace = True):
+    """
+        Runs create_LeftToRightPoss chunk by chunk over an iterator of tracking data frames (e.g. one match or a range of frames at a time,
+        see readTrackingChunks) and yields the normalized chunks, typed with tracking_schema. The flip signs only depend on the meta data
+        columns of each row so chunks can be normalized independently, and the full un-normalized data is never in memory.
+        Concatenate the chunks with concatFrames (it keeps the categorical columns)
+    """
+
+    for chunk in chunks:
+        match_ids = chunk["match_id"].unique()
+        with StageProfile("normalize", match_id = match_ids[0] if len(match_ids) == 1 else None, rows_in = len(chunk)) as stage:
+            chunk = stage.output(create_LeftToRightPoss(df = chunk, inplace = inplace))
+        yield chunk
 
 # ***
 # Model Data Mergers
 
-def mergeTrack_and_PP(event_df, track_df, include_pass = True, track_type = "SkillCorner"):
-    
+def mergeTrack_and_PP(event_df, track_df, include_pass = True, track_type = "SkillCorner", join_type = "interval"):
+    """
+        Attaches the ball coordinates of every tracking frame inside a player possession (frame_start to frame_end or frame_end_v2).
+        track_df is the tracking data or the directory of a tracking tensor store (see src.storage_helpers.writeTrackingTensors)
+        join_type = "interval" uses a sorted frame index and binary search so only matched rows are ever created,
+        join_type = "cross" is the original match level cross join followed by a frame filter (kept for comparison)
+    """
+    assert join_type in ["interval", "cross"], "join_type must be either 'interval' or 'cross'"
+
     frame_end = "frame_end_v2" if include_pass else "frame_end"
-    
+
+    if isinstance(track_df, str):
+        # a tensor store (see src.storage_helpers.writeTrackingTensors): only the ball slot of the matches in event_df is read
+        from src.storage_helpers import tensorBallFrames
+        track_df = tensorBallFrames(store_dir = track_df, match_ids = event_df["match_id"].astype("str").unique())
+
     track_df = track_df[["match_id", "frame", "ball_x", "ball_y"]].copy()
     track_df = track_df.drop_duplicates()
 
-    event_df = event_df[["individual_poss_id", "match_id", "match_team_possession_id",
+    event_df = event_df[["poss_key", "match_id", "team_poss_key",
                          "player_id", "player_name", 
                          "index", "frame_start", "frame_end", "frame_end_v2"]].copy()
     
@@ -389,43 +653,277 @@ def mergeTrack_and_PP(event_df, track_df, include_pass = True, track_type = "Ski
     event_df["match_id"] = event_df["match_id"].astype("str")
     track_df["match_id"] = track_df["match_id"].astype("str")
 
-    out_df = pd.merge(left = event_df, right = track_df, on = ["match_id"], suffixes=["_ev", "tr"])
-    out_df = out_df.loc[(out_df["frame_start"] <= out_df["frame"]) & (out_df["frame"] <= out_df[frame_end]), :]
+    if join_type == "interval":
+        # only emit the frames that fall inside each possession window (see intervalJoinFrames)
+        out_df = intervalJoinFrames(event_df = event_df, track_df = track_df, frame_end = frame_end)
+    else:
+        # original behaviour: every event is paired with every frame of the match and then filtered
+        out_df = pd.merge(left = event_df, right = track_df, on = ["match_id"], suffixes=["_ev", "tr"])
+        out_df = out_df.loc[(out_df["frame_start"] <= out_df["frame"]) & (out_df["frame"] <= out_df[frame_end]), :]
 
     if track_type == "SkillCorner":
         out_df["ball_time_in_poss_tempo"] = skillcorner_frame_precision * out_df["num_frames"]
 
     return out_df
 
+# 1a
+def createFrameIndex(track_df, columns = ["ball_x", "ball_y"]) -> tuple[pd.DataFrame, dict]:
+    """
+        Takes in tracking data and returns one row per (match_id, frame) sorted by match and frame together with
+        a dictionary of match_id -> (first row, last row + 1) so the frames of a match can be sliced without a filter
+    """
+
+    assert "match_id" in track_df.columns and "frame" in track_df.columns, "track_df must have match_id and frame columns"
+
+    frame_df = track_df[["match_id", "frame"] + columns].drop_duplicates()
+    frame_df["match_id"] = frame_df["match_id"].astype("str")
+    frame_df = frame_df.sort_values(["match_id", "frame"], kind = "stable").reset_index(drop = True)
+
+    # frames of one match are contiguous after sorting, so the bounds are where the match_id changes
+    match_values = frame_df["match_id"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, match_values[1:] != match_values[:-1]]) if len(match_values) else np.array([], dtype = int)
+    stops = np.r_[starts[1:], len(match_values)]
+    match_bounds = {match_values[start] : (start, stop) for start, stop in zip(starts, stops)}
+
+    return frame_df, match_bounds
+
+# 1b
+def frameWindowBounds(event_df, frame_df, match_bounds, frame_end = "frame_end_v2") -> tuple[np.ndarray, np.ndarray]:
+    """
+        For every event returns the positions [lo, hi) in frame_df (see createFrameIndex) of the frames that satisfy
+        frame_start <= frame <= frame_end. Events with no frames get lo == hi
+    """
+
+    lo = np.zeros(len(event_df), dtype = np.int64)
+    hi = np.zeros(len(event_df), dtype = np.int64)
+
+    frames = frame_df["frame"].to_numpy()
+    event_match = event_df["match_id"].astype("str").to_numpy()
+
+    # binary search the sorted frames of each match (one vectorized searchsorted per match)
+    for match_id in pd.unique(event_match):
+        if match_id not in match_bounds:
+            continue # no tracking data for this match so every window stays empty
+
+        start, stop = match_bounds[match_id]
+        rows = np.flatnonzero(event_match == match_id)
+        match_frames = frames[start:stop]
+
+        lo[rows] = start + np.searchsorted(match_frames, event_df["frame_start"].to_numpy()[rows], side = "left")
+        hi[rows] = start + np.searchsorted(match_frames, event_df[frame_end].to_numpy()[rows], side = "right")
+
+    hi = np.maximum(hi, lo) # windows that end before they start are empty
+
+    return lo, hi
+
+# 1c
+def intervalJoinFrames(event_df, track_df, frame_end = "frame_end_v2") -> pd.DataFrame:
+    """
+        Interval join of possession windows with tracking frames. Gives the same rows as merging on match_id and
+        filtering on frame_start <= frame <= frame_end, but memory and time grow with the number of matched rows
+    """
+
+    frame_df, match_bounds = createFrameIndex(track_df = track_df,
+                                              columns = [col for col in track_df.columns if col not in ["match_id", "frame"]])
+    lo, hi = frameWindowBounds(event_df = event_df, frame_df = frame_df, match_bounds = match_bounds, frame_end = frame_end)
+
+    # expand every event into its frames: event row i is repeated (hi - lo) times and paired with rows lo ... hi - 1
+    counts = hi - lo
+    event_rows = np.repeat(np.arange(len(event_df)), counts)
+    frame_rows = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    out_df = event_df.iloc[event_rows].reset_index(drop = True)
+    track_cols = frame_df.drop(columns = ["match_id"]).iloc[frame_rows].reset_index(drop = True)
+    out_df[track_cols.columns] = track_cols
+
+    return out_df
+
 # 2
 def distance_BallCoveredInPossession(df) :
   # TODO add assert statements
   
-  cols = ["individual_poss_id", "player_id", "match_id"]
+  # poss_key identifies the player possession (player_id & match_id come along with it)
+  cols = ["poss_key", "player_id", "match_id"]
 
   # ensure rows are in temporal order
-  df = df.sort_values(cols + ["frame"])
+  df = df[cols + ["frame", "ball_x", "ball_y"]].sort_values(["poss_key", "frame"], kind = "stable")
+  keys = df["poss_key"].to_numpy()
 
-  # compute per-axis differences within each group
-  df["dx"] = df.groupby(cols)["ball_x"].diff()
-  df["dy"] = df.groupby(cols)["ball_y"].diff()
+  # compute per-axis differences within each possession (the first frame of a possession has no movement)
+  new_poss = np.r_[True, keys[1:] != keys[:-1]]
+  dx = np.diff(df["ball_x"].to_numpy(dtype = np.float64), prepend = np.nan)
+  dy = np.diff(df["ball_y"].to_numpy(dtype = np.float64), prepend = np.nan)
 
   # distance moved between frames
-  df["ball_dist_step"] = np.sqrt(df["dx"]**2 + df["dy"]**2)
+  ball_dist_step = np.sqrt(dx**2 + dy**2)
+  ball_dist_step[new_poss] = 0
+  ball_dist_step = np.nan_to_num(ball_dist_step, nan = 0.0)
+
+  # total distance per possession
+  total_dist = df.loc[new_poss, cols].reset_index(drop = True)
+  total_dist["ball_total_distance_tempo"] = np.add.reduceat(ball_dist_step, np.flatnonzero(new_poss)) if len(keys) else []
 
-  # first frame in each group has no movement → set to 0
-  df["ball_dist_step"] = df["ball_dist_step"].fillna(0)
+  return total_dist
 
-  # cumulative distance within possession / sequence
-  df["ball_dist_cum"] = df.groupby(cols)["ball_dist_step"].cumsum()
+# 3
+def createBallPathIndex(track_df) -> tuple[pd.DataFrame, dict]:
+    """
+        Builds a per-match cumulative ball path from the ball_x/ball_y columns of the tracking data.
+        ball_dist_cum[i] is the distance the ball travelled from the first frame of the match up to frame i, so the
+        distance over any frame window is the difference of two entries (see ballDistanceFromIndex)
+    """
 
-  # total distance per (unique_id, player_id, match_id)
-  total_dist = (
-      df.groupby(cols)["ball_dist_step"]
-        .sum()
-        .reset_index(name="ball_total_distance_tempo")
-  )
+    frame_df, match_bounds = createFrameIndex(track_df = track_df, columns = ["ball_x", "ball_y"])
 
-  return total_dist
+    # step between consecutive frames of the same match (missing ball coordinates count as no movement)
+    step = np.sqrt(np.diff(frame_df["ball_x"].to_numpy(dtype = np.float64), prepend = np.nan)**2 +
+                   np.diff(frame_df["ball_y"].to_numpy(dtype = np.float64), prepend = np.nan)**2)
+    step[[start for start, _ in match_bounds.values()]] = 0 # first frame of each match has no movement
+    step = np.nan_to_num(step, nan = 0.0)
+
+    # a single cumulative sum is enough because window differences never cross a match boundary
+    frame_df["ball_dist_cum"] = np.cumsum(step)
+
+    return frame_df, match_bounds
+
+# 4
+def ballDistanceFromIndex(event_df, ball_index, include_pass = True, track_type = "SkillCorner") -> pd.DataFrame:
+    """
+        Computes ball_total_distance_tempo and ball_time_in_poss_tempo for each player possession straight from the
+        ball path index (see createBallPathIndex) with a vectorized lookup, so no event x frame table is created.
+        Returns the same rows as distance_BallCoveredInPossession (only possessions that have tracking frames)
+    """
+
+    frame_end = "frame_end_v2" if include_pass else "frame_end"
+    frame_df, match_bounds = ball_index
+
+    out_df = event_df[["poss_key", "player_id", "match_id", "frame_start", frame_end]].copy()
+    out_df["match_id"] = out_df["match_id"].astype("str")
+
+    lo, hi = frameWindowBounds(event_df = out_df, frame_df = frame_df, match_bounds = match_bounds, frame_end = frame_end)
+    has_frames = hi > lo
+
+    # distance between the first and the last frame in the window
+    ball_dist_cum = frame_df["ball_dist_cum"].to_numpy()
+    out_df["ball_total_distance_tempo"] = 0.0
+    out_df.loc[has_frames, "ball_total_distance_tempo"] = ball_dist_cum[hi[has_frames] - 1] - ball_dist_cum[lo[has_frames]]
+
+    if track_type == "SkillCorner":
+        out_df["ball_time_in_poss_tempo"] = skillcorner_frame_precision * (out_df[frame_end] - out_df["frame_start"])
+
+    out_df = out_df.loc[has_frames, :].drop(columns = ["frame_start", frame_end])
+
+    return out_df.sort_values("poss_key").reset_index(drop = True)
+
+# ***
+# Data Types
+
+# 1
+def applyDataSchema(df : pd.DataFrame, schema : dict, stage : str = None, report_memory : bool = None) -> pd.DataFrame:
+    """
+        Casts the columns of df that appear in schema (see src.universal_global_variables) to compact data types.
+        "id" gives a categorical with string categories, integer & bool types are skipped for columns with missing values.
+        Columns are replaced in df and df is returned. Prints the memory before and after when report_memory is True
+        (None: only while stage profiling is on, see src.profiling_helpers.enableProfiling, measuring it is not free)
+    """
+
+    assert isinstance(df, pd.DataFrame), "df must be a pandas DataFrame"
+
+    if report_memory is None:
+        report_memory = profiling_settings["enabled"]
+
+    if report_memory:
+        memory_before = df.memory_usage(deep = True).sum()
+
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+
+        if dtype == "id":
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype("category")
+            categories = df[col].cat.categories
+            if pd.api.types.is_float_dtype(categories):
+                categories = categories.astype("int64") # integer IDs with missing values are floats
+            if not all(isinstance(category, str) for category in categories):
+                df[col] = df[col].cat.rename_categories(categories.astype("str"))
+        elif (dtype.startswith("int") or dtype == "bool") and df[col].isna().any():
+            continue # integers & bools can not hold missing values
+        elif df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+
+    if report_memory:
+        memory_after = df.memory_usage(deep = True).sum()
+        print(f"{stage or 'data'} memory: {memory_before / 1024**2:.1f} MB -> {memory_after / 1024**2:.1f} MB")
+
+    return df
+
+# 2
+def alignCategories(left : pd.DataFrame, right : pd.DataFrame, columns : list[str]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+        Gives categorical columns of two data frames the same categories so merging on them keeps them categorical
+        (pandas falls back to object columns when the categories differ)
+    """
+
+    for col in columns:
+        if isinstance(left[col].dtype, pd.CategoricalDtype) and isinstance(right[col].dtype, pd.CategoricalDtype):
+            categories = left[col].cat.categories.union(right[col].cat.categories)
+            left[col] = left[col].cat.set_categories(categories)
+            right[col] = right[col].cat.set_categories(categories)
+
+    return left, right
+
+# 3
+def concatFrames(frames : list[pd.DataFrame]) -> pd.DataFrame:
+    """pd.concat that keeps categorical columns categorical by using the union of their categories"""
+
+    frames = [frame.copy(deep = False) for frame in frames]
+
+    for col in frames[0].columns:
+        if not all(col in frame.columns and isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames):
+            continue
+
+        categories = frames[0][col].cat.categories
+        for frame in frames[1:]:
+            categories = categories.union(frame[col].cat.categories)
+        for frame in frames:
+            frame[col] = frame[col].cat.set_categories(categories)
+
+    return pd.concat(frames)
+
+# 4
+def sortFrame(df : pd.DataFrame, columns : list[str]) -> pd.DataFrame:
+    """
+        Same rows as df.sort_values(columns) (a stable sort, categoricals in category order, missing values last) but the rows
+        are only copied when they are not already in that order. Returns a new frame either way, so columns can be added to it
+    """
+
+    keys = []
+    for col in columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            codes = df[col].cat.codes.to_numpy()
+            keys.append(np.where(codes < 0, len(df[col].cat.categories), codes))
+        else:
+            keys.append(df[col].to_numpy())
+
+    if keysInOrder(keys = keys):
+        return df.copy(deep = False)
+
+    return df.iloc[np.lexsort(keys[::-1])]
+
+def keysInOrder(keys : list[np.ndarray]) -> bool:
+    """True when the rows are sorted by keys (first key first), checked in one pass instead of a sort. False for keys with missing values"""
+
+    if any(pd.isna(key).any() for key in keys if key.dtype.kind not in "iub"):
+        return False
+
+    decided = np.zeros(max(len(keys[0]) - 1, 0), dtype = bool) if len(keys) > 0 else np.zeros(0, dtype = bool)
+    for key in keys:
+        before, after = key[:-1], key[1:]
+        if (~decided & (before > after)).any():
+            return False
+        decided |= before < after
+
+    return True
 
 # fin.
\ No newline at end of file
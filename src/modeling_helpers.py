@@ -0,0 +1,597 @@
+# Modeling layer: summaries & plots of the fitted bambi / PyMC models
+# Kept out of the data helpers so a data-only import never loads arviz, bambi, PyMC or matplotlib.
+# src.skillcorner_pysport_hackathon_helpers still provides these names, it imports this module on first use
+import os
+import re
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import weakref
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from scipy.optimize import minimize
+
+import pymc as pm
+import arviz as az
+import bambi as bmb # a beautiful package
+from pymc.util import get_default_varnames
+from pymc.backends.arviz import find_observations
+from pymc.blocking import DictToArrayBijection, RaveledVars
+
+default_posterior_dir = os.path.join("data", "posteriors")
+default_checkpoint_dir = os.path.join("data", "chain_checkpoints")
+
+# NUTS statistics kept for every draw of a chain (PyMC name -> name in sample_stats, as pm.sample names them)
+chain_stats = {"diverging" : "diverging", "energy" : "energy", "energy_error" : "energy_error", "max_energy_error" : "max_energy_error",
+               "depth" : "tree_depth", "tree_size" : "n_steps", "mean_tree_accept" : "acceptance_rate", "model_logp" : "lp",
+               "step_size" : "step_size", "step_size_bar" : "step_size_bar", "reached_max_treedepth" : "reached_max_treedepth"}
+
+# 1
+def visualizeEstimatedPlayerImpact(trace, k):
+    posterior = trace.posterior
+    player_var = "alpha_1|player_short_name"
+
+    # shape_results = posterior[player_var]
+    means = posteriorMeans(trace, player_var, hdi_prob = 0.95) # cached, shared with playerRankings(trace)
+    means = means.sort_values()
+
+    bottom5 = means.head(k).index.tolist()
+    top5 = means.tail(k).index.tolist()
+
+    subset_params = bottom5 + top5
+
+    # display(posterior[player_var].coords)
+    fig = az.plot_forest(
+        # idata,
+        trace,
+        var_names=[player_var],
+        coords={"player_short_name__factor_dim": subset_params}, # we got the naming convention by looking at output above!
+        kind="ridgeplot",
+        ridgeplot_alpha=0.5,
+        ridgeplot_overlap=0.78,
+        combined=True,
+        figsize=(10, 10),
+        colors = "salmon",
+        hdi_prob=0.95
+    )
+
+    # Customize our plot
+    ax = plt.gca()
+    ax.set_facecolor("#f5f5f5")
+
+    # Get current y-tick labels
+    yticks = ax.get_yticks()
+    yticklabels = [lbl.get_text() for lbl in ax.get_yticklabels()]
+
+    # Extract text inside brackets
+    clean_labels = []
+    for lbl in yticklabels:
+        match = re.search(r"\[(.*)\]", lbl)
+        clean_labels.append(match.group(1) if match else lbl)
+
+    # Insert "..." between the 5th and 6th label
+    # (Python indexing: between 5th and 6th is at index 5)
+    clean_labels.insert(5, "...")
+
+    # Insert a tick at the same position as the 5th tick to match the labels
+    yticks = list(yticks)
+    yticks.insert(5, (yticks[4] + yticks[5]) / 2)  # place in between
+
+    # Apply new labels
+    ax.set_yticks(yticks)
+    ax.set_yticklabels(clean_labels)
+
+    # Add dashed line at zero
+    ax.axvline(0, color="black", linestyle="--", linewidth=1.5)
+
+    # Add labels
+    # fig.suptitle('Main Plot Title', fontsize=16, fontweight='bold')
+    ax.set_xlabel("Posterior Distribution of Player Random Effect\n w/ 95% Credible Intervals", 
+                fontweight = "bold")
+    ax.set_title('Estimated Player Impact on Ball Speed Tempo "Variance"\n Top 5 and Bottom 5 Players', 
+                fontweight="bold",
+                fontsize=14)
+
+    ax.annotate(
+        "Higher Variance",
+        xy=(0.8, -0.10),  # end of arrow in axis coords
+        xytext=(0.1, -0.10),
+        xycoords="axes fraction",
+        textcoords="axes fraction",
+        arrowprops=dict(arrowstyle="<->", color="salmon", lw=2),
+        ha="center",
+        va="center",
+        fontsize=10,
+        color = "salmon",
+        fontweight = "bold"
+    )
+
+    ax.text(0.97, -0.10, "Lower Variance", 
+            transform=ax.transAxes,
+            color = "salmon",
+            fontweight="bold",
+            ha="right", va="center", fontsize=10)
+
+    plt.show()
+
+# 2 Sort Players by their Random Effect on Tempo Variance
+def playerRankings(trace, hdi = 0.95, diagnostics = True, thin = None):
+    # diagnostics = False skips MCSE, ESS & R-hat (much faster for 1000+ players), thin = k uses every k-th draw (see posteriorSummary)
+    alpha_player_vars = ["alpha_1|player_short_name"] # list in case we want to increase vars
+
+    alpha_player_df = pd.concat([posteriorSummary(trace, var_name, hdi_prob = hdi, kind = "all" if diagnostics else "stats", thin = thin)
+                                 for var_name in alpha_player_vars])
+
+    return roundSummary(alpha_player_df).sort_values("mean")
+
+# 3 view the fixed effects from our model
+def fixedEffects(trace, n_rows = 11):
+    # only summarize the variables of the first n_rows rows
+    summaries = []
+    for var_name in trace.posterior.data_vars:
+        summaries.append(posteriorSummary(trace, var_name))
+        if sum(len(summary) for summary in summaries) >= n_rows:
+            break
+
+    results = roundSummary(pd.concat(summaries))
+    results["exponentiated_mean"] = round((np.exp(results["mean"])), 2)
+    return results.head(n_rows)
+
+# 4 Posterior cache
+def hashModelData(data : pd.DataFrame) -> str:
+    """sha256 of a model data frame: the values (incl. the index), the column names and the dtypes (categorical levels too)"""
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps([[str(col), str(dtype)] for col, dtype in data.dtypes.items()]).encode())
+    for col in data.select_dtypes("category").columns:
+        digest.update(json.dumps([str(col)] + [str(level) for level in data[col].cat.categories]).encode())
+    digest.update(pd.util.hash_pandas_object(data, index = True).to_numpy().tobytes())
+
+    return digest.hexdigest()
+
+def posteriorKey(data : pd.DataFrame, formula, family : str, link, categorical : list[str] = None, priors : dict = None,
+                 **sample_kwargs) -> tuple[str, dict]:
+    """
+        Key of a fit: hash of the data, the formula (main and additional parts, e.g. "alpha ~ (1 | player_short_name)"),
+        family/link, categorical columns, priors, the sampler settings and the bambi/PyMC versions. Returns the key and its contents
+    """
+
+    formula = formula if isinstance(formula, bmb.Formula) else bmb.Formula(formula)
+    content = {"data" : hashModelData(data),
+               "formula" : [" ".join(part.split()) for part in [formula.main, *formula.additionals]], # ignore line breaks & indentation
+               "family" : family if isinstance(family, str) else repr(family),
+               "link" : link if link is None or isinstance(link, (str, dict)) else repr(link),
+               "categorical" : sorted(categorical) if categorical is not None else None,
+               "priors" : {name : repr(prior) for name, prior in priors.items()} if priors is not None else None,
+               "sample_kwargs" : sample_kwargs,
+               "versions" : {"bambi" : bmb.__version__, "pymc" : pm.__version__}}
+
+    key = hashlib.sha256(json.dumps(content, sort_keys = True, default = repr).encode()).hexdigest()[:24]
+    return key, content
+
+def fitCachedModel(formula, data : pd.DataFrame, family : str = "gamma", link = "log", categorical : list[str] = None,
+                   priors : dict = None, posterior_dir : str = default_posterior_dir, refit : bool = False, **sample_kwargs) -> az.InferenceData:
+    """
+        bmb.Model(formula, data, family, link, categorical, priors).fit(**sample_kwargs), saved as <posterior_dir>/<key>.nc (NetCDF)
+        with the key contents in <key>.json. When a fit with the same key is saved the trace is loaded instead and the model is not
+        even built. refit = True samples again and overwrites the saved trace
+    """
+
+    key, content = posteriorKey(data = data, formula = formula, family = family, link = link, categorical = categorical,
+                                priors = priors, **sample_kwargs)
+    path = os.path.join(posterior_dir, f"{key}.nc")
+
+    if os.path.exists(path) and not refit:
+        print(f"***-- Loaded posterior {key} --***")
+        return az.from_netcdf(path)
+
+    model = bmb.Model(formula = formula, data = data, family = family, link = link, categorical = categorical, priors = priors)
+    start = time.perf_counter()
+    idata = model.fit(**sample_kwargs)
+    print(f"***-- Sampled posterior {key} in {time.perf_counter() - start:.0f}s --***")
+
+    savePosterior(idata = idata, posterior_dir = posterior_dir, key = key, content = content)
+    return idata
+
+def savePosterior(idata : az.InferenceData, posterior_dir : str, key : str, content : dict) -> str:
+    """Saves a trace as <posterior_dir>/<key>.nc and the key contents as <key>.json"""
+
+    # write next to the final path first so an interrupted save never leaves half a trace behind
+    path = os.path.join(posterior_dir, f"{key}.nc")
+    os.makedirs(posterior_dir, exist_ok = True)
+    idata.to_netcdf(path + ".tmp", engine = "h5netcdf")
+    os.replace(path + ".tmp", path)
+    with open(os.path.join(posterior_dir, f"{key}.json"), "w") as f:
+        json.dump({"created" : time.strftime("%Y-%m-%d %H:%M:%S"), **content}, f, indent = 2, default = repr)
+
+    return path
+
+def clearPosteriorCache(posterior_dir : str = default_posterior_dir) -> None:
+    """Deletes every saved posterior"""
+
+    shutil.rmtree(posterior_dir, ignore_errors = True)
+
+# 5 Parallel chains with checkpoints
+def pinToCore(core : int) -> None:
+    # Runs in the chain worker: keep the process (and its BLAS threads) on one core so the chains do not compete (Linux only)
+    if not hasattr(os, "sched_setaffinity"):
+        print("*** core pinning is not supported on this platform, chains run unpinned ***")
+        return
+
+    os.sched_setaffinity(0, {core})
+
+def sampledVars(model : bmb.Model) -> list:
+    # the variables bambi keeps in a trace: every free & deterministic variable except the likelihood parameters (one per observation).
+    # These are the value variables (functions of the point NUTS samples), as in pm.sample, not the random variables themselves
+    pm_model = model.backend.model
+
+    return [var for var in get_default_varnames(pm_model.unobserved_value_vars, include_transformed = False)
+            if not (var.name in model.family.likelihood.params and pm_model[var.name] in pm_model.deterministics)]
+
+def _saveCheckpoint(state : dict, path : str) -> None:
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+def _loadCheckpoint(path : str) -> dict | None:
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+def _chunkPath(path : str, chunk : int) -> str:
+    # draws of one checkpoint interval of the chain checkpointed at path
+    return f"{os.path.splitext(path)[0]}_draws_{chunk:05d}.pkl"
+
+def _loadDraws(state : dict, path : str) -> tuple[dict, dict]:
+    # all draws & sample stats of a chain checkpoint, from its chunk files
+    chunks = [_loadCheckpoint(path = _chunkPath(path = path, chunk = chunk)) for chunk in range(state["chunks"])]
+    draws = {name : [draw for chunk in chunks for draw in chunk["draws"][name]] for name in state["var_names"]}
+    stats = {name : [stat for chunk in chunks for stat in chunk["stats"][name]] for name in chain_stats}
+
+    return draws, stats
+
+def runChain(job : dict) -> str:
+    """
+        Worker: samples one NUTS chain of the bambi model in job on core job["core"]. Every checkpoint_every iterations the
+        draws since the last checkpoint are saved to a chunk file of their own (see _chunkPath), then the current point and the
+        sampler state (step size & mass matrix adaptation, random generator) to job["checkpoint"], so a checkpoint costs the same
+        however long the chain is. A checkpoint that is already there is resumed. Returns the checkpoint path of the complete chain
+    """
+
+    pinToCore(core = job["core"])
+
+    model = bmb.Model(**job["model_kwargs"])
+    model.build()
+    pm_model = model.backend.model
+    sampled_vars = sampledVars(model = model)
+    var_names = [var.name for var in sampled_vars]
+    values = pm_model.compile_fn(outs = sampled_vars, inputs = pm_model.value_vars, on_unused_input = "ignore")
+
+    tune, draws = job["tune"], job["draws"]
+    initial_points, step = pm.init_nuts(init = job["init"], chains = 1, model = pm_model, random_seed = job["seed"],
+                                        target_accept = job["target_accept"], progressbar = False)
+
+    state = _loadCheckpoint(path = job["checkpoint"])
+    if state is None:
+        step.set_rng(np.random.default_rng(job["seed"]))
+        step.tune = tune > 0
+        step.reset_tuning()
+        step.iter_count = 0
+        state = {"var_names" : var_names, "point" : initial_points[0], "iteration" : 0, "complete" : False, "chunks" : 0}
+    else:
+        step.sampling_state = state["step"]
+        print(f"***-- Chain {job['chain']}: resuming at iteration {state['iteration']} of {tune + draws} --***")
+
+    # the same loop as pm.sample runs for one chain, with the draws kept in memory until the next checkpoint
+    point = state["point"]
+    chunk = {"draws" : {name : [] for name in var_names}, "stats" : {name : [] for name in chain_stats}}
+    for i in range(state["iteration"], tune + draws):
+        if i == tune:
+            step.stop_tuning()
+
+        point, stats = step.step(point)
+        if i >= tune:
+            for name, value in zip(var_names, values(point)):
+                chunk["draws"][name].append(np.array(value)) # copy, the compiled function may reuse its output buffers
+            for name in chain_stats:
+                chunk["stats"][name].append(stats[0][name])
+
+        if (i + 1) % job["checkpoint_every"] == 0 or i + 1 == tune + draws:
+            # the chunk first: a crash in between leaves a chunk the checkpoint does not count, which the resumed run overwrites
+            if len(chunk["stats"]["energy"]) > 0:
+                _saveCheckpoint(state = chunk, path = _chunkPath(path = job["checkpoint"], chunk = state["chunks"]))
+                state["chunks"] += 1
+                chunk = {"draws" : {name : [] for name in var_names}, "stats" : {name : [] for name in chain_stats}}
+            state.update(point = point, iteration = i + 1, step = step.sampling_state, complete = i + 1 == tune + draws)
+            _saveCheckpoint(state = state, path = job["checkpoint"])
+
+    return job["checkpoint"]
+
+def mergeChains(model : bmb.Model, checkpoints : list[str], log_likelihood : bool = False) -> az.InferenceData:
+    """Combines complete chain checkpoints into one InferenceData, cleaned up the same way model.fit does (see cleanPosterior)"""
+
+    states = [_loadCheckpoint(path = path) for path in checkpoints]
+    assert all(state is not None and state["complete"] for state in states), "every chain must be complete before merging"
+
+    chains = [_loadDraws(state = state, path = path) for state, path in zip(states, checkpoints)]
+    posterior = {name : np.stack([np.asarray(draws[name]) for draws, _ in chains]) for name in states[0]["var_names"]}
+    sample_stats = {chain_stats[name] : np.stack([np.asarray(stats[name]) for _, stats in chains]) for name in chain_stats}
+
+    return drawsToInferenceData(model = model, posterior = posterior, sample_stats = sample_stats, log_likelihood = log_likelihood)
+
+def drawsToInferenceData(model : bmb.Model, posterior : dict, sample_stats : dict = None, log_likelihood : bool = False) -> az.InferenceData:
+    """
+        InferenceData of the sampledVars draws in posterior (name -> array of chain x draw x shape), with the model coords & dims,
+        cleaned up the same way model.fit does (see cleanPosterior)
+    """
+
+    pm_model = model.backend.model
+
+    # variables in the order of pm.sample: free variables, then deterministics (fixedEffects shows the first rows)
+    posterior = {var.name : posterior[var.name] for var in pm_model.free_RVs + pm_model.deterministics if var.name in posterior}
+    observed_data = find_observations(pm_model)
+
+    idata = az.from_dict(posterior = posterior, sample_stats = sample_stats, observed_data = observed_data,
+                         coords = {name : list(levels) for name, levels in pm_model.coords.items()},
+                         dims = {name : list(dims) for name, dims in pm_model.named_vars_to_dims.items()
+                                 if name in posterior or name in observed_data})
+
+    # the log likelihood needs the raw variables (offsets, uncentered intercept), so compute it before they are cleaned up
+    if log_likelihood:
+        pm.compute_log_likelihood(idata, model = pm_model, progressbar = False)
+
+    return cleanPosterior(model = model, idata = idata)
+
+def cleanPosterior(model : bmb.Model, idata : az.InferenceData) -> az.InferenceData:
+    """
+        What model.fit does to the raw PyMC trace (bambi's PyMCModel._clean_results, which is private so it is redone here
+        with the public model attributes): drops the offsets of the non centered group effects, puts the group effect dims
+        last and moves the intercepts from centered predictors back to the original scale
+    """
+
+    for group in idata.groups():
+        getattr(idata, group).attrs["modeling_interface"] = "bambi"
+        getattr(idata, group).attrs["modeling_interface_version"] = bmb.__version__
+
+    idata.posterior = idata.posterior.drop_vars([var for var in idata.posterior.data_vars if var.endswith("_offset")])
+
+    # chain, draw, the other model dims, then the "__factor_dim" dims of the group effects (each in model order)
+    dims = [dim for dim in model.backend.model.coords if dim in idata.posterior.dims]
+    dims = ["chain", "draw"] + [dim for dim in dims if not dim.endswith("__factor_dim")] + [dim for dim in dims if dim.endswith("__factor_dim")]
+    idata.posterior = idata.posterior.drop_dims([dim for dim in idata.posterior.dims if dim not in dims]).transpose(*dims)
+
+    # bambi samples the intercept of centered predictors: Intercept = centered intercept - mean(X) . coefficients
+    if not model.center_predictors:
+        return idata
+
+    response_coords = model.response_component.term.coords
+    for component in model.components.values():
+        if component.intercept_term is None or len(component.common_terms) == 0:
+            continue
+
+        design = component.design.common
+        X = np.column_stack([np.asarray(design.design_matrix)[:, design.slices[name]] for name in component.common_terms])
+        shape, sample_dims = (idata.posterior.sizes["chain"], idata.posterior.sizes["draw"]), ("chain", "draw")
+        if response_coords:
+            levels = list(response_coords.values())[0]
+            shape, sample_dims = shape + (len(levels),), sample_dims + tuple(response_coords)
+
+        samples = idata.posterior.stack(samples = sample_dims)
+        coefs = np.vstack([np.atleast_2d(samples[term.alias or term.name].values) for term in component.common_terms.values()])
+        name = component.intercept_term.alias or component.intercept_term.name
+        idata.posterior[name] = idata.posterior[name] - np.dot(X.mean(0), coefs).reshape(shape)
+
+    return idata
+
+def fitChainsParallel(formula, data : pd.DataFrame, family : str = "gamma", link = "log", categorical : list[str] = None,
+                      priors : dict = None, chains : int = 4, draws : int = 1000, tune : int = 1000, target_accept : float = 0.9,
+                      init : str = "auto", random_seed : int = None, cores : list[int] = None, checkpoint_every : int = 250,
+                      log_likelihood : bool = False, checkpoint_dir : str = default_checkpoint_dir,
+                      posterior_dir : str = default_posterior_dir) -> az.InferenceData:
+    """
+        NUTS fit of bmb.Model(formula, data, family, link, categorical, priors) with every chain in its own process, pinned to
+        one of cores (default: every core this process may use). Chains write checkpoints to <checkpoint_dir>/<key>/, so after
+        a crash or a killed kernel running this again resumes every chain from its last checkpoint. The merged trace is saved
+        like fitCachedModel does (same posterior_dir, the key also includes the chain settings) and the checkpoints are removed
+    """
+
+    key, content = posteriorKey(data = data, formula = formula, family = family, link = link, categorical = categorical, priors = priors,
+                                sampler = "fitChainsParallel", chains = chains, draws = draws, tune = tune,
+                                target_accept = target_accept, init = init, random_seed = random_seed, log_likelihood = log_likelihood)
+    path = os.path.join(posterior_dir, f"{key}.nc")
+    if os.path.exists(path):
+        print(f"***-- Loaded posterior {key} --***")
+        return az.from_netcdf(path)
+
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+
+    chain_dir = os.path.join(checkpoint_dir, key)
+    os.makedirs(chain_dir, exist_ok = True)
+
+    model_kwargs = {"formula" : formula, "data" : data, "family" : family, "link" : link, "categorical" : categorical, "priors" : priors}
+    seeds = [int(seed.generate_state(1)[0]) for seed in np.random.SeedSequence(random_seed).spawn(chains)]
+    jobs = [{"chain" : chain, "core" : cores[chain % len(cores)], "seed" : seeds[chain], "model_kwargs" : model_kwargs,
+             "draws" : draws, "tune" : tune, "target_accept" : target_accept, "init" : init, "checkpoint_every" : checkpoint_every,
+             "checkpoint" : os.path.join(chain_dir, f"chain_{chain}.pkl")} for chain in range(chains)]
+
+    # chains that finished in an earlier (interrupted) run are not sampled again
+    todo = [job for job in jobs if not (_loadCheckpoint(path = job["checkpoint"]) or {}).get("complete", False)]
+    print(f"***-- Sampling {len(todo)} of {chains} chains on cores {sorted(set(job['core'] for job in todo))} --***")
+
+    start = time.perf_counter()
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers = min(len(todo), len(cores)), mp_context = multiprocessing.get_context("spawn")) as pool:
+            list(pool.map(runChain, todo))
+    print(f"***-- Sampled posterior {key} in {time.perf_counter() - start:.0f}s --***")
+
+    model = bmb.Model(**model_kwargs)
+    model.build()
+    idata = mergeChains(model = model, checkpoints = [job["checkpoint"] for job in jobs], log_likelihood = log_likelihood)
+
+    savePosterior(idata = idata, posterior_dir = posterior_dir, key = key, content = content)
+    shutil.rmtree(chain_dir, ignore_errors = True)
+
+    return idata
+
+# 6 Approximate inference for screening formulas
+# full-rank ADVI is left out: it runs into NaNs on the hierarchical Gamma model whatever the optimizer settings
+approximate_methods = ["advi", "laplace"]
+
+def fitApproximate(formula, data : pd.DataFrame, family : str = "gamma", link = "log", categorical : list[str] = None,
+                   priors : dict = None, method : str = "advi", n : int = 30000, draws : int = 1000, random_seed : int = None,
+                   posterior_dir : str = default_posterior_dir) -> az.InferenceData:
+    """
+        Fast fit of bmb.Model(formula, data, family, link, categorical, priors) to screen formulas before running NUTS:
+        mean-field ADVI ("advi") with at most n optimization steps (stops early once the parameters converge), or a Laplace
+        approximation at the MAP ("laplace", see laplaceDraws). Returns draws of the approximation as a 1 chain trace in the format
+        of model.fit, so playerRankings, fixedEffects & visualizeEstimatedPlayerImpact work on it. Cached like fitCachedModel.
+        The sds are usually too small (see compareToReference), use NUTS for the final numbers
+    """
+
+    assert method in approximate_methods, f"method must be one of {approximate_methods}"
+
+    key, content = posteriorKey(data = data, formula = formula, family = family, link = link, categorical = categorical, priors = priors,
+                                sampler = "fitApproximate", method = method, n = n, draws = draws, random_seed = random_seed)
+    path = os.path.join(posterior_dir, f"{key}.nc")
+    if os.path.exists(path):
+        print(f"***-- Loaded posterior {key} --***")
+        return az.from_netcdf(path)
+
+    model = bmb.Model(formula = formula, data = data, family = family, link = link, categorical = categorical, priors = priors)
+    model.build()
+    pm_model = model.backend.model
+    start = time.perf_counter()
+
+    # draws of the free (value) variables only
+    if method == "laplace":
+        samples = laplaceDraws(pm_model = pm_model, draws = draws, random_seed = random_seed)
+    else:
+        with pm_model:
+            approx = pm.fit(n = n, method = method, random_seed = random_seed, progressbar = False,
+                            callbacks = [pm.callbacks.CheckParametersConvergence(diff = "absolute")])
+        samples = approx.sample_dict_fn(draws, random_seed = random_seed)
+        print(f"***-- {method}: {len(approx.hist)} steps, final loss {np.mean(approx.hist[-100:]):.1f} --***")
+
+    # then the variables bambi keeps (not the per observation mu & alpha)
+    sampled_vars = sampledVars(model = model)
+    values = pm_model.compile_fn(outs = sampled_vars, inputs = pm_model.value_vars, on_unused_input = "ignore")
+    draws_values = [[np.array(value) for value in values({name : sample[i] for name, sample in samples.items()})] for i in range(draws)]
+
+    posterior = {var.name : np.stack([draw[j] for draw in draws_values])[np.newaxis] for j, var in enumerate(sampled_vars)}
+    idata = drawsToInferenceData(model = model, posterior = posterior)
+    print(f"***-- Approximated posterior {key} ({method}) in {time.perf_counter() - start:.0f}s --***")
+
+    savePosterior(idata = idata, posterior_dir = posterior_dir, key = key, content = content)
+    return idata
+
+def laplaceDraws(pm_model : pm.Model, draws : int, random_seed : int = None) -> dict:
+    """
+        Laplace approximation in the unconstrained space: draws of a multivariate normal at the mode of logp (incl. the
+        Jacobian of the transforms, so the group sigmas do not collapse to 0 like with pm.find_MAP) with the inverse Hessian of
+        -logp as covariance. Returns value variable -> draws x shape. (bambi's own "laplace" fails on the tempo model)
+    """
+
+    value_vars = {var.name : var for var in pm_model.value_vars}
+    start = pm_model.initial_point(random_seed = random_seed)
+    x0 = DictToArrayBijection.map({name : start[name] for name in value_vars})
+    rvs = [pm_model.values_to_rvs[value_vars[name]] for name, _, _, _ in x0.point_map_info]
+
+    logp = DictToArrayBijection.mapf(pm_model.compile_logp(jacobian = True), start)
+    dlogp = DictToArrayBijection.mapf(pm_model.compile_dlogp(rvs, jacobian = True), start)
+    result = minimize(lambda x: -logp(RaveledVars(x, x0.point_map_info)), x0.data, method = "L-BFGS-B",
+                      jac = lambda x: -dlogp(RaveledVars(x, x0.point_map_info)))
+    assert result.success, f"finding the mode failed: {result.message}"
+
+    mode = DictToArrayBijection.rmap(RaveledVars(result.x, x0.point_map_info), start)
+    hessian = pm_model.compile_d2logp(rvs, jacobian = True)(mode) # of -logp
+
+    samples = np.random.default_rng(random_seed).multivariate_normal(result.x, np.linalg.inv(hessian), size = draws, method = "cholesky")
+    points = [DictToArrayBijection.rmap(RaveledVars(sample, x0.point_map_info)) for sample in samples]
+
+    return {name : np.stack([point[name] for point in points]) for name, _, _, _ in x0.point_map_info}
+
+def compareToReference(approx_trace : az.InferenceData, reference_trace : az.InferenceData,
+                       var_name : str = "alpha_1|player_short_name", k : int = 5) -> tuple[pd.DataFrame, dict]:
+    """
+        Compares the player random effects of an approximate fit with a reference (NUTS) trace. Returns one row per player with
+        the posterior mean, sd & rank of the mean of both fits and the difference of the means in reference sds, and a summary:
+        Spearman correlation of the means, median sd ratio (approx / reference) and the overlap of the top & bottom k players
+    """
+
+    def summarize(trace):
+        posterior = trace.posterior[var_name]
+        return pd.DataFrame({"mean" : posterior.mean(dim = ("chain", "draw")).to_series(),
+                             "sd" : posterior.std(dim = ("chain", "draw")).to_series()})
+
+    comparison = summarize(approx_trace).join(summarize(reference_trace), lsuffix = "_approx", rsuffix = "_reference", how = "inner")
+    comparison["rank_approx"] = comparison["mean_approx"].rank()
+    comparison["rank_reference"] = comparison["mean_reference"].rank()
+    comparison["mean_diff_in_sd"] = (comparison["mean_approx"] - comparison["mean_reference"]) / comparison["sd_reference"]
+
+    def overlap(ranking):
+        return len(set(comparison["mean_approx"].pipe(ranking, k).index) & set(comparison["mean_reference"].pipe(ranking, k).index)) / k
+
+    summary = {"players" : len(comparison),
+               "spearman" : comparison["mean_approx"].corr(comparison["mean_reference"], method = "spearman"),
+               "median_sd_ratio" : (comparison["sd_approx"] / comparison["sd_reference"]).median(),
+               "max_abs_mean_diff_in_sd" : comparison["mean_diff_in_sd"].abs().max(),
+               f"top_{k}_overlap" : overlap(pd.Series.nlargest),
+               f"bottom_{k}_overlap" : overlap(pd.Series.nsmallest)}
+
+    return comparison.sort_values("mean_reference"), summary
+
+# 7 Posterior summary store
+# az.summary of single variables, computed on first use and kept per trace: {id(trace) : {(var_name, hdi_prob, kind, thin) : summary}}.
+# The entries of a trace are dropped when the trace is garbage collected, so a new trace never gets the summaries of an old one
+summary_store = {}
+
+def posteriorSummary(trace : az.InferenceData, var_name : str, hdi_prob : float = 0.94, kind : str = "all", thin : int = None) -> pd.DataFrame:
+    """
+        Unrounded az.summary of one variable, taken from summary_store after the first call. kind = "stats" (mean, sd & HDI) or
+        "all" (also MCSE, ESS & R-hat, which take most of the time). thin = k summarizes every k-th draw of every chain, for long
+        traces. A "stats" summary is cut from a cached "all" summary when there is one
+    """
+
+    assert kind in ["stats", "all"], "kind must be stats or all"
+
+    summaries = summary_store.get(id(trace))
+    if summaries is None:
+        summaries = summary_store[id(trace)] = {}
+        weakref.finalize(trace, summary_store.pop, id(trace), None)
+
+    key = (var_name, hdi_prob, kind, thin)
+    if key not in summaries:
+        summary_all = summaries.get((var_name, hdi_prob, "all", thin))
+        if kind == "stats" and summary_all is not None:
+            summaries[key] = summary_all[summary_all.columns[:4]]
+        else:
+            posterior = trace.posterior[[var_name]]
+            if thin is not None:
+                posterior = posterior.thin({"draw" : thin})
+            summaries[key] = az.summary(posterior, kind = kind, hdi_prob = hdi_prob, round_to = "none")
+
+    return summaries[key]
+
+def posteriorMeans(trace : az.InferenceData, var_name : str, hdi_prob : float = 0.94, thin : int = None) -> pd.Series:
+    """Posterior means of a variable with one dimension (e.g. the player effects) indexed by its coordinates, from posteriorSummary"""
+
+    posterior = trace.posterior[var_name]
+    dims = [dim for dim in posterior.dims if dim not in ["chain", "draw"]]
+    assert len(dims) == 1, f"{var_name} must have exactly one dimension besides chain & draw"
+
+    summary = posteriorSummary(trace, var_name, hdi_prob = hdi_prob, kind = "stats", thin = thin)
+    return pd.Series(summary["mean"].to_numpy(), index = pd.Index(posterior[dims[0]].values, name = dims[0]), name = var_name)
+
+def roundSummary(summary : pd.DataFrame) -> pd.DataFrame:
+    # the rounding az.summary does by default
+    return summary.round({col : 0 if col in ["ess_bulk", "ess_tail"] else 2 if col == "r_hat" else 3 for col in summary.columns})
+
+# fin.
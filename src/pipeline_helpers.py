@@ -0,0 +1,195 @@
+# Memoized pipeline from the SkillCorner files to the filtered model data
+# The pipeline is a small DAG of named stages. Every artifact is saved in <cache_dir>/<stage>/<key>.pkl and its key is a hash of
+# the keys of its inputs, its parameters, the module level config its helpers read and the source code of those helpers,
+# so only stages downstream of a change run again:
+#
+#   events ----------------------------------------------.
+#   tracking (per match) --.                              +--> merged --> model_df --> filtered
+#   metadata (per match) --+--> normalized tracking -----'
+#
+# e.g. changing min_player_possessions only reruns "filtered", include_pass reruns "merged", "model_df" and "filtered",
+# and nothing reparses the tracking files unless they (or the parser) changed.
+import os
+import json
+import time
+import shutil
+import inspect
+import hashlib
+import pandas as pd
+
+import src.universal_global_variables as global_variables
+from src.data_processing_helpers import *
+from src.universal_helpers import readEvents, attachPlayerMetaData
+from src.cache_helpers import fetchMatchFiles, matchFileHash
+from src.profiling_helpers import StageProfile
+from src.skillcorner_pysport_hackathon_helpers import (measurePossessions, joinModelContext, add_ModelContext, addTeamPhase,
+                                                        filterModelData)
+
+default_pipeline_cache_dir = os.path.join("data", "pipeline_cache")
+
+# 1 Stages
+def _eventsStage(match_ids):
+    event_df = readEvents(match_list = match_ids)
+    pp_data, poss_metrics = process_PPdata(event_df = event_df, partitions = partitionEvents(event_df = event_df))
+    poss_metrics["team_id"] = poss_metrics["team_id"].astype("str")
+    poss_metrics["match_id"] = poss_metrics["match_id"].astype("str")
+    return pp_data, poss_metrics
+
+def _trackingStage(match_id):
+    return parseTrackingData(file_path = fetchMatchFile(match_id = match_id, kind = "tracking"), match_id = match_id)
+
+def _metadataStage(match_id):
+    return playerMetaData(match_id = match_id)
+
+def _normalizedStage(tracking, metadata):
+    # normalize match by match (on copies, the stage inputs are cached artifacts) and concatenate once
+    chunks = (attachPlayerMetaData(tracking_df = track_df, players_df = players_df) for track_df, players_df in zip(tracking, metadata))
+    tracking_df = concatFrames(list(normalizeTrackingChunks(chunks = chunks))).reset_index(drop = True)
+
+    player_metadata = tracking_df[["player_id", "match_id", "team_id", "team_name",
+                                   "player_short_name", "player_role.name"]].drop_duplicates().reset_index(drop = True)
+    return tracking_df, player_metadata
+
+def _mergedStage(events, normalized, include_pass, use_ball_index):
+    return measurePossessions(pp_df = events[0], tracking_df = normalized[0], include_pass = include_pass, use_ball_index = use_ball_index)
+
+def _modelStage(merged, events, normalized):
+    model_df = joinModelContext(model_df = merged, pp_df = events[0], player_metadata = normalized[1])
+    return addTeamPhase(model_df = model_df)
+
+def _filteredStage(model_df, events, min_sequences, min_player_possessions):
+    return filterModelData(model_df = model_df, poss_metrics = events[1], min_sequences = min_sequences,
+                           min_player_possessions = min_player_possessions)
+
+# stage -> inputs (other stages), parameters, the helpers whose source is part of the key and the globals of
+# src.universal_global_variables those helpers read (config, pipeline_version is part of every key)
+# "per_match" stages are saved per match so adding a match only parses the new files
+pipeline_stages = {
+    "events" :     {"inputs" : [], "params" : ["match_ids"], "files" : ["events"], "per_match" : False,
+                    "config" : ["event_read_types", "event_read_columns", "event_read_dtypes", "event_schema", "pp_variables",
+                               "possession_id_schema", "possession_key_bits"],
+                    "run" : _eventsStage, "helpers" : [readEvents, process_PPdata, createPossessionIndex, createPassEndFrame,
+                                                       packPossessionKey, partitionEvents, eventsOfType, aggregateGroups, sortFrame, keysInOrder,
+                                                       applyDataSchema]},
+    "tracking" :   {"inputs" : [], "params" : [], "files" : ["tracking"], "per_match" : True,
+                    "config" : ["tracking_schema"],
+                    "run" : _trackingStage, "helpers" : [parseTrackingData, applyDataSchema]},
+    "metadata" :   {"inputs" : [], "params" : [], "files" : ["match"], "per_match" : True,
+                    "config" : ["tracking_schema"],
+                    "run" : _metadataStage, "helpers" : [playerMetaData, applyDataSchema]},
+    "normalized" : {"inputs" : ["tracking", "metadata"], "params" : [], "files" : [], "per_match" : False,
+                    "config" : ["tracking_schema"],
+                    "run" : _normalizedStage, "helpers" : [attachPlayerMetaData, alignCategories, concatFrames,
+                                                           directionSignTable, create_LeftToRightPoss, normalizeTrackingChunks]},
+    "merged" :     {"inputs" : ["events", "normalized"], "params" : ["include_pass", "use_ball_index"], "files" : [], "per_match" : False,
+                    "config" : ["skillcorner_frame_precision"],
+                    "run" : _mergedStage, "helpers" : [measurePossessions, createBallPathIndex, ballDistanceFromIndex, createFrameIndex,
+                                                       frameWindowBounds, mergeTrack_and_PP, intervalJoinFrames,
+                                                       distance_BallCoveredInPossession]},
+    "model_df" :   {"inputs" : ["merged", "events", "normalized"], "params" : [], "files" : [], "per_match" : False,
+                    "config" : [],
+                    "run" : _modelStage, "helpers" : [joinModelContext, add_ModelContext, addTeamPhase]},
+    "filtered" :   {"inputs" : ["model_df", "events"], "params" : ["min_sequences", "min_player_possessions"], "files" : [], "per_match" : False,
+                    "config" : [],
+                    "run" : _filteredStage, "helpers" : [filterModelData]},
+}
+
+# 2
+def stageKey(stage : str, params : dict, input_keys : list[str], file_hashes : list[str]) -> str:
+    """Hash of a stage's input keys, parameters, input files, config globals (and pipeline_version) and the source code of the stage & its helpers"""
+
+    spec = pipeline_stages[stage]
+    source = [inspect.getsource(spec["run"])] + [inspect.getsource(helper) for helper in spec["helpers"]]
+    config = {name : getattr(global_variables, name) for name in spec["config"] + ["pipeline_version"]}
+
+    content = json.dumps({"stage" : stage,
+                          "params" : {name : params[name] for name in spec["params"]},
+                          "inputs" : input_keys,
+                          "files" : file_hashes,
+                          "config" : hashlib.sha256(json.dumps(config, sort_keys = True, default = str).encode()).hexdigest(),
+                          "source" : hashlib.sha256("".join(source).encode()).hexdigest()}, sort_keys = True, default = str)
+
+    return hashlib.sha256(content.encode()).hexdigest()[:24]
+
+def stageKeys(match_ids : list[int], params : dict) -> dict:
+    """Keys of every stage for these matches & parameters (per match stages get a list of keys). Only hashes files, reads no data"""
+
+    keys = {}
+    for stage, spec in pipeline_stages.items(): # stages are listed in dependency order
+        input_keys = [keys[name] for name in spec["inputs"]]
+        if spec["per_match"]:
+            keys[stage] = [stageKey(stage = stage, params = params, input_keys = input_keys,
+                                    file_hashes = [matchFileHash(match_id = id, kind = kind) for kind in spec["files"]])
+                           for id in match_ids]
+        else:
+            file_hashes = [matchFileHash(match_id = id, kind = kind) for id in match_ids for kind in spec["files"]]
+            keys[stage] = stageKey(stage = stage, params = params, input_keys = input_keys, file_hashes = file_hashes)
+
+    return keys
+
+# 3
+def _artifactPath(cache_dir : str, stage : str, key : str) -> str:
+    return os.path.join(cache_dir, stage, f"{key}.pkl")
+
+def _saveArtifact(artifact, path : str) -> None:
+    # write next to the final path first so an interrupted run never leaves half an artifact behind
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    pd.to_pickle(artifact, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def runPipeline(match_ids : list[int], include_pass : bool = True, use_ball_index : bool = True,
+                min_sequences : int = 3, min_player_possessions : int = 31, target : str = "filtered",
+                cache_dir : str = default_pipeline_cache_dir) -> dict:
+    """
+        Builds the target stage (and whatever it needs) for match_ids, loading every artifact that is already memoized in cache_dir.
+        Inputs of a memoized stage are not even loaded. Returns a dictionary with the target artifact, the stage keys and the
+        stages that were computed in this run. For target = "filtered" the artifact is (model_df_filtered, players_sample)
+    """
+
+    assert target in pipeline_stages, f"target must be one of {list(pipeline_stages)}"
+
+    params = {"match_ids" : list(match_ids), "include_pass" : include_pass, "use_ball_index" : use_ball_index,
+              "min_sequences" : min_sequences, "min_player_possessions" : min_player_possessions}
+
+    fetchMatchFiles(match_ids = match_ids) # hashing needs the files locally
+    keys = stageKeys(match_ids = match_ids, params = params)
+
+    loaded, computed = {}, []
+
+    def loadOrRun(stage, key, arguments):
+        path = _artifactPath(cache_dir = cache_dir, stage = stage, key = key)
+        if os.path.exists(path):
+            print(f"***-- {stage}: loaded {key} --***")
+            return pd.read_pickle(path)
+
+        arguments = arguments() # build (or load) the inputs only now that this stage has to run
+        start = time.perf_counter()
+        with StageProfile(stage, match_id = arguments.get("match_id")):
+            artifact = pipeline_stages[stage]["run"](**arguments)
+        print(f"***-- {stage}: computed {key} in {time.perf_counter() - start:.1f}s --***")
+
+        _saveArtifact(artifact = artifact, path = path)
+        computed.append(stage)
+        return artifact
+
+    def build(stage):
+        if stage not in loaded:
+            spec = pipeline_stages[stage]
+            if spec["per_match"]:
+                loaded[stage] = [loadOrRun(stage, key, lambda id = id: {"match_id" : id}) for id, key in zip(match_ids, keys[stage])]
+            else:
+                loaded[stage] = loadOrRun(stage, keys[stage], lambda: {**{name : build(name) for name in spec["inputs"]},
+                                                                       **{name : params[name] for name in spec["params"]}})
+
+        return loaded[stage]
+
+    return {"artifact" : build(target), "keys" : keys, "computed" : computed}
+
+# 4
+def clearPipelineCache(cache_dir : str = default_pipeline_cache_dir, stages : list[str] = None) -> None:
+    """Deletes the memoized artifacts of some stages (or all of them)"""
+
+    for stage in (pipeline_stages if stages is None else stages):
+        shutil.rmtree(os.path.join(cache_dir, stage), ignore_errors = True)
+
+# fin.
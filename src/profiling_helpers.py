@@ -0,0 +1,217 @@
+# Opt-in profiling of the data pipeline stages
+# The readers and create_SkillCornerModelData wrap their stages in StageProfile. When profiling is off (the default) this
+# does nothing; after enableProfiling() every stage records wall time, CPU time, peak memory and rows in/out (per match
+# where the stage runs per match) and chosen stages can be run under cProfile.
+#
+#   enableProfiling(profile_stages = ["read tracking"])
+#   tracking_df, player_metadata, pp_data, poss_metrics = read_SkillCornerData(match_ids)
+#   profilingReport()                      # one row per stage (and match)
+#   printStageProfile("read tracking")     # cProfile output of that stage
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+import psutil
+import pandas as pd
+
+# current profiling settings (see enableProfiling)
+profiling_settings = {
+    "enabled" : False,
+    "profile_stages" : [], # stages to run under cProfile ("all" for every stage)
+    "profile_dir" : None, # save the cProfile stats of those stages as <stage>_<match_id>.prof
+    "interval" : 0.01, # memory sampling interval in seconds
+}
+
+# records & cProfile stats of the stages that ran since the last resetProfiling
+stage_records = []
+stage_profiles = {}
+
+# 1 Track the peak memory (RSS) of this process while a block of code runs
+class PeakMemorySampler:
+    """
+        Context manager that samples the resident memory of the current process in a background thread.
+        After the block: start_mb, peak_mb and peak_delta_mb (peak above the memory at the start) are available
+    """
+
+    def __init__(self, interval : float = 0.05):
+        self.interval = interval
+        self.process = psutil.Process()
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, self.process.memory_info().rss / 1024**2)
+
+    def __enter__(self):
+        self.start_mb = self.peak_mb = self.process.memory_info().rss / 1024**2
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._sample, daemon = True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_mb = max(self.peak_mb, self.process.memory_info().rss / 1024**2)
+        self.peak_delta_mb = self.peak_mb - self.start_mb
+        return False
+
+# 2
+def enableProfiling(profile_stages : list[str] = None, profile_dir : str = None, interval : float = 0.01, reset : bool = True) -> None:
+    """
+        Turns on stage profiling. profile_stages are also run under cProfile (e.g. ["read tracking", "normalize"] or "all")
+        and their stats are kept for printStageProfile (and saved to profile_dir when given). reset clears earlier records
+    """
+
+    if reset:
+        resetProfiling()
+
+    profiling_settings["enabled"] = True
+    profiling_settings["profile_stages"] = [] if profile_stages is None else (["all"] if profile_stages == "all" else list(profile_stages))
+    profiling_settings["profile_dir"] = profile_dir
+    profiling_settings["interval"] = interval
+
+def disableProfiling() -> None:
+    """Turns stage profiling off (the records are kept until resetProfiling)"""
+
+    profiling_settings["enabled"] = False
+
+def resetProfiling() -> None:
+    """Clears the stage records and cProfile stats"""
+
+    stage_records.clear()
+    stage_profiles.clear()
+
+# 3
+class StageProfile:
+    """
+        Context manager around one pipeline stage. Does nothing unless enableProfiling() was called.
+        rows_in is the size of the input, the output is counted with .output(df) (which returns df):
+
+            with StageProfile("normalize", rows_in = len(tracking_df)) as stage:
+                tracking_df = stage.output(create_LeftToRightPoss(df = tracking_df))
+    """
+
+    def __init__(self, stage : str, match_id = None, rows_in : int = None):
+        self.stage = stage
+        self.match_id = match_id
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.enabled = profiling_settings["enabled"]
+
+    def output(self, df):
+        self.rows_out = len(df)
+        return df
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+
+        self.profiler = None
+        if self.stage in profiling_settings["profile_stages"] or "all" in profiling_settings["profile_stages"]:
+            self.profiler = cProfile.Profile()
+
+        self.memory = PeakMemorySampler(interval = profiling_settings["interval"]).__enter__()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if not self.enabled:
+            return False
+
+        if self.profiler is not None:
+            self.profiler.disable()
+        wall_s = time.perf_counter() - self.wall_start
+        cpu_s = time.process_time() - self.cpu_start
+        self.memory.__exit__()
+
+        record = {"stage" : self.stage,
+                  "match_id" : "all" if self.match_id is None else str(self.match_id),
+                  "wall_s" : wall_s,
+                  "cpu_s" : cpu_s,
+                  "peak_mb" : self.memory.peak_delta_mb,
+                  "rows_in" : self.rows_in,
+                  "rows_out" : self.rows_out,
+                  "failed" : exc_type is not None,
+                  "profile" : None}
+
+        if self.profiler is not None:
+            stage_profiles[(record["stage"], record["match_id"])] = self.profiler
+            record["profile"] = "cProfile"
+            if profiling_settings["profile_dir"] is not None:
+                os.makedirs(profiling_settings["profile_dir"], exist_ok = True)
+                file_name = f"{record['stage'].replace(' ', '_')}_{record['match_id']}.prof"
+                record["profile"] = os.path.join(profiling_settings["profile_dir"], file_name)
+                self.profiler.dump_stats(record["profile"])
+
+        stage_records.append(record)
+        return False
+
+# 4
+def profilingReport(json_path : str = None, by_stage : bool = False) -> pd.DataFrame:
+    """
+        The recorded stages as a data frame (in the order they ran). by_stage sums the matches of every stage.
+        json_path also saves the report as JSON records
+    """
+
+    report = pd.DataFrame(stage_records, columns = ["stage", "match_id", "wall_s", "cpu_s", "peak_mb", "rows_in", "rows_out", "failed", "profile"])
+
+    if by_stage:
+        report = (report.groupby("stage", sort = False)
+                        .agg(matches = ("match_id", "nunique"), wall_s = ("wall_s", "sum"), cpu_s = ("cpu_s", "sum"),
+                             peak_mb = ("peak_mb", "max"),
+                             rows_in = ("rows_in", lambda rows: rows.sum(min_count = 1)), rows_out = ("rows_out", lambda rows: rows.sum(min_count = 1)))
+                        .reset_index())
+
+    report["share_of_wall"] = report["wall_s"] / report["wall_s"].sum()
+
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump(report.to_dict(orient = "records"), f, indent = 2)
+
+    return report
+
+# 5
+def printStageProfile(stage : str, match_id = None, n : int = 20, sort_by : str = "cumulative") -> None:
+    """Prints the n most expensive functions of a stage that ran under cProfile (match_id = None prints every match combined)"""
+
+    profiles = [profile for (name, id), profile in stage_profiles.items()
+                if name == stage and (match_id is None or id == str(match_id))]
+    assert len(profiles) > 0, f"no cProfile stats for stage {stage}, add it to profile_stages in enableProfiling"
+
+    stats = pstats.Stats()
+    stats.add(*profiles)
+    stats.sort_stats(sort_by).print_stats(n)
+
+# 6 Stage records of worker processes
+def collectProfiling() -> dict:
+    """
+        The stage records & cProfile stats of this process in a picklable form, for a worker process to send back with its
+        result (see mergeProfiling)
+    """
+
+    profiles = {}
+    for key, profile in stage_profiles.items():
+        stats = profile if isinstance(profile, pstats.Stats) else pstats.Stats(profile)
+        profiles[key] = stats.stats
+
+    return {"records" : list(stage_records), "profiles" : profiles}
+
+def mergeProfiling(collected : dict) -> None:
+    """Adds the stage records & cProfile stats collected in a worker process (collectProfiling) to the records of this process"""
+
+    stage_records.extend(collected["records"])
+    for key, raw_stats in collected["profiles"].items():
+        stats = pstats.Stats()
+        stats.stats = raw_stats
+        stats.get_top_level_stats()
+        if key in stage_profiles: # e.g. the "all" stages of several workers
+            stats = pstats.Stats().add(stage_profiles[key], stats)
+        stage_profiles[key] = stats
+
+# fin.
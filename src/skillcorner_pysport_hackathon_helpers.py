@@ -1,132 +1,62 @@
 # Put all packages that need to be loaded here. By importing this script we get everythin
+# The data layer is imported right away. The modeling (arviz, bambi -> PyMC) & plotting (matplotlib, mplsoccer) layers are
+# only imported the first time one of their names is used (see lazy_attributes at the bottom), so a batch job that only
+# processes data never pays for them. `from src.skillcorner_pysport_hackathon_helpers import *` gives the data layer only,
+# import the modeling & plotting names explicitly: `from src.skillcorner_pysport_hackathon_helpers import bmb, playerRankings`
 
 # Data Reading, Engineering, & Processing ---
 import pandas as pd
 import numpy as np
-import re
 import json
-import requests
+import os
+import sys
+import hashlib
+import time
+import psutil
+import importlib
+import multiprocessing
 
-# Visualizations --
-import matplotlib.pyplot as plt
-from mplsoccer import Pitch
-
-# Bayesian Modeling Packages ---
-import arviz as az
-import bambi as bmb # a beautiful package
-
-from src.universal_helpers import *
 from src.universal_global_variables import *
-# from src.visualization_helpers import * # we dont need this for the submission
+from src.cache_helpers import *
+from src.profiling_helpers import *
 from src.data_processing_helpers import *
-
-def visualizeEstimatedPlayerImpact(trace, k):
-    posterior = trace.posterior
-    player_var = "alpha_1|player_short_name"
-
-    # shape_results = posterior[player_var]
-    means = posterior[player_var].mean(dim=("chain", "draw")).to_series()
-    means = means.sort_values()
-
-    bottom5 = means.head(k).index.tolist()
-    top5 = means.tail(k).index.tolist()
-
-    subset_params = bottom5 + top5
-
-    # display(posterior[player_var].coords)
-    fig = az.plot_forest(
-        # idata,
-        trace,
-        var_names=[player_var],
-        coords={"player_short_name__factor_dim": subset_params}, # we got the naming convention by looking at output above!
-        kind="ridgeplot",
-        ridgeplot_alpha=0.5,
-        ridgeplot_overlap=0.78,
-        combined=True,
-        figsize=(10, 10),
-        colors = "salmon",
-        hdi_prob=0.95
-    )
-
-    # Customize our plot
-    ax = plt.gca()
-    ax.set_facecolor("#f5f5f5")
-
-    # Get current y-tick labels
-    yticks = ax.get_yticks()
-    yticklabels = [lbl.get_text() for lbl in ax.get_yticklabels()]
-
-    # Extract text inside brackets
-    clean_labels = []
-    for lbl in yticklabels:
-        match = re.search(r"\[(.*)\]", lbl)
-        clean_labels.append(match.group(1) if match else lbl)
-
-    # Insert "..." between the 5th and 6th label
-    # (Python indexing: between 5th and 6th is at index 5)
-    clean_labels.insert(5, "...")
-
-    # Insert a tick at the same position as the 5th tick to match the labels
-    yticks = list(yticks)
-    yticks.insert(5, (yticks[4] + yticks[5]) / 2)  # place in between
-
-    # Apply new labels
-    ax.set_yticks(yticks)
-    ax.set_yticklabels(clean_labels)
-
-    # Add dashed line at zero
-    ax.axvline(0, color="black", linestyle="--", linewidth=1.5)
-
-    # Add labels
-    # fig.suptitle('Main Plot Title', fontsize=16, fontweight='bold')
-    ax.set_xlabel("Posterior Distribution of Player Random Effect\n w/ 95% Credible Intervals", 
-                fontweight = "bold")
-    ax.set_title('Estimated Player Impact on Ball Speed Tempo "Variance"\n Top 5 and Bottom 5 Players', 
-                fontweight="bold",
-                fontsize=14)
-
-    ax.annotate(
-        "Higher Variance",
-        xy=(0.8, -0.10),  # end of arrow in axis coords
-        xytext=(0.1, -0.10),
-        xycoords="axes fraction",
-        textcoords="axes fraction",
-        arrowprops=dict(arrowstyle="<->", color="salmon", lw=2),
-        ha="center",
-        va="center",
-        fontsize=10,
-        color = "salmon",
-        fontweight = "bold"
-    )
-
-    ax.text(0.97, -0.10, "Lower Variance", 
-            transform=ax.transAxes,
-            color = "salmon",
-            fontweight="bold",
-            ha="right", va="center", fontsize=10)
-
-    plt.show()
-
+from src.universal_helpers import *
 
 # Data Reading & Processing Functions
-def read_SkillCornerData(match_ids):
+def read_SkillCornerData(match_ids, store_dir = None):
+    # store_dir: optionally save the cleaned data to a Parquet store partitioned by match_id (see src.storage_helpers)
+    validateMatchIds(match_ids = match_ids) # before anything is downloaded, the ids end up in the packed possession keys
+    # download the files that are not local yet concurrently (see src.cache_helpers), the readers then only read local files
+    fetchMatchFiles(match_ids = match_ids)
+
     # read all events
     print("***-- Reading & Processing SkillCorner Dynamic Events --***")
     all_events = readEvents(match_list = match_ids)
-    pp_data, poss_metrics = process_PPdata(event_df = all_events)
+    with StageProfile("process events", rows_in = len(all_events)) as stage:
+        partitions = partitionEvents(event_df = all_events) # split the events by event_type once (see partitionEvents)
+        pp_data, poss_metrics = process_PPdata(event_df = all_events, partitions = partitions)
+        stage.output(pp_data)
     poss_metrics["team_id"] = poss_metrics["team_id"].astype("str")
     poss_metrics["match_id"] = poss_metrics["match_id"].astype("str")
 
     print("\n***-- Reading & Processing SkillCorner Tracking Data --***")
-    # Read & process the raw tracking data
-    tracking_df = readTrackingData(match_list = match_ids, retrieve_metadata=True)
-    tracking_df = create_LeftToRightPoss(df = tracking_df)
-    tracking_df["team_id"] = tracking_df["team_id"].astype("str")
+    # Read & normalize the raw tracking data one match at a time, then concatenate once
+    # (team_id, player_id and match_id are already string categoricals, see tracking_schema)
+    tracking_chunks = normalizeTrackingChunks(chunks = readTrackingChunks(match_list = match_ids, retrieve_metadata = True))
+    if store_dir is not None:
+        from src.storage_helpers import streamTrackingTensors
+        tracking_chunks = streamTrackingTensors(chunks = tracking_chunks, store_dir = store_dir) # a tensor per match as it is read
+    tracking_df = concatFrames(list(tracking_chunks)).reset_index(drop = True)
 
     # From tracking data pull the player metadata
     player_metadata = tracking_df[["player_id", "match_id", "team_id", "team_name", 
                                     "player_short_name", "player_role.name"]].drop_duplicates().reset_index(drop = True)
-    player_metadata["team_id"] = player_metadata["team_id"].astype("str")
+
+    if store_dir is not None:
+        from src.storage_helpers import writeTrackingStore, writeEventStore
+        print("***-- Saving Processed Data to", store_dir, "--***")
+        writeTrackingStore(tracking_df = tracking_df, store_dir = store_dir)
+        writeEventStore(pp_data = pp_data, poss_metrics = poss_metrics, store_dir = store_dir)
 
     print("***-- Successfully Pulled & Processed Data --***")
     return tracking_df, player_metadata, pp_data, poss_metrics
@@ -135,9 +65,9 @@ def getEDA(tracking_df, poss_metrics):
     match_names = tracking_df[["match_id", "match_name"]].drop_duplicates().reset_index(drop = True)
     team_names = tracking_df[["team_id", "team_name"]].drop_duplicates().reset_index(drop = True)
 
-    match_info = poss_metrics.groupby(["match_id"])["match_team_possession_id"].nunique().reset_index()
+    match_info = poss_metrics.groupby(["match_id"])["team_poss_key"].nunique().reset_index()
     match_info = pd.merge(left = match_info, right = match_names, on = "match_id")
-    match_info.rename({"match_team_possession_id" : "num_possession_changes"}, axis = 1, inplace = True)
+    match_info.rename({"team_poss_key" : "num_possession_changes"}, axis = 1, inplace = True)
 
 
     # number of different
@@ -147,7 +77,7 @@ def getEDA(tracking_df, poss_metrics):
     return match_info, team_info
 
 def add_ModelContext(model_df, context_df):
-    pp_model = context_df[['individual_poss_id', 'match_team_possession_id',
+    pp_model = context_df[['poss_key', 'team_poss_key',
                           'duration', 'start_type', 'end_type', 
                           'pass_outcome', 'pass_distance', 'separation_start', 'separation_end', 
                           'n_passing_options', 'n_off_ball_runs', 
@@ -159,42 +89,76 @@ def add_ModelContext(model_df, context_df):
     output_df = pd.merge(
         left = model_df,
         right = pp_model,
-        on = ["individual_poss_id"],
+        on = ["poss_key"],
         how = "left"
     )
 
     return output_df
 
-def create_SkillCornerModelData(pp_df, tracking_df, player_metadata, include_pass):
-    print("***-- Merging tracking & event data. This may take some time. Please wait... --***")
-    poss_track_df = mergeTrack_and_PP(event_df = pp_df,
-                                      track_df = tracking_df,
-                                      include_pass = include_pass,
-                                      track_type = "SkillCorner")
-    
-    # Create out model target variables by estimating the distance traveled by ball
-    model_df = distance_BallCoveredInPossession(df = poss_track_df)
-    model_df = pd.merge(left = model_df, 
-                    right = poss_track_df[["individual_poss_id", "ball_time_in_poss_tempo"]].drop_duplicates(),
-                    on = "individual_poss_id",
-                    how = "left")
-    
+def measurePossessions(pp_df, tracking_df, include_pass, use_ball_index = True):
+    # ball distance & time of every player possession (the model targets)
+    if use_ball_index:
+        # Look up the ball distance of every possession in a cumulative ball path (no event x frame table needed)
+        print("***-- Indexing ball path & measuring possessions --***")
+        with StageProfile("ball path index", rows_in = len(tracking_df)) as stage:
+            ball_index = createBallPathIndex(track_df = tracking_df)
+            stage.output(ball_index[0]) # one row per frame
+        with StageProfile("distance", rows_in = len(pp_df)) as stage:
+            model_df = stage.output(ballDistanceFromIndex(event_df = pp_df,
+                                                          ball_index = ball_index,
+                                                          include_pass = include_pass,
+                                                          track_type = "SkillCorner"))
+    else:
+        print("***-- Merging tracking & event data. This may take some time. Please wait... --***")
+        with StageProfile("merge", rows_in = len(pp_df)) as stage:
+            poss_track_df = stage.output(mergeTrack_and_PP(event_df = pp_df,
+                                                           track_df = tracking_df,
+                                                           include_pass = include_pass,
+                                                           track_type = "SkillCorner"))
+        
+        # Create out model target variables by estimating the distance traveled by ball
+        with StageProfile("distance", rows_in = len(poss_track_df)) as stage:
+            model_df = distance_BallCoveredInPossession(df = poss_track_df)
+            model_df = stage.output(pd.merge(left = model_df, 
+                                             right = poss_track_df[["poss_key", "ball_time_in_poss_tempo"]].drop_duplicates("poss_key"),
+                                             on = "poss_key",
+                                             how = "left"))
+
+    return model_df
+
+def joinModelContext(model_df, pp_df, player_metadata):
+    model_df = model_df.copy()
     model_df["player_id"] = model_df["player_id"].astype("str") # type casting
 
     # Merge Player Data
     print("***-- Adding Context to Model Data --***")
-    model_df = pd.merge(left = model_df,
-                        right = player_metadata,
-                        on = ["match_id", "player_id"],
-                        how = "left")
-    
-    # Add Model Context for our Model Framework
-    model_df = add_ModelContext(model_df=model_df, context_df=pp_df)
+    with StageProfile("context join", rows_in = len(model_df)) as stage:
+        model_df = pd.merge(left = model_df,
+                            right = player_metadata,
+                            on = ["match_id", "player_id"],
+                            how = "left")
+        
+        # Add Model Context for our Model Framework
+        model_df = stage.output(add_ModelContext(model_df=model_df, context_df=pp_df))
+
+    return model_df
+
+def create_SkillCornerModelData(pp_df, tracking_df, player_metadata, include_pass, use_ball_index = True):
+    model_df = measurePossessions(pp_df = pp_df, tracking_df = tracking_df, include_pass = include_pass, use_ball_index = use_ball_index)
+    model_df = joinModelContext(model_df = model_df, pp_df = pp_df, player_metadata = player_metadata)
     
     print("***-- ...Dataset Generated... --***\n\n")
     return model_df
 
-def runDataProcessBatches(match_ids):
+def addTeamPhase(model_df):
+    # team_phase groups the in possession phases we model together
+    model_df["team_phase"] = model_df.team_in_possession_phase_type.astype(object) # plain strings so we can relabel the phases
+    model_df.loc[model_df.team_in_possession_phase_type.isin(["transition", "quick_break", "direct"]),"team_phase"] = "fast or long"
+    model_df.loc[model_df.team_in_possession_phase_type.isin(["chaotic", "disruption"]),"team_phase"] = "chaotic or disruption"
+
+    return model_df
+
+def runDataProcessBatches(match_ids, include_pass = True):
    # TODO: We will adapt this code once we get access to more matches or if selected for the Open Source Grant
 
    tracking_df, player_metadata, pp_data, poss_metrics = read_SkillCornerData(match_ids = match_ids)
@@ -203,7 +167,7 @@ def runDataProcessBatches(match_ids):
    model_df = create_SkillCornerModelData(pp_df = pp_data,
                                        tracking_df = tracking_df,
                                        player_metadata = player_metadata,
-                                       include_pass = True)
+                                       include_pass = include_pass)
     
    # match_last5 = match_ids[k:]
 
@@ -216,29 +180,346 @@ def runDataProcessBatches(match_ids):
    #                                     include_pass = True)
     
    # model_df = pd.concat([model_df, model_df2])
-   model_df.loc[:,"team_phase"] = model_df.team_in_possession_phase_type
-   model_df.loc[model_df.team_in_possession_phase_type.isin(["transition", "quick_break", "direct"]),"team_phase"] = "fast or long"
-   model_df.loc[model_df.team_in_possession_phase_type.isin(["chaotic", "disruption"]),"team_phase"] = "chaotic or disruption"
+   model_df = addTeamPhase(model_df = model_df)
    
    # concatenate our results
    # return model_df, pd.concat([poss_metrics, poss_metrics2]), pd.concat([match_info, match_info2]), pd.concat([team_info, team_info2])
    return model_df, poss_metrics, match_info, team_info
 
-def retrieveDataBatches(match_ids = match_ids):
+def batchHistoryPath():
+    # the batch history lives next to the download cache
+    return os.path.join(cache_settings["cache_dir"], "batch_history.json")
+
+def memoryPerFileByte():
+    # median peak memory (above the memory at the start of the batch) per byte of tracking file over the recorded batches
+    try:
+        with open(batchHistoryPath()) as f:
+            history = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        history = []
+
+    ratios = [batch["peak_delta_mb"] / batch["file_mb"] for batch in history if batch.get("file_mb", 0) > 0 and batch["peak_delta_mb"] > 0]
+
+    return float(np.median(ratios)) if len(ratios) > 0 else default_memory_per_file_byte
+
+def recordBatch(batch):
+    # append one batch to the history so future footprint estimates learn from it. The read-modify-write holds the history lock
+    # so concurrent runs never drop each other's batches, and the new file replaces the old one at once so readers never see half of it
+    path = batchHistoryPath()
+    with fileLock(path + ".lock"):
+        try:
+            with open(path) as f:
+                history = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            history = []
+
+        with open(path + ".tmp", "w") as f:
+            json.dump((history + [batch])[-200:], f) # keep the most recent batches
+        os.replace(path + ".tmp", path)
+
+def estimateMatchFootprint(match_ids):
+    """
+        Estimates the peak memory (MB) of processing each match from the size of its tracking file
+        (mirror, cache or HEAD request) times the memory per file byte observed in earlier batches
+    """
+
+    ratio = memoryPerFileByte()
+
+    footprints = []
+    for id in match_ids:
+        file_size = matchFileSize(match_id = id, kind = "tracking")
+        file_mb = default_tracking_file_mb if file_size is None else file_size / 1024**2
+        footprints.append({"match_id" : id, "file_mb" : file_mb, "estimated_mb" : file_mb * ratio})
+
+    return pd.DataFrame(footprints)
+
+def scheduleMatchBatches(footprints, memory_budget_mb):
+    """
+        Packs matches into batches whose estimated memory stays under memory_budget_mb (first fit decreasing).
+        A match that is larger than the budget on its own gets its own batch. Returns a list of lists of match ids
+    """
+
+    assert memory_budget_mb > 0, "memory_budget_mb must be positive"
+
+    match_list = footprints["match_id"].tolist()
+    estimates = footprints["estimated_mb"].tolist()
+
+    batches = [] # [estimated_mb, [match ids]]
+    for i in sorted(range(len(match_list)), key = lambda i: -estimates[i]):
+        if estimates[i] > memory_budget_mb:
+            print(f"*** match {match_list[i]} needs ~{estimates[i]:.0f} MB which is more than the budget, running it alone ***")
+
+        for batch in batches:
+            if batch[0] + estimates[i] <= memory_budget_mb:
+                batch[0] += estimates[i]
+                batch[1].append(match_list[i])
+                break
+        else:
+            batches.append([estimates[i], [match_list[i]]])
+
+    # keep the matches of each batch (and the batches) in the order they were given
+    order = {id : i for i, id in enumerate(match_list)}
+    batches = [sorted(batch[1], key = order.get) for batch in batches]
+
+    return sorted(batches, key = lambda batch: order[batch[0]])
+
+def retrieveDataBatches(match_ids = match_ids, memory_budget_mb = None):
+    """
+        Processes the matches in batches that fit in memory_budget_mb (default: half of the available memory) and streams
+        every batch into the final model_df, poss_metrics, match_info and team_info. The peak memory of every batch is recorded
+        so the footprint estimates improve over time
+    """
+
+    if memory_budget_mb is None:
+        memory_budget_mb = 0.5 * psutil.virtual_memory().available / 1024**2
+
+    footprints = estimateMatchFootprint(match_ids = match_ids)
+    batches = scheduleMatchBatches(footprints = footprints, memory_budget_mb = memory_budget_mb)
+    print(f"***-- {len(match_ids)} matches in {len(batches)} batches (memory budget {memory_budget_mb:.0f} MB) --***")
+
+    results = [[], [], [], []]
+    for i, batch in enumerate(batches):
+        print(f"\n***-- Batch {i + 1}/{len(batches)}: {batch} --***")
+        with PeakMemorySampler() as memory:
+            batch_results = runDataProcessBatches(match_ids = batch)
+
+        for output, result in zip(results, batch_results):
+            output.append(result)
+        del batch_results
+
+        batch_footprint = footprints.loc[footprints["match_id"].isin(batch), :]
+        recordBatch({"match_ids" : batch,
+                     "file_mb" : float(batch_footprint["file_mb"].sum()),
+                     "estimated_mb" : float(batch_footprint["estimated_mb"].sum()),
+                     "peak_rss_mb" : memory.peak_mb,
+                     "peak_delta_mb" : memory.peak_delta_mb,
+                     "time" : time.time()})
+        print(f"***-- Batch {i + 1} peak memory: {memory.peak_mb:.0f} MB (+{memory.peak_delta_mb:.0f} MB, estimated {batch_footprint['estimated_mb'].sum():.0f} MB) --***")
+
+    model_df, poss_metrics, match_info, team_info = [pd.concat(output) for output in results]
+
+    return model_df, poss_metrics, match_info, team_info
+
+def processMatch(connection, match_id, include_pass = True, profiling = None, cache = None):
+    # Worker process: download -> clean -> normalize -> merge -> distance for a single match.
+    # Only the small per-possession tables go back to the parent (with the stage records when profiling is on),
+    # the tracking data stays in the worker. A spawned worker starts with the cache settings of the environment variables,
+    # so the parent's (configureCache) are passed along in cache
+    if cache is not None:
+        configureCache(cache_dir = cache["cache_dir"], max_gb = cache["max_bytes"] / 1024**3, offline = cache["offline"],
+                       mirror_dir = cache["mirror_dir"] or "")
+    if profiling is not None and profiling["enabled"]:
+        enableProfiling(profile_stages = profiling["profile_stages"], profile_dir = profiling["profile_dir"], interval = profiling["interval"])
+
+    try:
+        connection.send(("ok", runDataProcessBatches(match_ids = [match_id], include_pass = include_pass), collectProfiling()))
+    except Exception as error:
+        connection.send(("error", f"processing match {match_id} failed: {error!r}", collectProfiling()))
+    finally:
+        connection.close()
+        flushAccessTimes() # atexit does not run in multiprocessing workers
+
+def workerMemory(worker):
+    # resident memory (RSS) of a worker process and its children in MB
+    try:
+        process = psutil.Process(worker.pid)
+        return sum(p.memory_info().rss for p in [process] + process.children(recursive = True)) / 1024**2
+    except psutil.NoSuchProcess:
+        return 0.0
+
+def processMatchesParallel(match_ids, include_pass = True, n_workers = 1, max_worker_memory_mb = None, retries = 0, interval = 0.1):
+    """
+        Runs processMatch for every match in its own (spawned) worker process, at most n_workers at a time, and yields
+        (match_id, tables) as the workers finish. The stage records of the workers are merged into the records of this process.
+        With max_worker_memory_mb the resident memory of every worker is sampled every interval seconds; a worker over the
+        budget is killed and its match retried up to retries times before a MemoryError is raised (short spikes between two
+        samples can go unnoticed)
+    """
+
+    context = multiprocessing.get_context("spawn")
+    queue = [(id, 0) for id in match_ids]
+    running = {} # match_id -> (worker, connection, attempt)
+
+    try:
+        while len(queue) > 0 or len(running) > 0:
+            while len(queue) > 0 and len(running) < n_workers:
+                id, attempt = queue.pop(0)
+                receiver, sender = context.Pipe(duplex = False)
+                worker = context.Process(target = processMatch, args = (sender, id, include_pass, dict(profiling_settings), dict(cache_settings)),
+                                         daemon = True)
+                worker.start()
+                sender.close()
+                running[id] = (worker, receiver, attempt)
+
+            for id, (worker, receiver, attempt) in list(running.items()):
+                if receiver.poll():
+                    try:
+                        status, result, profiling = receiver.recv()
+                    except EOFError: # the worker died without sending anything back
+                        worker.join()
+                        raise RuntimeError(f"the worker of match {id} died (exit code {worker.exitcode})")
+                    worker.join()
+                    receiver.close()
+                    del running[id]
+                    mergeProfiling(profiling)
+                    if status == "error":
+                        raise RuntimeError(result)
+                    yield id, result
+
+                elif max_worker_memory_mb and workerMemory(worker) > max_worker_memory_mb:
+                    worker.kill()
+                    worker.join()
+                    receiver.close()
+                    del running[id]
+                    if attempt >= retries:
+                        raise MemoryError(f"the worker of match {id} went over max_worker_memory_mb = {max_worker_memory_mb}")
+                    print(f"*** The worker of match {id} went over {max_worker_memory_mb} MB and was killed, retrying ***")
+                    queue.append((id, attempt + 1))
+
+            time.sleep(interval)
+    finally:
+        for worker, receiver, _ in running.values():
+            worker.kill()
+            worker.join()
+            receiver.close()
+
+def retrieveDataParallel(match_ids = match_ids, n_workers = None, max_worker_memory_mb = None, include_pass = True, retries = 0):
+    """
+        Processes every match in its own worker process and concatenates the results (model_df, poss_metrics, match_info, team_info)
+        in the order of match_ids. n_workers defaults to the number of CPUs (at most one per match), max_worker_memory_mb is the
+        resident memory budget of each worker: a worker over it is killed and retried (retries times) before a MemoryError is raised
+    """
+
+    assert type(match_ids) == type([]), "match_ids must be a list of integers"
+
+    n_workers = min(n_workers or os.cpu_count() or 1, len(match_ids))
+    print(f"***-- Processing {len(match_ids)} matches with {n_workers} workers --***")
+
+    results = dict(processMatchesParallel(match_ids = match_ids, include_pass = include_pass, n_workers = n_workers,
+                                          max_worker_memory_mb = max_worker_memory_mb, retries = retries))
+
+    # reduce: one concat per output table
+    model_df, poss_metrics, match_info, team_info = [pd.concat([results[id][i] for id in match_ids], ignore_index = True) for i in range(4)]
 
-    # TODO: We hope to optimize the data merging process after the submission.
-    # For now, we process the data in batches to prevent a kernel timeout
-    model_df, poss_metrics, match_info, team_info  = runDataProcessBatches(match_ids=match_ids[:5])
-    model_df2, poss_metrics2, match_info2, team_info2  = runDataProcessBatches(match_ids=match_ids[5:])
+    return model_df, poss_metrics, match_info, team_info
 
-    model_df = pd.concat([model_df, model_df2])
-    poss_metrics = pd.concat([poss_metrics, poss_metrics2])
-    match_info = pd.concat([match_info, match_info2])
-    team_info = pd.concat([team_info, team_info2])
+def matchInputHash(match_id):
+    # one hash for all inputs of a match (dynamic events, tracking data & match meta data)
+    file_hashes = [matchFileHash(match_id = match_id, kind = kind) for kind in ["events", "tracking", "match"]]
+    return hashlib.sha256("".join(file_hashes).encode()).hexdigest()
+
+def tableSchema(tables):
+    # column names & dtypes of the output tables: {name : [[column, dtype], ...]}
+    return {name : [[str(col), str(dtype)] for col, dtype in table.dtypes.items()] for name, table in tables.items()}
+
+def schemaHash(schema):
+    return hashlib.sha256(json.dumps(schema, sort_keys = True).encode()).hexdigest()
+
+def pipelineCodeHash():
+    # hash of the source of the modules that build the per-match tables, when it changes one match is rebuilt to check the schema
+    import src.universal_global_variables, src.data_processing_helpers, src.universal_helpers
+
+    digest = hashlib.sha256()
+    for module in [src.universal_global_variables, src.data_processing_helpers, src.universal_helpers, sys.modules[__name__]]:
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+def ingestMatches(match_ids = match_ids, store_dir = "data/model_store", include_pass = True, n_workers = 1):
+    """
+        Incremental version of retrieveDataBatches. The outputs of every match are persisted in store_dir (Parquet, see src.storage_helpers)
+        together with a manifest of the input hash, pipeline version and table schema (column names & dtypes) they were built with.
+        Only new matches and matches whose inputs, pipeline_version, include_pass or schema changed are processed (in parallel when
+        n_workers > 1), the others are loaded from the store. When the pipeline code changed since the last run, the first match
+        is rebuilt to learn the current schema, so a schema change without a pipeline_version bump still rebuilds the stale matches.
+        Returns model_df, poss_metrics, match_info and team_info for match_ids
+    """
+
+    from src.storage_helpers import readStore
+
+    manifest_path = os.path.join(store_dir, "manifest.json")
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+
+    table_names = ["model_df", "poss_metrics", "match_info", "team_info"]
+    schema = {}
+
+    def process(ids):
+        # (re)build the tables of ids and persist every match as it comes back
+        if n_workers > 1 and len(ids) > 1:
+            for id, tables in processMatchesParallel(match_ids = ids, include_pass = include_pass, n_workers = min(n_workers, len(ids))):
+                save(id, tables)
+        else:
+            for id in ids:
+                save(id, runDataProcessBatches(match_ids = [id], include_pass = include_pass))
+
+    def save(id, tables):
+        tables = dict(zip(table_names, tables))
+        schema.update(tableSchema(tables = tables)) # the schema the current code produces
+        saveMatchTables(store_dir = store_dir, manifest = manifest, match_id = id, tables = tables,
+                        input_hash = input_hashes[id], include_pass = include_pass)
+
+    # which matches need (re)processing
+    input_hashes = {id : matchInputHash(match_id = id) for id in match_ids}
+    todo = [id for id in match_ids
+            if manifest.get(str(id), {}).get("input_hash") != input_hashes[id]
+            or manifest.get(str(id), {}).get("pipeline_version") != pipeline_version
+            or manifest.get(str(id), {}).get("include_pass") != include_pass]
+    print(f"***-- {len(todo)} of {len(match_ids)} matches need processing, {len(match_ids) - len(todo)} are loaded from {store_dir} --***")
+    process(todo)
+
+    # the schema of the current code: from the matches just built, from the last run when the code did not change,
+    # or else by rebuilding one match
+    code_hash = pipelineCodeHash()
+    pipeline = manifest.get("_pipeline", {})
+    if len(schema) == 0 and pipeline.get("code_hash") == code_hash and "schema" in pipeline:
+        schema.update(pipeline["schema"])
+    elif len(schema) == 0:
+        print(f"***-- The pipeline code changed, rebuilding match {match_ids[0]} to check the table schema --***")
+        process(match_ids[:1])
+
+    stale = [id for id in match_ids if manifest[str(id)].get("schema_hash") != schemaHash(schema = schema)]
+    if len(stale) > 0:
+        print(f"***-- {len(stale)} matches were stored with another table schema, rebuilding them --***")
+        process(stale)
+
+    manifest["_pipeline"] = {"code_hash" : code_hash, "schema" : schema}
+    writeManifest(store_dir = store_dir, manifest = manifest)
+
+    # load everything we asked for (new and unchanged matches) and put the columns in the order of the schema
+    model_df, poss_metrics, match_info, team_info = [readStore(store_dir = store_dir, name = name, match_ids = match_ids)[[col for col, _ in schema[name]]]
+                                                     for name in table_names]
 
     return model_df, poss_metrics, match_info, team_info
 
-def filterModelData(model_df, poss_metrics):
+def saveMatchTables(store_dir, manifest, match_id, tables, input_hash, include_pass):
+    # write the tables of one match and record it in the manifest right away (so an interrupted run keeps its progress)
+    from src.storage_helpers import writeStore
+
+    for name, table in tables.items():
+        writeStore(df = table, store_dir = store_dir, name = name)
+
+    manifest[str(match_id)] = {"input_hash" : input_hash,
+                               "pipeline_version" : pipeline_version,
+                               "include_pass" : include_pass,
+                               "processed_at" : time.time(),
+                               "schema_hash" : schemaHash(schema = tableSchema(tables = tables))}
+
+    writeManifest(store_dir = store_dir, manifest = manifest)
+
+def writeManifest(store_dir, manifest):
+    os.makedirs(store_dir, exist_ok = True)
+    with open(os.path.join(store_dir, "manifest.json") + ".tmp", "w") as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(os.path.join(store_dir, "manifest.json") + ".tmp", os.path.join(store_dir, "manifest.json"))
+
+def filterModelData(model_df, poss_metrics, min_sequences = 3, min_player_possessions = 31):
+    # min_sequences: keep team possessions with at least this many player possessions
+    # min_player_possessions: keep players with at least this many possessions (after the other filters)
     # Filter for players possession that did not last more than zero seconds as measured by the tracking data
     model_df_filtered = model_df.loc[model_df["ball_total_distance_tempo"] != 0,:].reset_index(drop = True)
 
@@ -246,40 +527,61 @@ def filterModelData(model_df, poss_metrics):
     model_df_filtered["ball_speed_tempo"] = model_df_filtered["ball_total_distance_tempo"] / model_df_filtered["ball_time_in_poss_tempo"]
 
     # Filter for possession with atleast 3 sequences (3 changes in player possession during the team possession)
-    poss_samples = poss_metrics.loc[poss_metrics.team_possession_num_sequences > 2]["match_team_possession_id"].tolist()
-    model_df_filtered = model_df_filtered.loc[model_df_filtered["match_team_possession_id"].isin(poss_samples),:]
+    poss_samples = poss_metrics.loc[poss_metrics.team_possession_num_sequences >= min_sequences]["team_poss_key"].to_numpy()
+    model_df_filtered = model_df_filtered.loc[np.isin(model_df_filtered["team_poss_key"].to_numpy(), poss_samples),:]
 
     players_sample = model_df_filtered["player_short_name"].value_counts().reset_index()
-    players_sample = players_sample.loc[players_sample["count"] > 30, :] # filter for players with atleast 35 possessions across the data sample
+    players_sample = players_sample.loc[players_sample["count"] >= min_player_possessions, :] # filter for players with enough possessions across the data sample
     players_sample["count"].describe().T
 
     # # filter for players with atleast 30 possessions
     model_df_filtered = model_df_filtered.loc[model_df_filtered["player_short_name"].isin(players_sample["player_short_name"].tolist()),:]
 
-    return model_df_filtered, players_sample
-
-def plotTempo(model_df):
-    plt.hist(model_df["ball_speed_tempo"], bins=30)
-    plt.title("Distribution of Ball Speed Tempo")
-    plt.xlabel("Ball Speed Tempo")
+    # categorical columns (see event_schema & tracking_schema) should only keep the levels we model
+    for col in model_df_filtered.select_dtypes("category").columns:
+        model_df_filtered[col] = model_df_filtered[col].cat.remove_unused_categories()
 
-    plt.show()
-
-# Sort Players by their Random Effect on Tempo Variance
-def playerRankings(trace, hdi = 0.95):
-    trace.posterior.data_vars
-    alpha_player_vars = ["alpha_1|player_short_name"] # list in case we want to increase vars
-
-    alpha_player_df = az.summary(
-        trace,
-        var_names=alpha_player_vars,
-        hdi_prob = hdi
-    )
-
-    return alpha_player_df.sort_values("mean")
+    return model_df_filtered, players_sample
 
-# view the fixed effects from our model
-def fixedEffects(trace):
-    results = az.summary(trace)
-    results["exponentiated_mean"] = round((np.exp(results["mean"])), 2)
-    return results.head(11)
+# Modeling & Visualization (imported on first use) ---
+# name -> (module, attribute of the module or None for the module itself)
+lazy_attributes = {
+    "plt" : ("matplotlib.pyplot", None),
+    "Pitch" : ("mplsoccer", "Pitch"),
+    "az" : ("arviz", None),
+    "bmb" : ("bambi", None), # a beautiful package
+    "plotTempo" : ("src.visualization_helpers", "plotTempo"),
+    "visualizeEstimatedPlayerImpact" : ("src.modeling_helpers", "visualizeEstimatedPlayerImpact"),
+    "playerRankings" : ("src.modeling_helpers", "playerRankings"),
+    "fixedEffects" : ("src.modeling_helpers", "fixedEffects"),
+    "fitCachedModel" : ("src.modeling_helpers", "fitCachedModel"),
+    "clearPosteriorCache" : ("src.modeling_helpers", "clearPosteriorCache"),
+    "fitChainsParallel" : ("src.modeling_helpers", "fitChainsParallel"),
+    "fitApproximate" : ("src.modeling_helpers", "fitApproximate"),
+    "compareToReference" : ("src.modeling_helpers", "compareToReference"),
+    "posteriorSummary" : ("src.modeling_helpers", "posteriorSummary"),
+    "writeModelData" : ("src.tempo_model_helpers", "writeModelData"),
+    "fitMinibatch" : ("src.tempo_model_helpers", "fitMinibatch"),
+    "TempoModel" : ("src.tempo_model_helpers", "TempoModel"),
+    "fitSubsets" : ("src.tempo_model_helpers", "fitSubsets"),
+}
+
+def __getattr__(name):
+    if name not in lazy_attributes:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module, attribute = lazy_attributes[name]
+    value = importlib.import_module(module)
+    if attribute is not None:
+        value = getattr(value, attribute)
+
+    globals()[name] = value # later lookups skip __getattr__
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(lazy_attributes))
+
+# star imports get every public name except the lazy ones (listing them here would import them at that point)
+__all__ = [name for name in list(globals()) if not name.startswith("_") and name not in lazy_attributes]
+
+# fin.
@@ -0,0 +1,235 @@
+# Parquet storage for the cleaned SkillCorner data
+# Every dataset is partitioned by match_id (<store_dir>/<name>/match_id=<id>/...) so a reader only opens the matches it needs.
+# Reads support column projection and filters on match_id, period and frame ranges that are pushed down to pyarrow.
+# Tracking data can also be stored as a dense [frames, slots, xy] tensor per match in np.memmap files (see writeTrackingTensor),
+# written match by match while the tracking data is read (streamTrackingTensors) and joined on by mergeTrack_and_PP.
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# partition key of every dataset in the store (match_id is a string everywhere in our pipeline)
+store_partitioning = ds.partitioning(pa.schema([("match_id", pa.string())]), flavor = "hive")
+
+# 1
+def writeStore(df : pd.DataFrame, store_dir : str, name : str, sort_by : list[str] = None) -> str:
+    """
+        Writes a data frame to <store_dir>/<name> as Parquet partitioned by match_id.
+        Matches that are already in the store are replaced, other matches are kept. Returns the dataset path
+    """
+
+    assert "match_id" in df.columns, "df must have a match_id column to partition on"
+
+    dataset_path = os.path.join(store_dir, name)
+
+    df = df.copy()
+    df["match_id"] = df["match_id"].astype("str")
+    if sort_by is not None:
+        # sorted row groups have tight min/max statistics so frame filters can skip most of the file
+        df = df.sort_values(["match_id"] + sort_by, kind = "stable")
+
+    ds.write_dataset(pa.Table.from_pandas(df, preserve_index = False),
+                     base_dir = dataset_path,
+                     format = "parquet",
+                     partitioning = store_partitioning,
+                     existing_data_behavior = "delete_matching",
+                     max_rows_per_group = 256 * 1024)
+
+    return dataset_path
+
+# 2
+def readStore(store_dir : str, name : str, columns : list[str] = None, match_ids : list = None,
+              periods : list[int] = None, frame_range : tuple[int, int] = None, frame_column : str = "frame") -> pd.DataFrame:
+    """
+        Reads a dataset from the store. Only the requested columns are read and the filters
+        (match_id in match_ids, period in periods, frame_range[0] <= frame <= frame_range[1]) are applied while scanning
+    """
+
+    dataset_path = os.path.join(store_dir, name)
+    assert os.path.isdir(dataset_path), f"{dataset_path} does not exist, write it first with writeStore"
+
+    dataset = ds.dataset(dataset_path, format = "parquet", partitioning = store_partitioning)
+
+    filters = []
+    if match_ids is not None:
+        filters.append(ds.field("match_id").isin([str(id) for id in match_ids]))
+    if periods is not None:
+        filters.append(ds.field("period").isin(list(periods)))
+    if frame_range is not None:
+        filters.append((ds.field(frame_column) >= frame_range[0]) & (ds.field(frame_column) <= frame_range[1]))
+
+    expression = None
+    for condition in filters:
+        expression = condition if expression is None else expression & condition
+
+    table = dataset.to_table(columns = columns, filter = expression)
+    return table.to_pandas()
+
+# 3
+def writeTrackingStore(tracking_df : pd.DataFrame, store_dir : str) -> str:
+    """Writes cleaned (and direction normalized) tracking data sorted by period and frame"""
+
+    return writeStore(df = tracking_df, store_dir = store_dir, name = "tracking", sort_by = ["period", "frame"])
+
+# 4
+def readTrackingStore(store_dir : str, columns : list[str] = None, match_ids : list = None,
+                      periods : list[int] = None, frame_range : tuple[int, int] = None) -> pd.DataFrame:
+    """
+        Reads tracking data from the store. For example mergeTrack_and_PP only needs
+        columns = ["match_id", "frame", "ball_x", "ball_y"]
+    """
+
+    return readStore(store_dir = store_dir, name = "tracking", columns = columns, match_ids = match_ids,
+                     periods = periods, frame_range = frame_range)
+
+# 5
+def readTrackingFrames(store_dir : str, match_id, frame_start : int, frame_end : int = None, columns : list[str] = None) -> pd.DataFrame:
+    """Reads the tracking rows of one match between two frames, e.g. a single frame for plotFrame_Regular/plotFrame_Adjusted"""
+
+    frame_end = frame_start if frame_end is None else frame_end
+
+    return readTrackingStore(store_dir = store_dir, columns = columns, match_ids = [match_id], frame_range = (frame_start, frame_end))
+
+# 6
+def writeEventStore(pp_data : pd.DataFrame, poss_metrics : pd.DataFrame, store_dir : str) -> tuple[str, str]:
+    """Writes the process_PPdata outputs (player possessions and possession metrics)"""
+
+    pp_path = writeStore(df = pp_data, store_dir = store_dir, name = "pp_data", sort_by = ["index"])
+    poss_path = writeStore(df = poss_metrics, store_dir = store_dir, name = "poss_metrics", sort_by = ["match_possession_id"])
+
+    return pp_path, poss_path
+
+# 7
+def readEventStore(store_dir : str, columns : list[str] = None, match_ids : list = None,
+                   frame_range : tuple[int, int] = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Reads the process_PPdata outputs. frame_range keeps the player possessions that start inside the range"""
+
+    pp_data = readStore(store_dir = store_dir, name = "pp_data", columns = columns, match_ids = match_ids,
+                        frame_range = frame_range, frame_column = "frame_start")
+    poss_metrics = readStore(store_dir = store_dir, name = "poss_metrics", match_ids = match_ids)
+
+    return pp_data, poss_metrics
+
+# ***
+# Dense tracking tensors
+
+# 8
+def writeTrackingTensor(tracking_df : pd.DataFrame, store_dir : str, match_id) -> str:
+    """
+        Writes the tracking data of one match as a dense float32 tensor [frames, slots, 2] in <store_dir>/tensors/<match_id>/
+          xy.dat      np.memmap with the x, y coordinates (NaN when a player is not on the pitch in that frame)
+          frames.npy  sorted frame numbers, row i of the tensor holds frames[i] (frame -> row index)
+          slots.csv   slot -> player mapping, slot 0 is the ball
+          meta.json   shape & data type of xy.dat
+    """
+
+    match_df = tracking_df.loc[tracking_df["match_id"].astype("str") == str(match_id), :]
+    assert len(match_df) > 0, f"tracking_df has no rows for match {match_id}"
+
+    tensor_dir = os.path.join(store_dir, "tensors", str(match_id))
+    os.makedirs(tensor_dir, exist_ok = True)
+
+    # frame -> row index
+    frames = np.unique(match_df["frame"].to_numpy()).astype(np.int64)
+    rows = np.searchsorted(frames, match_df["frame"].to_numpy())
+
+    # player -> slot mapping (slot 0 is the ball)
+    slot_cols = [col for col in ["player_id", "team_id", "team_name", "player_short_name"] if col in match_df.columns]
+    slots = (match_df[slot_cols].astype(object).drop_duplicates("player_id")
+                                .sort_values([col for col in ["team_id", "player_id"] if col in slot_cols])
+                                .reset_index(drop = True))
+    slots = pd.concat([pd.DataFrame({"player_id" : ["ball"]}), slots], ignore_index = True)
+    slots.insert(0, "slot", np.arange(len(slots)))
+    player_slot = pd.Index(slots["player_id"].astype("str")).get_indexer(match_df["player_id"].astype("str"))
+
+    xy = np.memmap(os.path.join(tensor_dir, "xy.dat"), dtype = np.float32, mode = "w+", shape = (len(frames), len(slots), 2))
+    xy[:] = np.nan
+
+    # players
+    xy[rows, player_slot, 0] = match_df["x"].to_numpy(dtype = np.float32)
+    xy[rows, player_slot, 1] = match_df["y"].to_numpy(dtype = np.float32)
+
+    # ball (one value per frame)
+    xy[rows, 0, 0] = match_df["ball_x"].to_numpy(dtype = np.float32)
+    xy[rows, 0, 1] = match_df["ball_y"].to_numpy(dtype = np.float32)
+    xy.flush()
+
+    np.save(os.path.join(tensor_dir, "frames.npy"), frames)
+    slots.to_csv(os.path.join(tensor_dir, "slots.csv"), index = False)
+    with open(os.path.join(tensor_dir, "meta.json"), "w") as f:
+        json.dump({"shape" : list(xy.shape), "dtype" : "float32", "axes" : ["frame", "slot", "xy"]}, f)
+
+    return tensor_dir
+
+# 9
+def streamTrackingTensors(chunks, store_dir : str):
+    """
+        Writes the tensor of every match in an iterator of tracking data frames (e.g. normalizeTrackingChunks over readTrackingChunks)
+        as the chunks stream by and yields the chunks on, so the tensors are filled one chunk at a time. A match must not span chunks
+    """
+
+    written = set()
+    for chunk in chunks:
+        for match_id in chunk["match_id"].astype("str").unique():
+            assert match_id not in written, f"match {match_id} is in more than one chunk, every chunk must hold whole matches"
+            writeTrackingTensor(tracking_df = chunk, store_dir = store_dir, match_id = match_id)
+            written.add(match_id)
+        yield chunk
+
+# 9a
+def writeTrackingTensors(tracking, store_dir : str) -> list[str]:
+    """Writes one tracking tensor per match of a tracking data frame or of an iterator of them (see streamTrackingTensors)"""
+
+    chunks = [tracking] if isinstance(tracking, pd.DataFrame) else tracking
+    match_ids = [match_id for chunk in streamTrackingTensors(chunks = chunks, store_dir = store_dir)
+                 for match_id in chunk["match_id"].astype("str").unique()]
+
+    return [os.path.join(store_dir, "tensors", match_id) for match_id in match_ids]
+
+# 10
+def openTrackingTensor(store_dir : str, match_id, mode : str = "r") -> dict:
+    """
+        Opens the tensor of a match without reading it into memory. Returns a dictionary with
+        xy (np.memmap [frames, slots, 2]), frames (frame number of every row) and slots (slot -> player table)
+    """
+
+    tensor_dir = os.path.join(store_dir, "tensors", str(match_id))
+    assert os.path.isdir(tensor_dir), f"{tensor_dir} does not exist, write it first with writeTrackingTensor"
+
+    with open(os.path.join(tensor_dir, "meta.json")) as f:
+        meta = json.load(f)
+
+    return {"xy" : np.memmap(os.path.join(tensor_dir, "xy.dat"), dtype = meta["dtype"], mode = mode, shape = tuple(meta["shape"])),
+            "frames" : np.load(os.path.join(tensor_dir, "frames.npy")),
+            "slots" : pd.read_csv(os.path.join(tensor_dir, "slots.csv"), dtype = {"player_id" : "str", "team_id" : "str"})}
+
+# 11
+def tensorFrameWindow(tensor : dict, frame_start : int, frame_end : int) -> tuple[np.ndarray, np.ndarray]:
+    """
+        Returns a zero-copy view of the rows of a tensor (see openTrackingTensor) with frame_start <= frame <= frame_end
+        and the matching frame numbers. Only the pages of the window are read from disk
+    """
+
+    lo = np.searchsorted(tensor["frames"], frame_start, side = "left")
+    hi = np.searchsorted(tensor["frames"], frame_end, side = "right")
+
+    return tensor["xy"][lo:hi], tensor["frames"][lo:hi]
+
+# 12
+def tensorBallFrames(store_dir : str, match_ids : list) -> pd.DataFrame:
+    """
+        One row per (match_id, frame) with the ball coordinates (slot 0) of the tensors of match_ids, the frame table that
+        intervalJoinFrames joins the possession windows on (see mergeTrack_and_PP). Only the ball slot is copied out of the tensors
+    """
+
+    frames = []
+    for match_id in match_ids:
+        tensor = openTrackingTensor(store_dir = store_dir, match_id = match_id)
+        frames.append(pd.DataFrame({"match_id" : str(match_id), "frame" : tensor["frames"],
+                                    "ball_x" : tensor["xy"][:, 0, 0], "ball_y" : tensor["xy"][:, 0, 1]}))
+
+    return pd.concat(frames, ignore_index = True)
+
+# fin.
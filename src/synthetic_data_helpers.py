@@ -0,0 +1,226 @@
+# Synthetic SkillCorner open data
+# Writes dynamic events CSVs, _tracking_extrapolated.jsonl and _match.json files with the same layout as the SkillCorner
+# repository (<data_dir>/<match_id>/<match_id>_...), so the readers can run offline with configureCache(mirror_dir = data_dir).
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from src.universal_global_variables import *
+
+# 1
+def generateMatchMetaData(match_id : int, n_players : int = 11, n_subs : int = 5) -> dict:
+    """Creates a _match.json style dictionary with two teams of n_players starters and n_subs substitutes that never play"""
+
+    teams = [{"id" : match_id * 10 + 1, "name" : f"Home FC {match_id}", "short_name" : f"Home {match_id}"},
+             {"id" : match_id * 10 + 2, "name" : f"Away FC {match_id}", "short_name" : f"Away {match_id}"}]
+    roles = [("Goalkeeper", "Goalkeeper", "GK"), ("Central Defender", "Center Back", "CB"),
+             ("Midfield", "Central Midfield", "CM"), ("Wide Attacker", "Left Winger", "LW"), ("Center Forward", "Center Forward", "CF")]
+
+    players = []
+    for t, team in enumerate(teams):
+        for k in range(n_players + n_subs):
+            role = roles[0] if k == 0 else roles[1 + (k - 1) % (len(roles) - 1)]
+            playing = k < n_players
+            players.append({"id" : match_id * 100 + t * 50 + k,
+                            "short_name" : f"{team['short_name']} Player {k + 1}",
+                            "number" : k + 1,
+                            "team_id" : team["id"],
+                            "start_time" : "00:00:00" if playing else None,
+                            "end_time" : None,
+                            "player_role" : {"position_group" : role[0], "name" : role[1], "acronym" : role[2]}})
+
+    return {"id" : match_id,
+            "home_team_score" : 1,
+            "away_team_score" : 1,
+            "date_time" : "2024-10-19T09:00:00Z",
+            "home_team" : teams[0],
+            "away_team" : teams[1],
+            "home_team_side" : ["left_to_right", "right_to_left"],
+            "players" : players}
+
+# 2
+def generatePossessions(n_frames : int, possession_rate : float, rng, mean_duration : float = 25) -> pd.DataFrame:
+    """
+        Lays out player possessions over the match: runs of 1-8 player possessions per team possession, with breaks
+        so that roughly possession_rate of the frames have a team in possession
+    """
+
+    rows = []
+    frame = 10
+    team = 0
+    while frame < n_frames - 2 * mean_duration:
+        n_sequences = int(rng.integers(1, 9))
+        for k in range(n_sequences):
+            duration = int(max(2, rng.poisson(mean_duration)))
+            rows.append({"team" : team, "frame_start" : frame, "frame_end" : min(frame + duration, n_frames - 1),
+                         "first" : k == 0, "last" : k == n_sequences - 1})
+            frame += duration + int(rng.integers(1, 5)) # the ball travels to the next player
+
+        # a break without a team in possession, sized to hit possession_rate
+        frame += int(rng.exponential(mean_duration * n_sequences * (1 - possession_rate) / max(possession_rate, 1e-3)))
+        team = 1 - team if rng.random() < 0.8 else team
+
+    return pd.DataFrame(rows)
+
+# 3
+def generateTracking(meta_data : dict, possessions : pd.DataFrame, n_frames : int, n_players : int, rng) -> tuple[list[str], np.ndarray]:
+    """
+        Creates the JSON lines of a _tracking_extrapolated.jsonl file. Players move as smoothed random walks and the ball
+        follows the player in possession (or drifts when nobody has it). Returns the lines and the player in possession per pp event
+    """
+
+    starters = [[p["id"] for p in meta_data["players"] if p["team_id"] == team["id"]][:n_players]
+                for team in [meta_data["home_team"], meta_data["away_team"]]]
+    player_ids = starters[0] + starters[1]
+
+    # positions [frame, player, xy]
+    steps = rng.normal(0, 0.15, size = (n_frames, len(player_ids), 2))
+    start = np.column_stack([rng.uniform(-45, 45, len(player_ids)), rng.uniform(-30, 30, len(player_ids))])
+    xy = np.clip(start + np.cumsum(steps, axis = 0), [-52, -34], [52, 34])
+
+    # who has the ball
+    holder = np.full(n_frames, -1)
+    group = np.full(n_frames, None, dtype = object)
+    pp_player = np.zeros(len(possessions), dtype = int)
+    for i, (team, frame_start, frame_end) in enumerate(possessions[["team", "frame_start", "frame_end"]].itertuples(index = False)):
+        pp_player[i] = int(rng.integers(0, n_players)) + team * n_players
+        holder[frame_start : frame_end + 1] = pp_player[i]
+        group[frame_start : frame_end + 1] = "home team" if team == 0 else "away team"
+
+    ball = np.cumsum(rng.normal(0, 0.4, size = (n_frames, 2)), axis = 0)
+    has_ball = holder >= 0
+    ball[has_ball] = xy[np.flatnonzero(has_ball), holder[has_ball]] + rng.normal(0, 0.3, size = (has_ball.sum(), 2))
+    ball = np.clip(ball, [-52, -34], [52, 34])
+
+    half = n_frames // 2
+    lines = []
+    for frame in range(n_frames):
+        started = frame >= 5 # the first frames of an extrapolated file have no players yet
+        seconds = (frame if frame < half else frame - half) / 10
+        record = {"frame" : frame,
+                  "timestamp" : f"{int(seconds // 3600):02d}:{int(seconds // 60) % 60:02d}:{seconds % 60:05.2f}" if started else None,
+                  "period" : (1 if frame < half else 2) if started else None,
+                  "ball_data" : {"x" : round(float(ball[frame, 0]), 2) if started else None,
+                                 "y" : round(float(ball[frame, 1]), 2) if started else None,
+                                 "z" : round(float(abs(rng.normal(0, 0.3))), 2) if started else None,
+                                 "is_detected" : bool(rng.random() < 0.9) if started else None},
+                  "possession" : {"player_id" : player_ids[holder[frame]] if holder[frame] >= 0 else None, "group" : group[frame]},
+                  "image_corners_projection" : None,
+                  "player_data" : [{"x" : round(float(xy[frame, k, 0]), 2), "y" : round(float(xy[frame, k, 1]), 2),
+                                    "player_id" : player_ids[k], "is_detected" : bool(rng.random() < 0.8)}
+                                   for k in range(len(player_ids))] if started else []}
+        lines.append(json.dumps(record))
+
+    return lines, np.array(player_ids)[pp_player]
+
+# 4
+def generateEvents(match_id : int, meta_data : dict, possessions : pd.DataFrame, pp_player_ids : np.ndarray, n_players : int, rng) -> pd.DataFrame:
+    """Creates a dynamic events table with player possessions, passing options, on ball engagements and off ball runs"""
+
+    teams = [meta_data["home_team"], meta_data["away_team"]]
+    names = {p["id"] : p["short_name"] for p in meta_data["players"]}
+    starters = [[p["id"] for p in meta_data["players"] if p["team_id"] == team["id"]][:n_players] for team in teams]
+
+    rows = []
+    for i, pp in enumerate(possessions.itertuples(index = False)):
+        team, opponent = teams[pp.team], teams[1 - pp.team]
+        player_id = int(pp_player_ids[i])
+        event_id = f"{len(rows)}"
+        end_type = "pass" if not pp.last else rng.choice(["pass", "shot", "clearance", "possession_loss"])
+        rows.append({"event_type" : "player_possession", "event_subtype" : None,
+                     "player_id" : player_id, "player_name" : names[player_id], "team_id" : team["id"], "team_shortname" : team["short_name"],
+                     "frame_start" : pp.frame_start, "frame_end" : pp.frame_end, "duration" : (pp.frame_end - pp.frame_start) / 10,
+                     "x_start" : rng.uniform(-52, 52), "y_start" : rng.uniform(-34, 34), "x_end" : rng.uniform(-52, 52), "y_end" : rng.uniform(-34, 34),
+                     "targeted_passing_option_event_id" : None, "player_targeted_name" : None,
+                     "start_type" : "pass_reception" if not pp.first else rng.choice(["recovery", "throw_in", "free_kick"]),
+                     "end_type" : end_type,
+                     "pass_outcome" : ("successful" if not pp.last else "unsuccessful") if end_type == "pass" else None,
+                     "pass_distance" : rng.uniform(3, 40) if end_type == "pass" else None,
+                     "separation_start" : rng.gamma(2, 1.5), "separation_end" : rng.gamma(2, 1.5), "distance_covered" : rng.gamma(2, 2),
+                     "n_passing_options" : int(rng.integers(0, 7)), "n_off_ball_runs" : int(rng.integers(0, 4)),
+                     "team_score" : 0, "opponent_team_score" : 0, "game_state" : rng.choice(["drawing", "winning", "losing"]),
+                     "speed_avg" : rng.uniform(0, 7), "speed_avg_band" : rng.choice(["walking", "jogging", "running", "sprinting"]),
+                     "team_in_possession_phase_type" : rng.choice(["build_up", "create", "finish", "transition", "quick_break", "direct", "chaotic", "set_play"]),
+                     "team_out_of_possession_phase_type" : rng.choice(["low_block", "medium_block", "high_block"]),
+                     "third_start" : rng.choice(["defensive_third", "middle_third", "attacking_third"]),
+                     "first_player_possession_in_team_possession" : pp.first, "last_player_possession_in_team_possession" : pp.last})
+
+        for _ in range(int(rng.integers(0, 4))):
+            option = int(rng.choice(starters[pp.team]))
+            rows.append({"event_type" : "passing_option", "player_id" : option, "player_name" : names[option], "team_id" : team["id"],
+                         "team_shortname" : team["short_name"], "frame_start" : pp.frame_start, "frame_end" : pp.frame_end,
+                         "associated_player_possession_event_id" : event_id, "interplayer_distance" : rng.uniform(3, 40),
+                         "interplayer_angle" : rng.uniform(0, np.pi), "passing_option_score" : rng.uniform(),
+                         "separation_start" : rng.gamma(2, 1.5), "separation_end" : rng.gamma(2, 1.5), "separation_gain" : rng.normal()})
+
+        for _ in range(int(rng.integers(0, 3))):
+            defender = int(rng.choice(starters[1 - pp.team]))
+            rows.append({"event_type" : "on_ball_engagement", "player_id" : defender, "player_name" : names[defender], "team_id" : opponent["id"],
+                         "team_shortname" : opponent["short_name"], "frame_start" : pp.frame_start, "frame_end" : pp.frame_end,
+                         "event_subtype" : rng.choice(["pressing", "counter_press", "recovery_press", "pressure", "other"]),
+                         "associated_player_possession_event_id" : event_id, "speed_avg" : rng.uniform(0, 7),
+                         "speed_avg_band" : rng.choice(["jogging", "running", "sprinting"]), "distance_covered" : rng.gamma(2, 2),
+                         "pressing_chain" : bool(rng.random() < 0.3), "pressing_chain_end_type" : None,
+                         "pressing_chain_length" : int(rng.integers(1, 4)), "simultaneous_defensive_engagement_same_target" : bool(rng.random() < 0.2)})
+
+        runner = int(rng.choice(starters[pp.team]))
+        rows.append({"event_type" : "off_ball_run", "event_subtype" : "run_ahead_of_the_ball", "player_id" : runner, "player_name" : names[runner],
+                     "team_id" : team["id"], "team_shortname" : team["short_name"], "frame_start" : pp.frame_start, "frame_end" : pp.frame_end})
+
+    events = pd.DataFrame(rows)
+    events.insert(0, "match_id", match_id)
+    events.insert(1, "index", np.arange(len(events)))
+    events.insert(2, "event_id", [f"{i}" for i in range(len(events))])
+
+    # every column the helpers select has to exist (empty when the event type does not use it)
+    for col in dict.fromkeys(pp_variables + po_variables + obe_variables):
+        if col not in events.columns:
+            events[col] = None
+
+    return events
+
+# 5
+def generateSyntheticMatch(data_dir : str, match_id : int, n_frames : int = 54000, n_players : int = 11,
+                           possession_rate : float = 0.75, seed : int = None) -> str:
+    """
+        Writes the three SkillCorner files of one synthetic match to <data_dir>/<match_id>/.
+        n_frames is the number of tracking frames (10 per second, 54000 = 90 minutes), n_players the starters per team
+        and possession_rate the share of frames with a team in possession. Returns the match directory
+    """
+
+    assert 0 < possession_rate <= 1, "possession_rate must be in (0, 1]"
+    assert n_frames > 200, "n_frames must be larger than 200"
+
+    rng = np.random.default_rng(match_id if seed is None else seed)
+
+    meta_data = generateMatchMetaData(match_id = match_id, n_players = n_players)
+    possessions = generatePossessions(n_frames = n_frames, possession_rate = possession_rate, rng = rng)
+    lines, pp_player_ids = generateTracking(meta_data = meta_data, possessions = possessions, n_frames = n_frames, n_players = n_players, rng = rng)
+    events = generateEvents(match_id = match_id, meta_data = meta_data, possessions = possessions,
+                            pp_player_ids = pp_player_ids, n_players = n_players, rng = rng)
+
+    match_dir = os.path.join(data_dir, str(match_id))
+    os.makedirs(match_dir, exist_ok = True)
+
+    events.to_csv(os.path.join(match_dir, f"{match_id}_dynamic_events.csv"), index = False)
+    with open(os.path.join(match_dir, f"{match_id}_tracking_extrapolated.jsonl"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    with open(os.path.join(match_dir, f"{match_id}_match.json"), "w") as f:
+        json.dump(meta_data, f)
+
+    return match_dir
+
+# 6
+def generateSyntheticData(data_dir : str, n_matches : int = 2, n_frames : int = 54000, n_players : int = 11,
+                          possession_rate : float = 0.75, first_match_id : int = 5000001) -> list[int]:
+    """Writes n_matches synthetic matches to data_dir and returns their match ids (ids stay below 2**31, see possession_key_bits)"""
+
+    synthetic_match_ids = [first_match_id + i for i in range(n_matches)]
+    for id in synthetic_match_ids:
+        print("synthetic match_id:", id)
+        generateSyntheticMatch(data_dir = data_dir, match_id = id, n_frames = n_frames, n_players = n_players, possession_rate = possession_rate)
+
+    return synthetic_match_ids
+
+# fin.
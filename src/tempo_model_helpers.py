@@ -0,0 +1,404 @@
+# Scalable fits of the tempo model: the hierarchical Gamma regression of ball_speed_tempo with player random effects on the
+# mean (mu) and the shape (alpha), i.e. the bambi model of tempo_formula (family = "gamma", link = "log").
+#
+# The PyMC model is the one bambi builds (bmb.Model(tempo_formula, data, ...).build()) with its per-possession arrays (design
+# matrix, group indices, response) swapped for shared data containers, so the names, dims, priors & centering are bambi's and
+# the traces work with playerRankings, fixedEffects & visualizeEstimatedPlayerImpact. One built model takes any batch of
+# possessions: fitMinibatch streams batches from a Parquet store (minibatch ADVI) and TempoModel / fitSubsets refit the compiled
+# model on many subsets (per competition, team phase, rolling windows)
+import os
+import json
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+import pymc as pm
+import arviz as az
+import bambi as bmb
+import formulae as fm
+import pytensor
+from pytensor.graph.basic import Constant
+from pytensor.graph.fg import FunctionGraph
+from pymc.model.fgraph import fgraph_from_model, model_from_fgraph, model_named, model_observed_rv, ModelObservedRV
+from pymc.variational.minibatch_rv import create_minibatch_rv
+
+from src.storage_helpers import writeStore, store_partitioning
+from src.modeling_helpers import hashModelData, savePosterior, chain_stats, default_posterior_dir, sampledVars, cleanPosterior
+
+default_model_store_dir = os.path.join("data", "store")
+
+tempo_formula = bmb.Formula("""ball_speed_tempo ~ 1 + separation_start + n_passing_options + n_off_ball_runs + game_state + team_phase
+                               + (1 | player_short_name)""",
+                            "alpha ~ (1 | player_short_name)")
+tempo_categorical = ["player_short_name", "game_state", "team_phase"]
+
+# 1 The bambi model with swappable data
+def formulaColumns(formula : bmb.Formula = tempo_formula) -> list[str]:
+    """The data columns of a formula: the response and the variables of the main and the additional parts (not their parameters)"""
+
+    columns = set(fm.model_description(formula.main).var_names)
+    for part in formula.additionals:
+        columns |= fm.model_description(part).var_names - {part.split("~")[0].strip()}
+
+    return sorted(columns)
+
+def readModelData(source, formula : bmb.Formula = tempo_formula) -> pd.DataFrame:
+    """The formula columns of a model data frame or of a Parquet dataset (see writeModelData)"""
+
+    if isinstance(source, pd.DataFrame):
+        return source[formulaColumns(formula = formula)]
+
+    dataset = ds.dataset(source, format = "parquet", partitioning = store_partitioning)
+    return dataset.to_table(columns = formulaColumns(formula = formula)).to_pandas()
+
+def commonMeans(model : bmb.Model) -> dict:
+    """Column means of the common design matrix of every component that bambi centers (center_predictors & an intercept)"""
+
+    means = {}
+    for name, component in model.components.items():
+        if not model.center_predictors or component.intercept_term is None or len(component.common_terms) == 0:
+            continue
+        design = component.design.common
+        means[name] = np.column_stack([np.asarray(design.design_matrix)[:, design.slices[term]] for term in component.common_terms]).mean(0)
+
+    return means
+
+def designArrays(model : bmb.Model, data : pd.DataFrame, means : dict = None) -> dict:
+    """
+        The per-observation arrays of the PyMC graph of a built bambi model, evaluated on data with the levels of the model data:
+        <component>_intercept_data (ones), <component>_common_data (common design matrix, centered with means, the commonMeans of
+        the model data), <term>_group_index & <term>_predictor for every group term and <response>_data.
+        Only group intercepts (1 | group) are supported, like in the tempo model
+    """
+
+    means = commonMeans(model = model) if means is None else means
+    n_rows, arrays = len(data), {}
+
+    for name, component in model.components.items():
+        if component.intercept_term is not None:
+            arrays[f"{name}_intercept_data"] = np.ones(n_rows)
+
+        if len(component.common_terms):
+            design = component.design.common.evaluate_new_data(data)
+            X = np.column_stack([np.asarray(design.design_matrix)[:, design.slices[term]] for term in component.common_terms]).astype("float64")
+            arrays[f"{name}_common_data"] = X - means[name] if name in means else X
+
+        if len(component.group_specific_terms):
+            design = component.design.group.evaluate_new_data(data)
+            for term_name, term in component.group_specific_terms.items():
+                assert (term.predictor == 1).all(), f"{term_name}: only group intercepts (1 | group) are supported"
+                Z = design.design_matrix.tocsr()[:, design.slices[term.term.name]] # one hot group dummies
+                assert (np.diff(Z.indptr) == 1).all(), f"{term_name}: data has groups that are not in the model data"
+                arrays[f"{term_name}_group_index"] = Z.indices.astype("int64")
+                arrays[f"{term_name}_predictor"] = np.ones(n_rows, dtype = term.predictor.dtype)
+
+    response = model.response_component.term.name
+    arrays[f"{response}_data"] = data[response].to_numpy(dtype = "float64")
+
+    return arrays
+
+def dataModel(model : bmb.Model, total_size : int = None) -> pm.Model:
+    """
+        The PyMC model of a built bambi model with every per-observation constant (design matrices, group indices, response)
+        replaced by a shared data container named after its designArrays array, so pm.set_data / setModelData swap the data
+        without rebuilding. Equal arrays (e.g. the group index of mu & alpha) share a container. With total_size (the number of
+        rows of the full data) the likelihood of a batch is scaled up to the full data (minibatch inference)
+    """
+
+    n_rows = model.response_component.term.data.shape[0]
+    assert len(model.data) == n_rows, "the model data has missing values in the formula columns, drop them first"
+    arrays = designArrays(model = model, data = model.data)
+    fgraph, _ = fgraph_from_model(model.backend.model, inlined_views = True)
+
+    containers, replacements = {}, {}
+    for var in fgraph.variables:
+        if not (isinstance(var, Constant) and getattr(var, "ndim", 0) >= 1 and var.data.shape[0] == n_rows):
+            continue
+        name = next((name for name, array in arrays.items() if array.shape == var.data.shape and array.dtype == var.data.dtype
+                     and np.array_equal(array, var.data)), None)
+        assert name is not None, f"the bambi model has per-observation data that designArrays does not rebuild: {var}"
+        if name not in containers:
+            containers[name] = model_named(pytensor.shared(arrays[name], name = name, shape = (None, *var.data.shape[1:])))
+        replacements[var] = containers[name]
+
+    # rebuild the graph around the containers (a plain fgraph replace would pin their length with SpecifyShape)
+    outputs = pytensor.clone_replace(fgraph.outputs, replace = replacements, rebuild_strict = False)
+    for old, new in zip(fgraph.outputs, outputs):
+        new.name = old.name
+    data_fgraph = FunctionGraph(outputs = outputs, clone = False)
+    data_fgraph._coords, data_fgraph._dim_lengths = fgraph._coords, fgraph._dim_lengths
+
+    if total_size is not None:
+        node = next(node for node in data_fgraph.toposort() if isinstance(node.op, ModelObservedRV))
+        rv, value, *dims = node.inputs
+        observed = model_observed_rv(create_minibatch_rv(rv, total_size), value, *dims)
+        observed.name = node.outputs[0].name
+        data_fgraph.replace(node.outputs[0], observed, import_missing = True)
+
+    return model_from_fgraph(data_fgraph, mutate_fgraph = True)
+
+def setModelData(model : bmb.Model, pm_model : pm.Model, data : pd.DataFrame, means : dict = None) -> None:
+    """Puts data into the containers of a dataModel and resizes its observation dim"""
+
+    arrays = designArrays(model = model, data = data, means = means)
+    pm.set_data({name : array for name, array in arrays.items() if name in pm_model.named_vars}, model = pm_model)
+
+    obs_dim = pm_model.named_vars_to_dims[model.response_component.term.name][0]
+    pm_model.set_dim(obs_dim, len(data), coord_values = np.arange(len(data)))
+
+def traceFunction(model : bmb.Model, pm_model : pm.Model) -> tuple[list[str], callable]:
+    """
+        Names of the variables bambi keeps in a trace (sampledVars) and a compiled function of a point of the dataModel
+        (value variables) that returns them
+    """
+
+    names = [var.name for var in sampledVars(model = model)]
+    outputs = {var.name : var for var in pm_model.unobserved_value_vars} # in terms of the value variables (pm_model[name] would draw from the prior)
+
+    return names, pm_model.compile_fn(outs = [outputs[name] for name in names], inputs = pm_model.value_vars, on_unused_input = "ignore")
+
+def traceToInferenceData(model : bmb.Model, pm_model : pm.Model, posterior : dict, sample_stats : dict = None) -> az.InferenceData:
+    """InferenceData of traceFunction draws (name -> chain x draw x shape) cleaned up like model.fit does (see cleanPosterior)"""
+
+    # variables in bambi's order (fixedEffects shows the first rows)
+    order = model.backend.model.free_RVs + model.backend.model.deterministics
+    posterior = {var.name : posterior[var.name] for var in order if var.name in posterior}
+    idata = az.from_dict(posterior = posterior, sample_stats = sample_stats,
+                         dims = {name : list(pm_model.named_vars_to_dims[name]) for name in posterior if name in pm_model.named_vars_to_dims},
+                         coords = {name : list(levels) for name, levels in pm_model.coords.items()})
+
+    return cleanPosterior(model = model, idata = idata)
+
+def modelTrace(model : bmb.Model, pm_model : pm.Model, samples : dict) -> az.InferenceData:
+    """Trace in the format of bambi's model.fit from draws of the free (value) variables {name : chains x draws x shape}"""
+
+    names, values = traceFunction(model = model, pm_model = pm_model)
+
+    n_chains, n_draws = next(iter(samples.values())).shape[:2]
+    draws = [values({name : sample[chain, draw] for name, sample in samples.items()}) for chain in range(n_chains) for draw in range(n_draws)]
+
+    posterior = {name : np.stack([draw[j] for draw in draws]).reshape(n_chains, n_draws, *np.shape(draws[0][j])) for j, name in enumerate(names)}
+    return traceToInferenceData(model = model, pm_model = pm_model, posterior = posterior)
+
+# 2 Streaming batches from disk
+def writeModelData(model_df : pd.DataFrame, store_dir : str = default_model_store_dir, name : str = "model_data",
+                   formula : bmb.Formula = tempo_formula) -> str:
+    """Writes the formula columns (and match_id) of the model data to the Parquet store, partitioned by match_id. Returns the dataset path"""
+
+    return writeStore(df = model_df[["match_id", *formulaColumns(formula = formula)]], store_dir = store_dir, name = name)
+
+def streamBatches(source, batch_size : int, formula : bmb.Formula = tempo_formula, buffer_rows : int = 100000, random_seed : int = None):
+    """
+        Endless random batches of batch_size rows of a model data frame or Parquet dataset. Every epoch reads the files (matches)
+        in a new random order into a shuffle buffer of about buffer_rows rows, so possessions of several matches are mixed in a
+        batch and only the buffer is in memory
+    """
+
+    rng = np.random.default_rng(random_seed)
+    columns = formulaColumns(formula = formula)
+
+    if isinstance(source, pd.DataFrame):
+        files, buffer_rows = [source[columns]], len(source) # the whole frame is the buffer
+    else:
+        dataset = ds.dataset(source, format = "parquet", partitioning = store_partitioning)
+        files, buffer_rows = dataset.files, min(buffer_rows, dataset.count_rows())
+
+    buffer = pd.DataFrame(columns = columns)
+    while True:
+        for i in rng.permutation(len(files)):
+            data = files[i] if isinstance(files[i], pd.DataFrame) else ds.dataset(files[i], format = "parquet").to_table(columns = columns).to_pandas()
+            buffer = pd.concat([buffer, data], ignore_index = True) if len(buffer) else data.reset_index(drop = True)
+            if len(buffer) < buffer_rows:
+                continue
+
+            buffer = buffer.iloc[rng.permutation(len(buffer))].reset_index(drop = True)
+            n_batches = len(buffer) // batch_size
+            for b in range(n_batches):
+                yield buffer.iloc[b * batch_size:(b + 1) * batch_size]
+            buffer = buffer.iloc[n_batches * batch_size:] # the rest goes into the next buffer
+
+# 3 Minibatch ADVI
+def hashModelSource(source) -> str:
+    """sha256 of a model data frame (hashModelData) or of the files of a Parquet dataset"""
+
+    if isinstance(source, pd.DataFrame):
+        return hashModelData(data = source)
+
+    digest = hashlib.sha256()
+    for path in sorted(ds.dataset(source, format = "parquet", partitioning = store_partitioning).files):
+        digest.update(os.path.relpath(path, source).encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+def fitMinibatch(source, formula : bmb.Formula = tempo_formula, family : str = "gamma", link = "log", categorical : list[str] = tempo_categorical,
+                 priors : dict = None, batch_size : int = 1024, n : int = 20000, learning_rate : float = 0.01, draws : int = 1000,
+                 buffer_rows : int = 100000, random_seed : int = None, posterior_dir : str = default_posterior_dir) -> az.InferenceData:
+    """
+        Mean-field ADVI of the bambi model on random batches of batch_size possessions streamed from source (a Parquet dataset
+        written by writeModelData, or a data frame), for data that full-batch NUTS can not handle. bambi builds the model once from
+        the formula columns of the full data (levels, priors & centering), then the likelihood of every batch is scaled by
+        n_rows / batch_size, so each step uses an unbiased estimate of the full-data ELBO. Runs n steps of adagrad_window (Adam
+        does not converge on this model) and returns draws of the approximation as a 1 chain trace in the format of model.fit,
+        so playerRankings, fixedEffects & visualizeEstimatedPlayerImpact work on it. Cached in posterior_dir like fitCachedModel.
+        Check the player effects against NUTS on a sample of the data with compareToReference
+    """
+
+    content = {"data" : hashModelSource(source = source), "formula" : [" ".join(part.split()) for part in [formula.main, *formula.additionals]],
+               "family" : family, "link" : link, "categorical" : sorted(categorical) if categorical is not None else None,
+               "priors" : {name : repr(prior) for name, prior in priors.items()} if priors is not None else None,
+               "sampler" : "fitMinibatch", "batch_size" : batch_size, "n" : n, "learning_rate" : learning_rate, "draws" : draws,
+               "buffer_rows" : buffer_rows, "random_seed" : random_seed, "versions" : {"bambi" : bmb.__version__, "pymc" : pm.__version__}}
+    key = hashlib.sha256(json.dumps(content, sort_keys = True, default = repr).encode()).hexdigest()[:24]
+    path = os.path.join(posterior_dir, f"{key}.nc")
+    if os.path.exists(path):
+        print(f"***-- Loaded posterior {key} --***")
+        return az.from_netcdf(path)
+
+    start = time.perf_counter()
+    model = bmb.Model(formula = formula, data = readModelData(source = source, formula = formula), family = family, link = link,
+                      categorical = categorical, priors = priors)
+    model.build()
+    n_rows, means = len(model.data), commonMeans(model = model)
+    pm_model = dataModel(model = model, total_size = n_rows)
+    batch_size = min(batch_size, n_rows)
+    print(f"***-- {n_rows} rows, batches of {batch_size} --***")
+
+    batches = streamBatches(source = source, batch_size = batch_size, formula = formula, buffer_rows = buffer_rows, random_seed = random_seed)
+    def nextBatch(*args):
+        setModelData(model = model, pm_model = pm_model, data = next(batches), means = means)
+
+    nextBatch()
+    with pm_model:
+        # a new batch after every step
+        approx = pm.fit(n = n, method = "advi", obj_optimizer = pm.adagrad_window(learning_rate = learning_rate), random_seed = random_seed,
+                        progressbar = False, callbacks = [nextBatch])
+    print(f"***-- advi: {n} steps, mean loss per batch of the last 1000 {np.mean(approx.hist[-1000:]):.1f} --***")
+
+    samples = approx.sample_dict_fn(draws, random_seed = random_seed)
+    idata = modelTrace(model = model, pm_model = pm_model, samples = {name : sample[np.newaxis] for name, sample in samples.items()})
+    print(f"***-- Approximated posterior {key} (minibatch advi) in {time.perf_counter() - start:.0f}s --***")
+
+    savePosterior(idata = idata, posterior_dir = posterior_dir, key = key, content = content)
+    return idata
+
+# 4 Compile-once model for refits on subsets
+class TempoModel:
+    """
+        The bambi model built & compiled once (logp & gradient, NUTS, the trace function) for NUTS fits on many subsets of the
+        data. source (a data frame or a Parquet dataset) fixes the levels, the priors & the centering of the predictors, so every
+        subset is fit with the same players, levels & priors (bambi would rescale the priors per subset), and fit only swaps the
+        data in the containers of the dataModel:
+
+            handle = TempoModel(model_df_filtered)
+            create = handle.fit(model_df_filtered[model_df_filtered["team_phase"] == "create"], draws = 1000, tune = 1000)
+
+        Drop a categorical term from the formula when the subsets have a single level of it (e.g. per team phase refits)
+    """
+
+    def __init__(self, source, formula : bmb.Formula = tempo_formula, family : str = "gamma", link = "log",
+                 categorical : list[str] = tempo_categorical, priors : dict = None, target_accept : float = 0.9):
+        start = time.perf_counter()
+        self.model = bmb.Model(formula = formula, data = readModelData(source = source, formula = formula), family = family, link = link,
+                               categorical = categorical, priors = priors)
+        self.model.build()
+        self.means = commonMeans(model = self.model)
+        self.pm_model = dataModel(model = self.model)
+
+        self.initial_point = self.pm_model.initial_point()
+        self.step = pm.NUTS(model = self.pm_model, target_accept = target_accept, initial_point = self.initial_point)
+        self.initial_state = self.step.sampling_state # step size & mass matrix before any adaptation
+        self.names, self.values = traceFunction(model = self.model, pm_model = self.pm_model)
+        print(f"***-- Compiled the tempo model in {time.perf_counter() - start:.1f}s --***")
+
+    def setData(self, data : pd.DataFrame) -> None:
+        setModelData(model = self.model, pm_model = self.pm_model, data = data, means = self.means)
+
+    def sampleChain(self, draws : int, tune : int, seed : int) -> tuple[dict, dict]:
+        """One NUTS chain on the current data (jittered start, adapted mass matrix & step size) like pm.sample runs it"""
+
+        rng = np.random.default_rng(seed)
+        self.step.sampling_state = self.initial_state
+        self.step.set_rng(rng)
+        self.step.tune = tune > 0
+        self.step.reset_tuning()
+        self.step.iter_count = 0
+
+        point = {name : value + rng.uniform(-1, 1, size = np.shape(value)) for name, value in self.initial_point.items()}
+        chain_draws, chain_draw_stats = {name : [] for name in self.names}, {name : [] for name in chain_stats}
+        for i in range(tune + draws):
+            if i == tune:
+                self.step.stop_tuning()
+
+            point, stats = self.step.step(point)
+            if i >= tune:
+                for name, value in zip(self.names, self.values(point)):
+                    chain_draws[name].append(np.array(value)) # copy, the compiled function may reuse its output buffers
+                for name in chain_stats:
+                    chain_draw_stats[name].append(stats[0][name])
+
+        return chain_draws, chain_draw_stats
+
+    def fit(self, data : pd.DataFrame, draws : int = 1000, tune : int = 1000, chains : int = 4, random_seed : int = None) -> az.InferenceData:
+        """
+            NUTS fit on data (sequential chains). Returns a trace in the format of model.fit with only the groups (players) that
+            are in data (the others would just be draws of their prior)
+        """
+
+        self.setData(data = data)
+        seeds = [int(seed.generate_state(1)[0]) for seed in np.random.SeedSequence(random_seed).spawn(chains)]
+        chains = [self.sampleChain(draws = draws, tune = tune, seed = seed) for seed in seeds]
+
+        posterior = {name : np.stack([np.asarray(chain_draws[name]) for chain_draws, _ in chains]) for name in self.names}
+        sample_stats = {chain_stats[name] : np.stack([np.asarray(draw_stats[name]) for _, draw_stats in chains]) for name in chain_stats}
+        idata = traceToInferenceData(model = self.model, pm_model = self.pm_model, posterior = posterior, sample_stats = sample_stats)
+
+        factors = {term.name.split("|")[1] for component in self.model.components.values() for term in component.group_specific_terms.values()}
+        return idata.sel(**{f"{factor}__factor_dim" : sorted(set(data[factor].astype("str"))) for factor in factors})
+
+# worker state of fitSubsets: the compiled model of this process
+subset_worker = {}
+
+def _initSubsetWorker(source, model_kwargs : dict) -> None:
+    subset_worker["handle"] = TempoModel(source = source, **model_kwargs)
+
+def _fitSubset(job : tuple) -> az.InferenceData:
+    name, data, fit_kwargs = job
+    start = time.perf_counter()
+    idata = subset_worker["handle"].fit(data = data, **fit_kwargs)
+    print(f"***-- Subset {name}: {len(data)} rows in {time.perf_counter() - start:.0f}s --***")
+    return idata
+
+def fitSubsets(source, subsets, formula : bmb.Formula = tempo_formula, family : str = "gamma", link = "log",
+               categorical : list[str] = tempo_categorical, priors : dict = None, target_accept : float = 0.9,
+               parallel : bool = False, workers : int = None, random_seed : int = None, **fit_kwargs) -> dict:
+    """
+        NUTS fits of the bambi model on every subset ({name : data frame} or a list of data frames) with a TempoModel for the
+        levels & priors of source, so the model is compiled once (once per worker process with parallel = True, workers
+        default to the number of cores). fit_kwargs (draws, tune, chains) are passed to TempoModel.fit.
+        Returns {name (or list position) : trace}
+    """
+
+    subsets = subsets if isinstance(subsets, dict) else dict(enumerate(subsets))
+    model_kwargs = {"formula" : formula, "family" : family, "link" : link, "categorical" : categorical, "priors" : priors, "target_accept" : target_accept}
+    source = readModelData(source = source, formula = formula) # read once, not once per worker
+
+    seeds = [int(seed.generate_state(1)[0]) for seed in np.random.SeedSequence(random_seed).spawn(len(subsets))]
+    jobs = [(name, data, {**fit_kwargs, "random_seed" : seed}) for (name, data), seed in zip(subsets.items(), seeds)]
+
+    if not parallel:
+        _initSubsetWorker(source = source, model_kwargs = model_kwargs)
+        return {job[0] : _fitSubset(job = job) for job in jobs}
+
+    workers = min(len(jobs), workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("spawn"),
+                             initializer = _initSubsetWorker, initargs = (source, model_kwargs)) as pool:
+        return dict(zip(subsets, pool.map(_fitSubset, jobs)))
+
+# fin.
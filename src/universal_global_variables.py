@@ -100,7 +100,156 @@ obe_variables = [
     "simultaneous_defensive_engagement_same_target"
 ]
 
+# what readEvents keeps from the dynamic events files: the event types we model and the columns of the variable lists above
+event_read_types = ["player_possession", "passing_option", "on_ball_engagement"]
+event_read_columns = list(dict.fromkeys(pp_variables + po_variables + obe_variables + ["event_type", "event_subtype"]))
+
+# on ball engagement subtypes that are aggregated together (see aggregateOBE)
+# every bucket becomes a feature block: num_<bucket>_players, <bucket>_dist_covered_mean/min, <bucket>_speed_avg_mean/max
+obe_subtype_buckets = {
+    "opp_press" : ["pressing", "counter_press", "recovery_press"],
+    "opp_pressure" : ["pressure"],
+    "opp_other_obe" : ["other"],
+}
+
+# compact data types for our data frames (applied with applyDataSchema, see src.data_processing_helpers)
+# "id" is a categorical with string categories, so IDs still compare and merge like the strings we used before
+# integer types are only applied to columns without missing values
+tracking_schema = {
+    # identifiers
+    "match_id" : "id",
+    "player_id" : "id",
+    "team_id" : "id",
+    "possession_player_id" : "id",
+
+    # frames & coordinates
+    "frame" : "int32",
+    "period" : "int8",
+    "x" : "float32",
+    "y" : "float32",
+    "adj_x" : "float32",
+    "adj_y" : "float32",
+    "ball_x" : "float32",
+    "ball_y" : "float32",
+    "ball_z" : "float32",
+    "ball_adj_x" : "float32",
+    "ball_adj_y" : "float32",
+    "is_detected_ball" : "boolean",
+    "player_number" : "int16",
+
+    # labels that are repeated on every tracking row
+    "possession_group" : "category",
+    "match_name" : "category",
+    "home_team.name" : "category",
+    "away_team.name" : "category",
+    "team_name" : "category",
+    "player_short_name" : "category",
+    "player_role.position_group" : "category",
+    "player_role.name" : "category",
+    "player_role.acronym" : "category",
+    "direction_player_1st_half" : "category",
+    "direction_player_2nd_half" : "category",
+    "possession_flag" : "category",
+    "direction_player" : "category",
+}
+
+event_schema = {
+    # identifiers (integers in the dynamic events, converted to "id" in createPossessionIndex)
+    "match_id" : "int32",
+    "team_id" : "int32",
+    "player_id" : "int32",
+    "index" : "int32",
+
+    # frames & measurements
+    "frame_start" : "int32",
+    "frame_end" : "int32",
+    "x_start" : "float32",
+    "y_start" : "float32",
+    "x_end" : "float32",
+    "y_end" : "float32",
+    "duration" : "float32",
+    "pass_distance" : "float32",
+    "separation_start" : "float32",
+    "separation_end" : "float32",
+    "separation_gain" : "float32",
+    "distance_covered" : "float32",
+    "speed_avg" : "float32",
+    "interplayer_distance" : "float32",
+    "interplayer_angle" : "float32",
+    "passing_option_score" : "float32",
+
+    # flags (empty for the other event types, parsed straight into the nullable boolean type instead of objects)
+    "first_player_possession_in_team_possession" : "boolean",
+    "last_player_possession_in_team_possession" : "boolean",
+
+    # labels
+    "event_type" : "category",
+    "event_subtype" : "category",
+    "team_shortname" : "category",
+    "player_name" : "category",
+    "player_targeted_name" : "category",
+    "start_type" : "category",
+    "end_type" : "category",
+    "pass_outcome" : "category",
+    "game_state" : "category",
+    "speed_avg_band" : "category",
+    "team_in_possession_phase_type" : "category",
+    "team_out_of_possession_phase_type" : "category",
+    "third_start" : "category",
+}
+
+# data types used while parsing the dynamic events CSVs (the numeric & flag columns of event_schema). Integer columns are parsed as
+# float64 because some event types leave them empty; applyDataSchema makes them int32 (and the labels categorical) after the concat
+event_read_dtypes = {col : ("float64" if dtype.startswith("int") else dtype) for col, dtype in event_schema.items() if dtype != "category"}
+
+# identifiers & flags of the player possession data after createPossessionIndex (the flags are empty for the other
+# event types, so they are only bool once the events are filtered to player possessions)
+possession_id_schema = {
+    "match_id" : "id",
+    "team_id" : "id",
+    "player_id" : "id",
+    "first_player_possession_in_team_possession" : "bool",
+    "last_player_possession_in_team_possession" : "bool",
+}
+
+# bits of the packed int64 possession keys (see packPossessionKey): match_id | team possession number | event index
+# 31 + 14 + 18 = 63 bits so every key is a positive int64: any int32 match_id, 16384 team possessions and 262144 events per match
+possession_key_bits = {
+    "match_id" : 31,
+    "possession" : 14,
+    "index" : 18,
+}
+
 # skillcorner frame precision
 skillcorner_frame_precision = (1/10)
 
+# SkillCorner open data locations (dynamic events & match meta data are on raw GitHub, tracking data is stored with LFS)
+skillcorner_raw_url = "https://raw.githubusercontent.com/SkillCorner/opendata/master/data/matches"
+skillcorner_media_url = "https://media.githubusercontent.com/media/SkillCorner/opendata/master/data/matches"
+
+# file name and host of every file we read for a match
+skillcorner_match_files = {
+    "events" : ("{match_id}_dynamic_events.csv", skillcorner_raw_url),
+    "tracking" : ("{match_id}_tracking_extrapolated.jsonl", skillcorner_media_url),
+    "match" : ("{match_id}_match.json", skillcorner_raw_url),
+}
+
+# local download cache for the SkillCorner files (see src.cache_helpers)
+# these defaults can be overwritten with the SKILLCORNER_CACHE_DIR, SKILLCORNER_CACHE_MAX_GB, SKILLCORNER_OFFLINE
+# and SKILLCORNER_MIRROR_DIR environment variables or with configureCache()
+skillcorner_cache_dir = "~/.cache/skillcorner_opendata"
+skillcorner_cache_max_gb = 5
+
+# version of the data pipeline, bump it when a change to the helpers changes the model data so persisted matches are rebuilt
+# (see ingestMatches). Rule: every change to a persisted schema (renamed, added or dropped columns, new dtypes) must bump it
+# "2": individual_poss_id / match_team_possession_id became poss_key / team_poss_key
+# "3": wider match_id field in the packed poss_key / team_poss_key (see possession_key_bits)
+# "4": first_ / last_player_possession_in_team_possession are bool (they were object before the Parquet round trip)
+pipeline_version = "4"
+
+# batch scheduler (see retrieveDataBatches): peak memory used per byte of tracking file until the batch history has observations,
+# and the tracking file size we assume when we can not look it up
+default_memory_per_file_byte = 2.5
+default_tracking_file_mb = 450
+
 # fin.
\ No newline at end of file
@@ -1,9 +1,13 @@
 import pandas as pd
 import numpy as np
 import json
+import time
 import requests
 
-from src.data_processing_helpers import *
+from src.universal_global_variables import event_schema, event_read_types, event_read_columns, event_read_dtypes
+from src.data_processing_helpers import parseTrackingData, playerMetaData, alignCategories, concatFrames, applyDataSchema
+from src.cache_helpers import fetchMatchFile
+from src.profiling_helpers import StageProfile, PeakMemorySampler # PeakMemorySampler used to live here, re-exported for old imports
 
 # 1 From SkillCorner tutorials (convert time to seconds)
 def time_to_seconds(time_str):
@@ -15,32 +19,44 @@ def time_to_seconds(time_str):
 
 
 # 2 Read JSON dynamic events from GitHub
-def readEvents(match_list : list[int]) -> pd.DataFrame:
-    """Reads in dynamic events data from SkillCorner GitHub as specifed by list of match ids"""
+def readEvents(match_list : list[int], event_types : list[str] = event_read_types, columns : list[str] = event_read_columns,
+               chunksize : int = 100_000) -> pd.DataFrame:
+    """
+        Reads in dynamic events data from SkillCorner GitHub as specifed by list of match ids (files are cached locally, see src.cache_helpers).
+        Only the columns we use (see event_read_columns) are parsed, with the numeric & flag types of event_read_dtypes, and only the rows
+        of event_types are kept while the file is streamed in chunks. event_types = None / columns = None read everything
+    """
 
     assert type(match_list) == type([]), "match_list must be a list of integers"
     assert type(match_list[0]) == type(1), "match_list must be a list of integers"
 
-    print("match_id:", match_list[0])
-    output_df = pd.read_csv(f"https://raw.githubusercontent.com/SkillCorner/opendata/master/data/matches/{match_list[0]}/{match_list[0]}_dynamic_events.csv")
+    wanted_columns = None if columns is None else set(columns)
+    usecols = None if columns is None else (lambda col: col in wanted_columns) # columns missing from a file are simply not read
 
-    # loop through the remaining matches, read them, and append to dataset (this only runs if there are more than 1 match in the match_list)
-    if len(match_list) > 1:
-        for id in match_list[1:]:
-            print("match_id:", id)
-            temp_df = pd.read_csv(f"https://raw.githubusercontent.com/SkillCorner/opendata/master/data/matches/{id}/{id}_dynamic_events.csv")
+    # read every match into a list and concatenate once at the end (appending in the loop copies the data every time)
+    match_frames = []
+    for id in match_list:
+        print("match_id:", id)
+        with StageProfile("read events", match_id = id) as stage:
+            chunks = []
+            for chunk in pd.read_csv(fetchMatchFile(match_id = id, kind = "events"), usecols = usecols, dtype = event_read_dtypes, chunksize = chunksize):
+                chunks.append(chunk if event_types is None else chunk.loc[chunk["event_type"].isin(event_types), :])
+            temp_df = stage.output(pd.concat(chunks, ignore_index = True))
 
-            assert output_df.shape[1] == temp_df.shape[1], "number of columns for appending dataset must be the same as output dataset"
+        assert len(match_frames) == 0 or match_frames[0].shape[1] == temp_df.shape[1], "number of columns for appending dataset must be the same as output dataset"
+        match_frames.append(temp_df)
 
-            output_df = pd.concat([output_df, temp_df])
+    output_df = pd.concat(match_frames, ignore_index = True)
 
     assert len(output_df["match_id"].unique()) == len(match_list), "number of matches should be same as number of matches specified in the input"
-    return output_df
+    return applyDataSchema(df = output_df, schema = event_schema, stage = "dynamic events")
 
 # 3 Read JSON tracking data from GitHub
-def readTrackingData(match_list : list[int], retrieve_metadata : bool = True) -> pd.DataFrame:
-
-    """Reads in tracking data from SkillCorner GitHub as specific by list of match ids"""
+def readTrackingChunks(match_list : list[int], retrieve_metadata : bool = True):
+    """
+        Yields the tracking data of one match at a time from SkillCorner GitHub (files are cached locally, see src.cache_helpers),
+        typed with tracking_schema and with the player meta data attached when retrieve_metadata is True
+    """
 
     assert type(match_list) == type([]), "match_list must be a list of integers"
     assert type(match_list[0]) == type(1), "match_list must be a list of integers"
@@ -48,31 +64,31 @@ def readTrackingData(match_list : list[int], retrieve_metadata : bool = True) ->
     if retrieve_metadata:
         print("\n*** Retrieving Player Meta Data (This will increase processing time) ***\n")
 
-    print("match_id:", match_list[0])
-    output_df = pd.read_json(f"https://media.githubusercontent.com/media/SkillCorner/opendata/master/data/matches/{match_list[0]}/{match_list[0]}_tracking_extrapolated.jsonl",
-                            lines = True)
+    for id in match_list:
+        print("match_id:", id)
+        # Use our streaming parser to read & clean up the tracking data (same output as pd.read_json + cleanTrackingData)
+        with StageProfile("read tracking", match_id = id) as stage:
+            match_df = stage.output(parseTrackingData(file_path = fetchMatchFile(match_id = id, kind = "tracking"), match_id = id))
+
+        if retrieve_metadata == True:
+            with StageProfile("metadata merge", match_id = id, rows_in = len(match_df)) as stage:
+                match_df = stage.output(attachPlayerMetaData(tracking_df = match_df, players_df = playerMetaData(match_id = id)))
 
-    output_df = cleanTrackingData(df = output_df, match_id = match_list[0]) # Use our helper function to clean up the tracking data
+        yield match_df
+
+def readTrackingData(match_list : list[int], retrieve_metadata : bool = True) -> pd.DataFrame:
 
-    if retrieve_metadata == True:
-        
-        players_df = playerMetaData(match_id = match_list[0])
-        output_df = pd.merge(left = output_df, right = players_df, on = ["player_id", "match_id"]) # Append metadata for tracking data
+    """Reads in tracking data from SkillCorner GitHub as specific by list of match ids (files are cached locally, see src.cache_helpers)"""
 
-    # loop through the remaining matches, read them, and append to dataset (this only runs if there are more than 1 match in the match_list)
-    if len(match_list) > 1:
-        for id in match_list[1:]:
-            print("match_id:", id)
-            temp_df = pd.read_json(f"https://media.githubusercontent.com/media/SkillCorner/opendata/master/data/matches/{id}/{id}_tracking_extrapolated.jsonl",
-                                   lines = True)
-            
-            temp_df = cleanTrackingData(df = temp_df, match_id = id)
+    # read every match into a list and concatenate once at the end (appending in the loop copies the data every time)
+    match_frames = list(readTrackingChunks(match_list = match_list, retrieve_metadata = retrieve_metadata))
+    assert all(frame.shape[1] == match_frames[0].shape[1] for frame in match_frames), "number of columns for appending dataset must be the same as output dataset"
 
-            if retrieve_metadata == True:
-                players_df = playerMetaData(match_id=id)
-                temp_df = pd.merge(left = temp_df, right = players_df, on = ["player_id", "match_id"]) # append metadata for tracking data
+    return concatFrames(match_frames) # keeps the compact categorical columns
 
-            assert output_df.shape[1] == temp_df.shape[1], "number of columns for appending dataset must be the same as output dataset"
-            output_df = pd.concat([output_df, temp_df])
+# 3a
+def attachPlayerMetaData(tracking_df : pd.DataFrame, players_df : pd.DataFrame) -> pd.DataFrame:
+    """Appends the player meta data (see playerMetaData) to the tracking data of a match"""
 
-    return output_df
+    tracking_df, players_df = alignCategories(left = tracking_df, right = players_df, columns = ["player_id", "match_id"])
+    return pd.merge(left = tracking_df, right = players_df, on = ["player_id", "match_id"])
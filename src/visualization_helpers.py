@@ -1,10 +1,11 @@
+import matplotlib.pyplot as plt
 from mplsoccer import Pitch
 
 
 # 1
 def plotFrame_Regular(frame):
 
-    frame["pip"] = frame["possession_player_id"] == frame["player_id"]
+    frame["pip"] = frame["possession_player_id"].astype("str") == frame["player_id"].astype("str") # categoricals with different categories
 
     pitch = Pitch(
         pitch_type="skillcorner",
@@ -74,7 +75,7 @@ def plotFrame_Regular(frame):
 #2
 def plotFrame_Adjusted(frame):
 
-    frame["pip"] = frame["possession_player_id"] == frame["player_id"]
+    frame["pip"] = frame["possession_player_id"].astype("str") == frame["player_id"].astype("str") # categoricals with different categories
 
     pitch = Pitch(
         pitch_type="skillcorner",
@@ -143,4 +144,14 @@ def plotFrame_Adjusted(frame):
         label="Ball",
     )
 
-    fig.show()
\ No newline at end of file
+    fig.show()
+
+# 3
+def plotTempo(model_df):
+    plt.hist(model_df["ball_speed_tempo"], bins=30)
+    plt.title("Distribution of Ball Speed Tempo")
+    plt.xlabel("Ball Speed Tempo")
+
+    plt.show()
+
+# fin.
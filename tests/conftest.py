@@ -0,0 +1,26 @@
+# Shared fixtures: a small synthetic SkillCorner mirror (see src.synthetic_data_helpers) and an offline cache pointed at it,
+# so no test touches the network or the user's cache
+import os
+import pytest
+
+from src.cache_helpers import cache_settings, configureCache
+from src.synthetic_data_helpers import generateSyntheticData
+
+@pytest.fixture(scope = "session")
+def synthetic_mirror(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp("mirror"))
+    match_ids = generateSyntheticData(data_dir = data_dir, n_matches = 2, n_frames = 6000)
+    return data_dir, match_ids
+
+@pytest.fixture
+def offline_cache(synthetic_mirror, tmp_path, monkeypatch):
+    # workers must get these settings from the parent, not from the environment
+    for name in ["SKILLCORNER_CACHE_DIR", "SKILLCORNER_OFFLINE", "SKILLCORNER_MIRROR_DIR"]:
+        monkeypatch.delenv(name, raising = False)
+
+    saved = dict(cache_settings)
+    data_dir, match_ids = synthetic_mirror
+    configureCache(cache_dir = str(tmp_path / "cache"), mirror_dir = data_dir, offline = True)
+    yield match_ids
+
+    cache_settings.update(saved)
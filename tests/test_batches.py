@@ -0,0 +1,27 @@
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from src.cache_helpers import cache_settings, configureCache
+from src.skillcorner_pysport_hackathon_helpers import recordBatch, batchHistoryPath
+
+def recordBatches(cache_dir, worker, n_batches):
+    configureCache(cache_dir = cache_dir)
+    for i in range(n_batches):
+        recordBatch({"worker" : worker, "batch" : i})
+
+def test_record_batch_keeps_concurrent_batches(tmp_path):
+    # every process appends to the same history file, none of their batches may get lost
+    saved = dict(cache_settings)
+    cache_dir = str(tmp_path / "cache")
+    try:
+        with ProcessPoolExecutor(max_workers = 4, mp_context = multiprocessing.get_context("spawn")) as pool:
+            list(pool.map(recordBatches, [cache_dir] * 4, range(4), [25] * 4))
+
+        configureCache(cache_dir = cache_dir)
+        with open(batchHistoryPath()) as f:
+            history = json.load(f)
+    finally:
+        cache_settings.update(saved)
+
+    assert sorted((batch["worker"], batch["batch"]) for batch in history) == [(worker, i) for worker in range(4) for i in range(25)]
@@ -0,0 +1,44 @@
+import os
+
+import src.cache_helpers as cache_helpers
+from src.cache_helpers import (cache_settings, configureCache, fetchMatchFile, addFileToCache, lookupCache, flushAccessTimes,
+                               skillcornerURL, skillcornerFileName, _readIndex)
+
+def cacheFile(match_id, kind, size, tmp_path):
+    # a downloaded file of a known size, added to the cache like fetchMatchFiles does
+    file_path = str(tmp_path / f"{match_id}_{kind}.part")
+    with open(file_path, "wb") as f:
+        f.write(str(match_id).encode().ljust(size, b"x"))
+    return addFileToCache(url = skillcornerURL(match_id = match_id, kind = kind), file_path = file_path)
+
+def test_cache_hit_does_not_fetch(offline_cache, synthetic_mirror, tmp_path, monkeypatch):
+    # no mirror: the file must come from the cache, offline mode would raise on a miss
+    data_dir, match_ids = synthetic_mirror
+    monkeypatch.setitem(cache_settings, "mirror_dir", None)
+
+    mirror_path = os.path.join(data_dir, str(match_ids[0]), skillcornerFileName(match_id = match_ids[0], kind = "match"))
+    file_path = str(tmp_path / "download.part")
+    with open(mirror_path, "rb") as source, open(file_path, "wb") as f:
+        f.write(source.read())
+    cached_path = addFileToCache(url = skillcornerURL(match_id = match_ids[0], kind = "match"), file_path = file_path)
+
+    def fetchMatchFiles(*args, **kwargs):
+        raise AssertionError("a cached file was downloaded again")
+    monkeypatch.setattr(cache_helpers, "fetchMatchFiles", fetchMatchFiles)
+    assert fetchMatchFile(match_id = match_ids[0], kind = "match") == cached_path
+    with open(cached_path, "rb") as cached, open(mirror_path, "rb") as source:
+        assert cached.read() == source.read()
+
+def test_cache_evicts_least_recently_used(offline_cache, tmp_path):
+    # room for two 1000 byte files
+    configureCache(max_gb = 2500 / 1024**3)
+
+    first = cacheFile(match_id = 1, kind = "match", size = 1000, tmp_path = tmp_path)
+    second = cacheFile(match_id = 2, kind = "match", size = 1000, tmp_path = tmp_path)
+    assert lookupCache(url = skillcornerURL(match_id = 1, kind = "match")) == first # 1 is now more recent than 2
+    flushAccessTimes()
+
+    third = cacheFile(match_id = 3, kind = "match", size = 1000, tmp_path = tmp_path)
+    assert sorted(_readIndex()) == sorted(skillcornerURL(match_id = id, kind = "match") for id in [1, 3])
+    assert os.path.exists(first) and os.path.exists(third) and not os.path.exists(second)
+    assert lookupCache(url = skillcornerURL(match_id = 2, kind = "match")) is None
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data_processing_helpers import aggregateGroups, sortFrame, keysInOrder, applyDataSchema
+from src.profiling_helpers import profiling_settings
+
+@pytest.fixture
+def group_df():
+    # small groups with missing keys & values, like the passing options & on ball engagements of a player possession
+    rng = np.random.default_rng(11)
+    n_rows = 2000
+    df = pd.DataFrame({"match_id" : rng.choice([3, 1, 2], n_rows).astype("int32"),
+                       "pp_event_id" : rng.integers(0, 200, n_rows).astype("float64"),
+                       "player_id" : rng.integers(0, 12, n_rows).astype("float64"),
+                       "distance" : rng.gamma(2, 3, n_rows).astype("float32"),
+                       "index" : rng.integers(0, 500, n_rows).astype("int32")})
+    df.loc[rng.random(n_rows) < 0.05, "pp_event_id"] = np.nan
+    df.loc[rng.random(n_rows) < 0.05, "player_id"] = np.nan
+    df.loc[rng.random(n_rows) < 0.05, "distance"] = np.nan
+    return df
+
+def test_aggregate_groups_matches_pandas(group_df):
+    aggregations = {"distance_min" : ("distance", "min"), "distance_max" : ("distance", "max"), "distance_mean" : ("distance", "mean"),
+                    "distance_sum" : ("distance", "sum"), "index_mean" : ("index", "mean"), "index_sum" : ("index", "sum"), "index_max" : ("index", "max"),
+                    "players" : ("player_id", "nunique"), "rows" : ("index", "size")}
+
+    for df in [group_df, group_df.sort_values(["match_id", "pp_event_id"], kind = "stable")]: # the sort is skipped for sorted keys
+        expected = df.groupby(["match_id", "pp_event_id"]).agg(**aggregations).reset_index()
+        pd.testing.assert_frame_equal(aggregateGroups(df = df, keys = ["match_id", "pp_event_id"], **aggregations), expected,
+                                      check_exact = False, rtol = 1e-6)
+
+    empty = aggregateGroups(df = group_df.iloc[:0], keys = ["match_id", "pp_event_id"], **aggregations)
+    assert len(empty) == 0 and list(empty.columns) == ["match_id", "pp_event_id", *aggregations]
+
+def test_sort_frame_matches_sort_values(group_df):
+    df = group_df.assign(team = pd.Categorical(np.where(group_df["index"] % 3 == 0, "b", "a"), categories = ["b", "a"]))
+    for columns in [["match_id", "index"], ["team", "match_id"], ["pp_event_id", "index"]]:
+        expected = df.sort_values(columns, kind = "stable")
+        pd.testing.assert_frame_equal(sortFrame(df = df, columns = columns), expected)
+        # already sorted rows are not copied but the frame is still a new one
+        in_order = sortFrame(df = expected, columns = columns)
+        pd.testing.assert_frame_equal(in_order, expected)
+        assert in_order is not expected
+
+    assert keysInOrder(keys = [np.array([1, 1, 2]), np.array([5, 6, 0])])
+    assert not keysInOrder(keys = [np.array([1, 1, 2]), np.array([6, 5, 0])])
+
+def test_schema_memory_is_only_reported_while_profiling(group_df, capsys, monkeypatch):
+    schema = {"match_id" : "id", "index" : "int16"}
+
+    applyDataSchema(df = group_df.copy(), schema = schema, stage = "events")
+    assert capsys.readouterr().out == ""
+
+    monkeypatch.setitem(profiling_settings, "enabled", True)
+    applyDataSchema(df = group_df.copy(), schema = schema, stage = "events")
+    assert capsys.readouterr().out.startswith("events memory:")
+    applyDataSchema(df = group_df.copy(), schema = schema, stage = "events", report_memory = False)
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,5 @@
+from src.benchmark_helpers import checkImportTime
+
+def test_star_import_loads_no_modeling_or_plotting_package():
+    report = checkImportTime(modules = ["src.skillcorner_pysport_hackathon_helpers"], budget_s = 60, repeats = 1)
+    assert report["heavy_loaded"].iloc[0] == []
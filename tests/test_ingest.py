@@ -0,0 +1,33 @@
+import json
+import os
+
+from src.skillcorner_pysport_hackathon_helpers import ingestMatches, runDataProcessBatches
+
+def test_ingest_parallel_offline_matches_direct_dtypes(offline_cache, tmp_path):
+    # the parallel ingest runs in spawned workers, which must see the offline mirror of the parent
+    match_ids = offline_cache
+    store_dir = str(tmp_path / "store")
+
+    stored = ingestMatches(match_ids = match_ids, store_dir = store_dir, n_workers = 2)
+    direct = runDataProcessBatches(match_ids = match_ids)
+
+    for name, left, right in zip(["model_df", "poss_metrics", "match_info", "team_info"], stored, direct):
+        assert list(left.columns) == list(right.columns), name
+        assert left.dtypes.astype(str).to_dict() == right.dtypes.astype(str).to_dict(), name
+        assert len(left) == len(right), name
+
+def test_ingest_loads_unchanged_matches(offline_cache, tmp_path):
+    match_ids = offline_cache
+    store_dir = str(tmp_path / "store")
+
+    first = ingestMatches(match_ids = match_ids, store_dir = store_dir)
+    with open(os.path.join(store_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    processed_at = {id : manifest[str(id)]["processed_at"] for id in match_ids}
+
+    again = ingestMatches(match_ids = match_ids, store_dir = store_dir)
+    with open(os.path.join(store_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    assert all(manifest[str(id)]["processed_at"] == processed_at[id] for id in match_ids) # nothing was rebuilt
+    assert all(left.equals(right) for left, right in zip(first, again))
@@ -0,0 +1,17 @@
+import pandas as pd
+
+from src.skillcorner_pysport_hackathon_helpers import retrieveDataParallel, runDataProcessBatches
+
+def comparable(df):
+    # category levels depend on which matches were read together, compare the values
+    df = df.astype({col : "object" for col in df.select_dtypes("category").columns})
+    return df.sort_values(list(df.columns[:2])).reset_index(drop = True)
+
+def test_retrieve_parallel_offline_mirror(offline_cache):
+    # the workers are spawned: they only see the mirror & offline mode through the settings the parent passes them
+    match_ids = offline_cache
+    parallel = retrieveDataParallel(match_ids = match_ids, n_workers = 2)
+    serial = runDataProcessBatches(match_ids = match_ids)
+
+    for name, left, right in zip(["model_df", "poss_metrics", "match_info", "team_info"], parallel, serial):
+        pd.testing.assert_frame_equal(comparable(left), comparable(right), check_dtype = False, obj = name)
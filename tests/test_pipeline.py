@@ -0,0 +1,18 @@
+import src.universal_global_variables as global_variables
+from src.pipeline_helpers import runPipeline
+
+def test_config_change_invalidates_memoized_stages(offline_cache, tmp_path, monkeypatch):
+    match_ids = offline_cache
+    cache_dir = str(tmp_path / "pipeline")
+
+    first = runPipeline(match_ids = match_ids, target = "merged", cache_dir = cache_dir)
+    assert first["computed"] == ["events", "tracking", "tracking", "metadata", "metadata", "normalized", "merged"]
+    assert runPipeline(match_ids = match_ids, target = "merged", cache_dir = cache_dir)["computed"] == []
+
+    # merged lists skillcorner_frame_precision under config: only merged gets a new key and is rerun
+    monkeypatch.setattr(global_variables, "skillcorner_frame_precision", 1/25)
+    second = runPipeline(match_ids = match_ids, target = "merged", cache_dir = cache_dir)
+    assert second["computed"] == ["merged"]
+    assert second["keys"]["merged"] != first["keys"]["merged"]
+    for stage in ["events", "tracking", "metadata", "normalized"]:
+        assert second["keys"][stage] == first["keys"][stage], stage
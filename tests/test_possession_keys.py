@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from src.data_processing_helpers import packPossessionKey, unpackPossessionKey
+from src.universal_global_variables import possession_key_bits
+
+def test_possession_key_round_trip():
+    rng = np.random.default_rng(3)
+    match_id = np.r_[0, 2**possession_key_bits["match_id"] - 1, rng.integers(0, 2**possession_key_bits["match_id"], 100)]
+    possession = np.r_[0, 2**possession_key_bits["possession"] - 1, rng.integers(0, 2**possession_key_bits["possession"], 100)]
+    index = np.r_[0, 2**possession_key_bits["index"] - 1, rng.integers(0, 2**possession_key_bits["index"], 100)]
+
+    keys = packPossessionKey(match_id = match_id, possession = possession, index = index)
+    assert keys.dtype == np.int64 and (keys >= 0).all()
+    for unpacked, values in zip(unpackPossessionKey(keys), [match_id, possession, index]):
+        np.testing.assert_array_equal(unpacked, values)
+
+    # index = 0 is the team possession key: the player possession key with its index bits cleared
+    team_keys = packPossessionKey(match_id = match_id, possession = possession)
+    np.testing.assert_array_equal(team_keys, keys & ~np.int64(2**possession_key_bits["index"] - 1))
+
+@pytest.mark.parametrize("name", ["match_id", "possession", "index"])
+def test_possession_key_overflow(name):
+    parts = {"match_id" : 1, "possession" : 1, "index" : 1}
+
+    with pytest.raises(AssertionError, match = name):
+        packPossessionKey(**{**parts, name : 2**possession_key_bits[name]})
+    with pytest.raises(AssertionError, match = name):
+        packPossessionKey(**{**parts, name : -1})
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.modeling_helpers import fitCachedModel
+from src.tempo_model_helpers import TempoModel, tempo_formula, tempo_categorical
+
+@pytest.fixture(scope = "module")
+def model_df():
+    # small gamma data with the tempo model columns: 12 players with their own mean & shape
+    rng = np.random.default_rng(7)
+    n_rows, players = 480, [f"Player {i}" for i in range(12)]
+    df = pd.DataFrame({"match_id" : rng.choice(["1", "2"], n_rows),
+                       "player_short_name" : rng.choice(players, n_rows),
+                       "separation_start" : rng.gamma(2, 2, n_rows),
+                       "n_passing_options" : rng.poisson(3, n_rows).astype("float64"),
+                       "n_off_ball_runs" : rng.poisson(1, n_rows).astype("float64"),
+                       "game_state" : rng.choice(["drawing", "losing", "winning"], n_rows),
+                       "team_phase" : rng.choice(["build_up", "create", "finish"], n_rows)})
+    player = dict(zip(players, rng.normal(0, 0.2, len(players))))
+    mu = np.exp(2.5 + 0.02 * df["separation_start"] + df["player_short_name"].map(player))
+    df["ball_speed_tempo"] = rng.gamma(5, mu / 5)
+    return df
+
+@pytest.fixture(scope = "module")
+def handle(model_df):
+    return TempoModel(model_df)
+
+def test_data_model_matches_bambi_logp(handle):
+    bambi_model = handle.model.backend.model
+    assert handle.pm_model.compile_logp()(handle.initial_point) == pytest.approx(bambi_model.compile_logp()(bambi_model.initial_point()))
+
+def test_full_refit_matches_fit_cached_model(handle, model_df, tmp_path):
+    refit = handle.fit(model_df, draws = 500, tune = 500, chains = 2, random_seed = 1)
+    reference = fitCachedModel(tempo_formula, model_df, categorical = tempo_categorical, draws = 500, tune = 500, chains = 2,
+                               cores = 1, random_seed = 1, posterior_dir = str(tmp_path))
+
+    assert list(refit.posterior.data_vars) == list(reference.posterior.data_vars)
+    for name in reference.posterior.data_vars:
+        assert refit.posterior[name].shape == reference.posterior[name].shape, name
+        left, right = refit.posterior[name].mean(("chain", "draw")), reference.posterior[name].mean(("chain", "draw"))
+        sd = reference.posterior[name].std(("chain", "draw"))
+        assert (abs(left - right) < 0.5 * sd + 1e-3).all(), name # well within the Monte Carlo error of 1000 draws
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+import src.universal_helpers as universal_helpers
+from src.universal_helpers import readTrackingData, readTrackingChunks, readEvents
+from src.data_processing_helpers import normalizeTrackingChunks, concatFrames, mergeTrack_and_PP, partitionEvents, process_PPdata
+from src.storage_helpers import streamTrackingTensors, openTrackingTensor, tensorFrameWindow
+
+def test_read_tracking_data_concatenates_once(offline_cache, monkeypatch):
+    # reading several matches must not copy the matches read so far once per match
+    match_ids = offline_cache
+    calls = []
+    concat = universal_helpers.concatFrames
+    monkeypatch.setattr(universal_helpers, "concatFrames", lambda frames: calls.append(len(frames)) or concat(frames))
+
+    tracking_df = readTrackingData(match_list = match_ids)
+    assert calls == [len(match_ids)]
+
+    expected = pd.concat([chunk.astype({col : "str" for col in chunk.select_dtypes("category").columns})
+                          for chunk in readTrackingChunks(match_list = match_ids)])
+    assert sorted(tracking_df["match_id"].unique()) == sorted(str(id) for id in match_ids)
+    pd.testing.assert_frame_equal(tracking_df.astype({col : "str" for col in tracking_df.select_dtypes("category").columns}), expected)
+
+def test_interval_join_on_tensor_store_matches_tracking_frame(offline_cache, tmp_path):
+    match_ids = offline_cache
+    store_dir = str(tmp_path / "store")
+    chunks = streamTrackingTensors(chunks = normalizeTrackingChunks(chunks = readTrackingChunks(match_list = match_ids)), store_dir = store_dir)
+    tracking_df = concatFrames(list(chunks)).reset_index(drop = True)
+
+    # the ball slot of a frame window holds the ball of those frames
+    tensor = openTrackingTensor(store_dir = store_dir, match_id = match_ids[0])
+    xy, frames = tensorFrameWindow(tensor = tensor, frame_start = 100, frame_end = 200)
+    ball = tracking_df.loc[tracking_df["match_id"] == str(match_ids[0]), ["frame", "ball_x"]].drop_duplicates("frame").set_index("frame")
+    assert (frames >= 100).all() and (frames <= 200).all()
+    np.testing.assert_array_equal(xy[:, 0, 0], ball.loc[frames, "ball_x"].to_numpy())
+
+    event_df = readEvents(match_list = match_ids)
+    pp_data, _ = process_PPdata(event_df = event_df, partitions = partitionEvents(event_df = event_df))
+    from_frame = mergeTrack_and_PP(event_df = pp_data, track_df = tracking_df)
+    from_tensor = mergeTrack_and_PP(event_df = pp_data, track_df = store_dir)
+    assert len(from_frame) > 0
+    pd.testing.assert_frame_equal(from_tensor, from_frame, check_dtype = False)
+
+def test_interval_join_matches_cross_join(offline_cache):
+    match_ids = offline_cache
+    tracking_df = readTrackingData(match_list = match_ids)
+    event_df = readEvents(match_list = match_ids)
+    pp_data, _ = process_PPdata(event_df = event_df, partitions = partitionEvents(event_df = event_df))
+
+    for include_pass in [True, False]:
+        interval = mergeTrack_and_PP(event_df = pp_data, track_df = tracking_df, include_pass = include_pass, join_type = "interval")
+        cross = mergeTrack_and_PP(event_df = pp_data, track_df = tracking_df, include_pass = include_pass, join_type = "cross")
+        assert len(interval) > 0
+
+        # same rows, the cross join keeps the order of the merge
+        interval = interval.sort_values(["poss_key", "frame"], kind = "stable").reset_index(drop = True)
+        cross = cross.sort_values(["poss_key", "frame"], kind = "stable").reset_index(drop = True)
+        pd.testing.assert_frame_equal(interval, cross[interval.columns], check_dtype = False)